@@ -0,0 +1,158 @@
+"""End to end timings of DeviceConnector against the simulated board of alpaca_kernel.simulator.
+
+Run as ``python -m alpaca_kernel.benchmark``.  The simulator is started on a pseudo-terminal, TCP port or
+WebREPL port at the given baud rate and latency, then the connect time, the round trip of a trivial cell,
+the upload of a large cell, sendtofile/fetchfile throughput with and without compression and the rate
+at which live plot lines are taken in are measured.  Each run appends a JSON line to --output, and
+--compare prints the results beside the last run recorded in another (or the same) file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from . import deviceconnector
+
+benchmarkfile = "alpacabench.jsonl"
+
+
+# stands in for the output functions of the kernel, just counting
+class OutputSink:
+    def __init__(self):
+        self.nlines = 0
+        self.nchars = 0
+
+    def __call__(self, output, *args, **kwargs):
+        output = str(output)
+        self.nlines += output.count("\n")
+        self.nchars += len(output)
+
+
+def startsimulator(transport, baud, latency):
+    pargs = [sys.executable, "-m", "alpaca_kernel.simulator", "--baud", str(baud), "--latency", str(latency)]
+    pargs.extend({ "pty":["--pty"], "tcp":["--tcp", "0"], "websocket":["--websocket", "0"] }[transport])
+    process = subprocess.Popen(pargs, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    line = process.stdout.readline().decode()
+    if not line.startswith("ALPACASIM "):
+        process.kill()
+        raise RuntimeError("simulator did not start: {}".format(line))
+    return process, json.loads(line[len("ALPACASIM "):])
+
+
+def connect(dc, transport, info, baud):
+    if transport == "pty":
+        dc.serialconnect(info["pty"], baud or 115200, False)
+    elif transport == "tcp":
+        dc.socketconnect("127.0.0.1", info["tcp"])
+    else:
+        dc.websocketconnect(info["websocket"])
+        dc.workingwebsocket.recv()   # Password:
+        dc.workingwebsocket.send(info["password"])
+        dc.workingwebsocket.send("\r\n")
+        time.sleep(0.1)
+        dc.workingserialreadall()
+    return dc.enterpastemode(verbose=False)
+
+
+def runcell(dc, cell, isplotting=0):
+    dc.writebytes(cell.encode() + b"\r\x04")
+    return dc.receivestream(bseekokay=True, isplotting=isplotting)
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.perf_counter()
+    res = f(*args, **kwargs)
+    return time.perf_counter() - t0, res
+
+
+def runbenchmarks(transport="pty", baud=115200, latency=0.0, repeat=20, filesize=16384, plotlines=2000):
+    process, info = startsimulator(transport, baud, latency)
+    sink = OutputSink()
+    dc = deviceconnector.DeviceConnector(sink, sink, sink)
+    results = { }
+    try:
+        seconds, bready = timed(connect, dc, transport, info, baud)
+        if not bready:
+            raise RuntimeError("could not get the simulator into the raw REPL")
+        results["connect_s"] = seconds
+
+        runcell(dc, "1")
+        roundtrips = [ timed(runcell, dc, "1")[0]  for i in range(repeat) ]
+        results["cell_roundtrip_ms"] = statistics.median(roundtrips)*1000
+
+        largecell = "".join("x{} = {} + {}*2  # a longer line of cell\n".format(i, i, i)  for i in range(400))
+        seconds, res = timed(runcell, dc, largecell)
+        results["largecell_kBps"] = len(largecell)/seconds/1000
+
+        rng = random.Random(1)
+        binarydata = bytes(rng.getrandbits(8)  for i in range(filesize))
+        textdata = "".join("{:6d} {:.6f}, reading {}\n".format(i, rng.random(), rng.choice(["ok", "low", "high"]))  for i in range(filesize//30)).encode()
+        for name, data in [("binary", binarydata), ("text", textdata)]:
+            for bcompress in ([False, True]  if name == "text"  else [False]):
+                key = "{}{}".format(name, "_compressed" if bcompress else "")
+                seconds, res = timed(dc.sendtofile, "bench/{}.dat".format(name), True, False, True, True, data, bcompress=bcompress)
+                with open(os.path.join(info["root"], "bench", name + ".dat"), "rb") as fin:
+                    if fin.read() != data:
+                        raise RuntimeError("sendtofile {} came out different".format(key))
+                results["sendtofile_{}_kBps".format(key)] = len(data)/seconds/1000
+                seconds, fetched = timed(dc.fetchfile, "bench/{}.dat".format(name), True, True, bcompress=bcompress)
+                if fetched != data:
+                    raise RuntimeError("fetchfile {} came out different".format(key))
+                results["fetchfile_{}_kBps".format(key)] = len(data)/seconds/1000
+
+        nlines = sink.nlines
+        seconds, res = timed(runcell, dc, "for i in range({}):\n print(i, i*0.5, -i)".format(plotlines), isplotting=1)
+        results["plot_lines_per_s"] = (sink.nlines - nlines)/seconds
+        results["plot_kBps"] = sum(len("{} {} {}\r\n".format(i, i*0.5, -i))  for i in range(plotlines))/seconds/1000
+    finally:
+        dc.disconnect(raw=True)
+        process.kill()
+    return results
+
+
+def comparisontable(results, previous):
+    lines = [ "{:<36} {:>12} {:>12} {:>8}\n".format("", "this run", "previous", "ratio") ]
+    for key, value in results.items():
+        before = previous.get(key)
+        ratio = "{:8.2f}".format(value/before)  if before  else "       -"
+        lines.append("{:<36} {:12.2f} {:>12} {}\n".format(key, value, "-" if before is None else "{:.2f}".format(before), ratio))
+    return "".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the kernel's device connection against a simulated board")
+    parser.add_argument('--transport', choices=["pty", "tcp", "websocket"], default="pty")
+    parser.add_argument('--baud', type=int, default=115200, help="0 for no limit")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each way")
+    parser.add_argument('--repeat', type=int, default=20, help="trivial cells to time")
+    parser.add_argument('--filesize', type=int, default=16384)
+    parser.add_argument('--output', type=str, default=benchmarkfile, help="JSON lines file the results are appended to")
+    parser.add_argument('--compare', type=str, help="results file whose last run to compare with")
+    args = parser.parse_args(argv)
+
+    results = runbenchmarks(args.transport, args.baud, args.latency, args.repeat, args.filesize)
+    record = { "time":time.time(), "transport":args.transport, "baud":args.baud, "latency":args.latency,
+               "python":platform.python_version(), "results":results }
+
+    previous = { }
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as fin:
+            lines = [ line  for line in fin  if line.strip() ]
+        if lines:
+            previous = json.loads(lines[-1])["results"]
+    print(comparisontable(results, previous), end="")
+
+    if args.output:
+        with open(args.output, "a") as fout:
+            fout.write(json.dumps(record) + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
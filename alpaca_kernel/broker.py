@@ -0,0 +1,450 @@
+"""Local broker process that holds serial connections open across kernel restarts.
+
+Run with ``python -m alpaca_kernel.broker`` (the kernel starts it itself on ``%serialconnect --broker``).
+Kernels and monitors talk to it over a Unix socket with frames of [type byte][u32 length][payload].
+Client sockets are non-blocking with their frames queued, so one that stops reading can't hold up the
+others: a monitor that falls too far behind is dropped, and a controlling kernel loses its oldest output.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import select
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import serial
+
+from .deviceconnector import alpacacachedir, serialtimeout
+
+logger = logging.getLogger(__name__)
+
+FRAMEHEADER = struct.Struct(">cI")
+
+# frame types
+FATTACH = b'A'    # client->broker json {"port", "baud", "monitor"}, answered with FREPLY
+FDATA = b'D'      # bytes to the device, or bytes from the device
+FCLOSE = b'C'     # client->broker: really close the serial port (otherwise only detach)
+FSTATUS = b'S'    # client->broker: list held devices, answered with FREPLY
+FQUIT = b'Q'      # client->broker: close everything and exit
+FREPLY = b'R'     # broker->client json
+
+backlogsize = 65536   # device output kept while no kernel is attached
+clientbuffermax = 1024*1024   # bytes queued for a client that isn't reading before it is dropped or trimmed
+brokeridletimeout = 600  # exit after this long with no devices held and no clients
+
+
+def brokersocketpath():
+    return os.environ.get("ALPACA_BROKER_SOCKET") or os.path.join(alpacacachedir(), "broker.sock")
+
+
+def frame(ftype, payload=b""):
+    if type(payload) == dict or type(payload) == list:
+        payload = json.dumps(payload).encode()
+    return FRAMEHEADER.pack(ftype, len(payload)) + payload
+
+def sendframe(sock, ftype, payload=b""):
+    sock.sendall(frame(ftype, payload))
+
+
+class FrameReader:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        frames = [ ]
+        while len(self.buffer) >= FRAMEHEADER.size:
+            ftype, n = FRAMEHEADER.unpack_from(self.buffer)
+            if len(self.buffer) < FRAMEHEADER.size + n:
+                break
+            frames.append((ftype, bytes(self.buffer[FRAMEHEADER.size:FRAMEHEADER.size+n])))
+            del self.buffer[:FRAMEHEADER.size+n]
+        return frames
+
+
+class BrokerDevice:
+    def __init__(self, portname, baudrate):
+        self.portname = portname
+        self.baudrate = baudrate
+        self.serial = serial.Serial(portname, baudrate, timeout=0)
+        self.controller = None    # the one client allowed to write
+        self.monitors = set()     # read-only followers of the output stream
+        self.backlog = bytearray()
+        self.opentime = time.time()
+
+
+class BrokerClient:
+    def __init__(self):
+        self.framereader = FrameReader()
+        self.device = None
+        self.outframes = collections.deque()   # (type, framed bytes) waiting to be sent, the first from outoffset
+        self.outoffset = 0
+        self.outbytes = 0
+        self.bwaitingwrite = False   # registered for EVENT_WRITE
+
+
+class DeviceBroker:
+    def __init__(self, socketpath):
+        self.socketpath = socketpath
+        self.sel = selectors.DefaultSelector()
+        self.devices = { }    # portname -> BrokerDevice
+        self.clients = { }    # socket -> BrokerClient
+        self.lastactivity = time.time()
+        self.running = True
+
+    def serve(self):
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socketpath)
+        os.chmod(self.socketpath, 0o600)
+        listener.listen(8)
+        listener.setblocking(False)
+        self.sel.register(listener, selectors.EVENT_READ, "listener")
+        logger.info("broker listening on %s", self.socketpath)
+        try:
+            while self.running:
+                for key, mask in self.sel.select(timeout=serialtimeout):
+                    if key.data == "listener":
+                        csock, _ = listener.accept()
+                        csock.setblocking(False)
+                        self.clients[csock] = BrokerClient()
+                        self.sel.register(csock, selectors.EVENT_READ, "client")
+                    elif key.data == "client":
+                        if mask & selectors.EVENT_READ:
+                            self.clientreadable(key.fileobj)
+                        if mask & selectors.EVENT_WRITE and key.fileobj in self.clients:
+                            self.flushclient(key.fileobj)
+                    else:
+                        self.devicereadable(key.data)
+                if self.devices or self.clients:
+                    self.lastactivity = time.time()
+                elif time.time() - self.lastactivity > brokeridletimeout:
+                    break
+        finally:
+            for csock, client in self.clients.items():   # eg the reply to FQUIT
+                try:
+                    csock.settimeout(1)
+                    for i, (ftype, data) in enumerate(client.outframes):
+                        csock.sendall(data[client.outoffset:]  if i == 0  else data)
+                except OSError:
+                    pass
+            for device in list(self.devices.values()):
+                self.closedevice(device)
+            self.sel.close()
+            listener.close()
+            if os.path.exists(self.socketpath):
+                os.remove(self.socketpath)
+
+    def devicereadable(self, device):
+        try:
+            data = device.serial.read(device.serial.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            logger.warning("device %s lost: %s", device.portname, e)
+            self.closedevice(device)
+            return
+        if not data:
+            return
+        if device.controller:
+            self.queueframe(device.controller, FDATA, data)
+        else:
+            device.backlog.extend(data)
+            del device.backlog[:-backlogsize]
+        for monitor in list(device.monitors):
+            self.queueframe(monitor, FDATA, data)
+
+    def queueframe(self, csock, ftype, payload):
+        client = self.clients.get(csock)
+        if client is None:
+            return
+        data = frame(ftype, payload)
+        client.outframes.append((ftype, data))
+        client.outbytes += len(data)
+        if client.outbytes > clientbuffermax:
+            if client.device is None or client.device.controller is not csock:
+                logger.warning("dropping a monitor that isn't reading")
+                self.dropclient(csock)
+                return
+            # the controlling kernel isn't reading, so lose its oldest output (not the frame part sent)
+            ndropped = 0
+            kept = collections.deque()
+            for i, (qtype, qdata) in enumerate(client.outframes):
+                if client.outbytes - ndropped > clientbuffermax and qtype == FDATA and not (i == 0 and client.outoffset):
+                    ndropped += len(qdata)
+                else:
+                    kept.append((qtype, qdata))
+            client.outframes = kept
+            client.outbytes -= ndropped
+            logger.warning("dropped %d bytes of output from %s that the kernel isn't reading", ndropped, client.device.portname)
+        self.flushclient(csock)
+
+    def flushclient(self, csock):
+        client = self.clients[csock]
+        while client.outframes:
+            ftype, data = client.outframes[0]
+            try:
+                n = csock.send(memoryview(data)[client.outoffset:])
+            except BlockingIOError:
+                break
+            except OSError:
+                self.dropclient(csock)
+                return
+            client.outoffset += n
+            client.outbytes -= n
+            if client.outoffset < len(data):
+                break
+            client.outframes.popleft()
+            client.outoffset = 0
+        if client.bwaitingwrite != bool(client.outframes):
+            client.bwaitingwrite = bool(client.outframes)
+            self.sel.modify(csock, selectors.EVENT_READ | (selectors.EVENT_WRITE if client.bwaitingwrite else 0), "client")
+
+    def clientreadable(self, csock):
+        try:
+            data = csock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:   # a kernel that dies or restarts just detaches, leaving the port open
+            self.dropclient(csock)
+            return
+        client = self.clients[csock]
+        for ftype, payload in client.framereader.feed(data):
+            device = client.device
+            if ftype == FDATA:
+                if device and device.controller is csock:
+                    device.serial.write(payload)
+            elif ftype == FATTACH:
+                self.attach(csock, json.loads(payload.decode()))
+            elif ftype == FSTATUS:
+                self.queueframe(csock, FREPLY, {"devices":[ { "port":d.portname, "baud":d.baudrate, "attached":(d.controller is not None),
+                                                         "monitors":len(d.monitors), "uptime":time.time()-d.opentime }  for d in self.devices.values() ]})
+            elif ftype == FCLOSE:   # only the controlling client can close the port, a monitor just goes away
+                if device and device.controller is not csock:
+                    self.queueframe(csock, FREPLY, {"ok":False, "error":"{} is controlled by another client".format(device.portname)})
+                    continue
+                if device:
+                    self.closedevice(device)
+                self.queueframe(csock, FREPLY, {"ok":True})
+            elif ftype == FQUIT:
+                self.running = False
+                self.queueframe(csock, FREPLY, {"ok":True})
+
+    def attach(self, csock, request):
+        portname, baudrate = request["port"], request.get("baud", 115200)
+        fresh = portname not in self.devices
+        if fresh:
+            if request.get("monitor"):
+                self.queueframe(csock, FREPLY, {"ok":False, "error":"{} is not held by the broker".format(portname)})
+                return
+            try:
+                device = BrokerDevice(portname, baudrate)
+            except (serial.SerialException, OSError) as e:
+                self.queueframe(csock, FREPLY, {"ok":False, "error":str(e)})
+                return
+            self.devices[portname] = device
+            self.sel.register(device.serial.fileno(), selectors.EVENT_READ, device)
+        device = self.devices[portname]
+        if device.baudrate != baudrate and not request.get("monitor"):
+            device.serial.baudrate = baudrate
+            device.baudrate = baudrate
+
+        self.clients[csock].device = device
+        if request.get("monitor"):
+            device.monitors.add(csock)
+        else:
+            if device.controller is not None and device.controller is not csock:
+                self.queueframe(device.controller, FREPLY, {"ok":False, "error":"taken over by another kernel", "takenover":True})
+                if device.controller in self.clients:
+                    self.clients[device.controller].device = None
+            device.controller = csock
+        self.queueframe(csock, FREPLY, {"ok":True, "fresh":fresh, "port":portname, "baud":device.baudrate})
+        if device.backlog and device.controller is csock:
+            self.queueframe(csock, FDATA, bytes(device.backlog))
+            device.backlog.clear()
+
+    def dropclient(self, csock):
+        if csock not in self.clients:
+            return
+        device = self.clients.pop(csock).device
+        if device:
+            device.monitors.discard(csock)
+            if device.controller is csock:
+                device.controller = None
+        self.sel.unregister(csock)
+        csock.close()
+
+    def closedevice(self, device):
+        if self.devices.get(device.portname) is device:
+            del self.devices[device.portname]
+        self.sel.unregister(device.serial.fileno())
+        device.serial.close()
+        for csock, client in self.clients.items():
+            if client.device is device:
+                client.device = None
+
+
+# connection to the broker which stands in for a serial.Serial as DeviceConnector.workingserial
+class BrokerSerial:
+    def __init__(self, socketpath, timeout=serialtimeout):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socketpath)
+        self.timeout = timeout
+        self.framereader = FrameReader()
+        self.rxbuffer = bytearray()
+        self.replies = [ ]
+        self.takenover = False   # another kernel has attached to the port as controller
+        self.port = None
+        self.baudrate = None
+        self.fresh = True
+
+    def __str__(self):
+        return "BrokerSerial(port={}, baudrate={}, fresh={})".format(self.port, self.baudrate, self.fresh)
+
+    def request(self, ftype, payload=b""):
+        while self._pump(0):   # so that no reply left over from before is taken as the answer
+            pass
+        self.replies.clear()
+        sendframe(self.sock, ftype, payload)
+        tend = time.time() + 5
+        while not self.replies:
+            if time.time() > tend:
+                raise serial.SerialException("no reply from broker")
+            self._pump(0.1)
+        return self.replies.pop(0)
+
+    def attach(self, portname, baudrate, monitor=False):
+        reply = self.request(FATTACH, {"port":portname, "baud":baudrate, "monitor":monitor})
+        if not reply.get("ok"):
+            raise serial.SerialException(reply.get("error", "broker refused the port"))
+        self.port, self.baudrate, self.fresh = reply["port"], reply["baud"], reply["fresh"]
+        self.takenover = False
+        return self
+
+    def _pump(self, timeout):
+        r, w, e = select.select([self.sock], [], [], timeout)
+        if not r:
+            return False
+        data = self.sock.recv(65536)
+        if not data:
+            raise serial.SerialException("connection to broker closed")
+        for ftype, payload in self.framereader.feed(data):
+            if ftype == FDATA:
+                self.rxbuffer.extend(payload)
+            elif ftype == FREPLY:
+                reply = json.loads(payload.decode())
+                if reply.get("takenover"):   # not the answer to a request
+                    self.takenover = True
+                else:
+                    self.replies.append(reply)
+        return True
+
+    def read(self, size=1):
+        tend = time.time() + self.timeout
+        while len(self.rxbuffer) < size:
+            remaining = tend - time.time()
+            if remaining <= 0:
+                break
+            self._pump(remaining)
+        res = bytes(self.rxbuffer[:size])
+        del self.rxbuffer[:size]
+        return res
+
+    def read_all(self):
+        while self._pump(0):
+            pass
+        res = bytes(self.rxbuffer)
+        self.rxbuffer.clear()
+        return res
+
+    @property
+    def in_waiting(self):
+        while self._pump(0):
+            pass
+        return len(self.rxbuffer)
+
+    def write(self, data):
+        if self.takenover:   # the broker would drop the data
+            raise serial.SerialException("{} taken over by another kernel".format(self.port))
+        sendframe(self.sock, FDATA, data)
+        return len(data)
+
+    def isOpen(self):
+        return self.sock is not None
+
+    def close(self):   # an explicit close releases the port; a kernel that just goes away leaves it held
+        if self.sock is not None:
+            try:
+                self.request(FCLOSE)
+            except (serial.SerialException, OSError):
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+def brokerstatus(socketpath=None):
+    s = BrokerSerial(socketpath or brokersocketpath())
+    try:
+        return s.request(FSTATUS)["devices"]
+    finally:
+        s.sock.close()
+
+
+# connect to the broker, starting it in the background if it's not there yet
+def brokerserial(socketpath=None):
+    socketpath = socketpath or brokersocketpath()
+    try:
+        return BrokerSerial(socketpath)
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    subprocess.Popen([sys.executable, "-m", "alpaca_kernel.broker", "--socket", socketpath],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for i in range(50):
+        time.sleep(0.1)
+        try:
+            return BrokerSerial(socketpath)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+    raise serial.SerialException("could not start broker on {}".format(socketpath))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hold MicroPython serial connections open for ALPACA kernels")
+    parser.add_argument('--socket', type=str, default=None)
+    parser.add_argument('--monitor', type=str, metavar="PORT", help="follow the output of a device held by the broker")
+    parser.add_argument('--status', action='store_true', help="list the devices held by the broker")
+    parser.add_argument('--stop', action='store_true', help="close all devices and stop the broker")
+    args = parser.parse_args(argv)
+    socketpath = args.socket or brokersocketpath()
+
+    if args.status:
+        for d in brokerstatus(socketpath):
+            print("{port} baud={baud} attached={attached} monitors={monitors} uptime={uptime:.0f}s".format(**d))
+    elif args.stop:
+        s = BrokerSerial(socketpath)
+        s.request(FQUIT)
+        s.sock.close()
+    elif args.monitor:
+        s = BrokerSerial(socketpath).attach(args.monitor, None, monitor=True)
+        try:
+            while True:
+                s._pump(1.0)
+                sys.stdout.write(s.read_all().decode(errors="replace"))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    else:
+        logging.basicConfig(level=logging.INFO)
+        DeviceBroker(socketpath).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,260 @@
-import logging, sys, time, os, re, binascii, subprocess, ast
+import logging, sys, time, os, re, binascii, subprocess, ast, json, hashlib, zlib, struct
 import serial, socket, serial.tools.list_ports, select
 import websocket  # the old non async one
+import queue, threading, itertools, array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from . import devicehelpers
+from . import hostmount
+from . import wiretrace
 
 serialtimeout = 0.5
 serialtimeoutcount = 10
 
+probetimeout = 1.5   # seconds to wait for a raw REPL banner when auto-detecting ports
+esptoolmaxparallel = 8   # esptool processes flashing at the same time
+
+compressminbytes = 512    # smaller files aren't worth the extra round trips of a compressed transfer
+compressmaxratio = 0.85   # only send compressed if it comes out smaller than this
+compresswbits = 10        # 1kB window, so the device doesn't have to find 32kB for the dictionary
+
+transferchunksize = 30       # bytes per base64 line, each with its own crc32
+transfergroupsize = 10       # lines per execution when sending
+transfersegmentsize = 1920   # bytes per execution when fetching
+transfercheckpoint = 4096    # granularity at which --resume compares the partial file
+transfermaxretries = 5       # times the same offset can fail before giving up
+
+def compressdata(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, compresswbits)
+    return compressor.compress(data) + compressor.flush()
+
+webreplfile = "<2sBBQLH64s"   # WebREPL file transfer request header: b"WA", op, 0, 0, size, len(fname), fname
+webreplputfile, webreplgetfile = 1, 2
+webreplchunksize = 2048
+webrepltimeout = 5
+socketrecvsize = 4096
+
+writebuffermax = 4096   # bytes held back by sswrite before they go out anyway
+protocolboundary = re.compile(b"[\x01-\x04]")   # raw REPL control codes, which the device acts on straight away
+
+# lines that make the directories leading up to a file on the device
+def mkdirlines(filename):
+    dseq = [ d  for d in filename.split("/")[:-1]  if d]
+    if not dseq:
+        return b""
+    res = [ b'import os\r\n' ]
+    for i in range(len(dseq)):
+        res.append('try:  os.mkdir({})\r\n'.format(repr("/".join(dseq[:i+1]))).encode())
+        res.append(b'except OSError:  pass\r\n')
+    return b"".join(res)
+
+deltamaxblocks = 1024      # so the block sums of the old file come back in one short reply
+deltamaxliteral = 0.8      # a full send is quicker if more than this much would go as literal data
+
+def deltablocksize(nbytes):
+    blocksize = 256
+    while nbytes > blocksize*deltamaxblocks:
+        blocksize *= 2
+    return blocksize
+
+# rsync matching of data against the [(sum, crc32)] of the full blocks of the old file: the byte sum over 
+# each window comes from prefix sums, so it only costs a crc32 where the sum already matches a block;
+# returns (instruction stream for the device's _alpacadelta, number of literal bytes)
+def deltainstructions(data, blocksums, blocksize):
+    table = { }
+    for j, (weak, strong) in enumerate(blocksums):
+        table.setdefault(weak, { }).setdefault(strong, j)
+    prefix = array.array('q', itertools.accumulate(data, initial=0))
+
+    res, nliteral = [ ], 0
+    literalstart, i = 0, 0
+    copystart, copycount = None, 0
+    def flushcopy():
+        if copycount:
+            res.append(b"C" + struct.pack(">II", copystart, copycount))
+    while i + blocksize <= len(data):
+        candidates = table.get(prefix[i+blocksize] - prefix[i])
+        j = candidates.get(zlib.crc32(data[i:i+blocksize]))  if candidates  else None
+        if j is None:
+            i += 1
+            continue
+        if literalstart < i:
+            flushcopy()
+            copycount = 0
+            res.append(b"L" + struct.pack(">II", 0, i - literalstart) + data[literalstart:i])
+            nliteral += i - literalstart
+        if copycount and j == copystart + copycount:
+            copycount += 1
+        else:
+            flushcopy()
+            copystart, copycount = j, 1
+        i += blocksize
+        literalstart = i
+    flushcopy()
+    if literalstart < len(data):
+        res.append(b"L" + struct.pack(">II", 0, len(data) - literalstart) + data[literalstart:])
+        nliteral += len(data) - literalstart
+    return b"".join(res), nliteral
+
+esptoolprogress = re.compile(r"\((\d+) ?%\)")
+
 wifimessageignore = re.compile("(\x1b\[[\d;]*m)?[WI] \(\d+\) (wifi|system_api|modsocket|phy|event|cpu_start|heap_init|network|wpa): ")
 
+# local directory for things worth remembering between kernel sessions (port probes, build products)
+def alpacacachedir(*subdirs):
+    d = os.environ.get("ALPACA_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "alpaca_kernel")
+    d = os.path.join(d, *subdirs)
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def loadjsoncache(filename):
+    try:
+        with open(os.path.join(alpacacachedir(), filename)) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+def savejsoncache(filename, cache):
+    fname = os.path.join(alpacacachedir(), filename)
+    try:
+        with open(fname + ".tmp", "w") as fout:
+            json.dump(cache, fout, indent=1, sort_keys=True)
+        os.replace(fname + ".tmp", fname)
+    except OSError as e:
+        logging.warning("could not write cache {}: {}".format(fname, e))
+
+# key under which probe results are remembered (the device name of a port can change between plug-ins)
+def portusbkey(portinfo):
+    if portinfo.vid is None:
+        return None
+    return "{:04x}:{:04x}:{}".format(portinfo.vid, portinfo.pid, portinfo.serial_number or "")
+
 # this should take account of the operating system
 def guessserialport():  
     lp = list(serial.tools.list_ports.grep(""))
-    lp.sort(key=lambda X: (X.hwid == "n/a", X.device))  # n/a could be good evidence that the port is non-existent
+    portcache = loadjsoncache("portcache.json")
+    # boards that have answered as MicroPython before go first, n/a could be good evidence that the port is non-existent
+    lp.sort(key=lambda X: (not portcache.get(portusbkey(X), {}).get("micropython", False), X.hwid == "n/a", X.device))
     return [x.device  for x in lp]
 
+# open a port, interrupt whatever is running and see if it answers with a raw REPL banner 
+# returns (score, banner) where score 2=raw REPL, 1=something python-like, 0=no sign of MicroPython
+def probeserialport(portname, baudrate):
+    try:
+        s = serial.Serial(portname, baudrate, timeout=0.05)
+    except (serial.SerialException, OSError) as e:
+        return 0, str(e)
+    res = [ ]
+    try:
+        s.write(b'\r\x03\x03')   # ctrl-C twice to kill off running programs
+        s.write(b'\r\x01')        # ctrl-A: enter raw REPL
+        tend = time.time() + probetimeout
+        while time.time() < tend:
+            res.append(s.read(256))
+            if b"raw REPL" in b"".join(res)[-300:]:
+                break
+        if b"raw REPL" in b"".join(res):
+            s.write(b'\x02')       # ctrl-B: back to normal REPL, which prints the board banner
+            tend = time.time() + probetimeout
+            while time.time() < tend:
+                res.append(s.read(256))
+                if b"\r\n>>> " in b"".join(res)[-300:]:
+                    break
+    except (serial.SerialException, OSError) as e:
+        return 0, str(e)
+    finally:
+        s.close()
+
+    b = b"".join(res)
+    mbanner = re.search(rb"(MicroPython [^\r\n]*)", b)
+    banner = mbanner.group(1).decode(errors="replace") if mbanner else ""
+    if b"raw REPL" in b:
+        return 2, banner
+    if b">>>" in b or mbanner:
+        return 1, banner
+    return 0, banner
+
+# probes all candidate ports at once (each port waits for its own timeout, so serially this is slow)
+# and returns [(portname, score, banner)] best first; remembers what it found against the USB VID/PID
+def probeserialports(baudrate):
+    lp = list(serial.tools.list_ports.grep(""))
+    if not lp:
+        return [ ]
+    with ThreadPoolExecutor(max_workers=len(lp)) as executor:
+        probes = list(executor.map(lambda X: probeserialport(X.device, baudrate), lp))
+
+    portcache = loadjsoncache("portcache.json")
+    for portinfo, (score, banner) in zip(lp, probes):
+        key = portusbkey(portinfo)
+        if key:
+            portcache[key] = { "micropython":(score != 0), "board":banner, "port":portinfo.device, "time":time.time() }
+    savejsoncache("portcache.json", portcache)
+
+    res = [ (portinfo.device, score, banner)  for portinfo, (score, banner) in zip(lp, probes) ]
+    res.sort(key=lambda X: (-X[1], X[0]))
+    return res
+
+# the port of a board we have seen answer as MicroPython before, without opening anything
+def cachedmicropythonport():
+    portcache = loadjsoncache("portcache.json")
+    for portinfo in serial.tools.list_ports.grep(""):
+        if portcache.get(portusbkey(portinfo), {}).get("micropython", False):
+            return portinfo.device, portcache[portusbkey(portinfo)].get("board", "")
+    return None, ""
+
+# ports held open by a running broker (which isn't started just to ask)
+def brokerheldports():
+    try:
+        from . import broker
+        return [ d["port"]  for d in broker.brokerstatus() ]
+    except (OSError, AttributeError, serial.SerialException):   # no broker running, or no unix sockets
+        return [ ]
+
+# runs the processes in {tag: pargs} (at most maxparallel at once) and yields (tag, streamname, line) 
+# as soon as lines turn up on either pipe; reading stdout to the end before stderr can deadlock 
+# when the stderr pipe fills.  Lines are also broken at \r so progress updates come through.
+# Finally yields (tag, "exit", returncode) for each process.
+def streamprocesses(pargsbytag, maxparallel=esptoolmaxparallel):
+    linequeue = queue.Queue()
+    def pipereader(tag, streamname, pipe):
+        for line in iter(pipe.readline, b''):
+            for subline in line.replace(b'\r\n', b'\n').split(b'\r'):
+                if subline.strip():
+                    linequeue.put((tag, streamname, subline.decode(errors="replace")))
+        pipe.close()
+        linequeue.put((tag, streamname, None))
+
+    pending = list(pargsbytag.items())
+    running = { }  # tag -> [process, open pipe count]
+    try:
+        while pending or running:
+            while pending and len(running) < maxparallel:
+                tag, pargs = pending.pop(0)
+                try:
+                    process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                except OSError as e:
+                    yield tag, "stderr", "{}\n".format(str(e))
+                    yield tag, "exit", -1
+                    continue
+                running[tag] = [process, 2]
+                for streamname, pipe in (("stdout", process.stdout), ("stderr", process.stderr)):
+                    threading.Thread(target=pipereader, args=(tag, streamname, pipe), daemon=True).start()
+            if not running:
+                break
+            tag, streamname, line = linequeue.get()
+            if line is not None:
+                yield tag, streamname, line
+            else:
+                running[tag][1] -= 1
+                if running[tag][1] == 0:
+                    process = running.pop(tag)[0]
+                    yield tag, "exit", process.wait()
+    finally:   # the caller stopped early (closed, interrupted): don't leave esptool running on a port
+        for process, npipes in running.values():
+            process.terminate()
+        for process, npipes in running.values():
+            process.wait()
+
 # merge uncoming serial stream and break at OK, \x04, >, \r\n, and long delays 
 # (must make this a member function so does not have to switch on the type of s)
 def yieldserialchunk(s):
@@ -22,16 +264,24 @@ def yieldserialchunk(s):
     wsresbufferI = 0
     while True:
         try:
-            if type(s) == serial.Serial:
-                b = s.read()
-            elif type(s) == socket.socket:
-                r,w,e = select.select([s], [], [], serialtimeout)
-                if r:
-                    b = s._sock.recv(1)
+            if isinstance(s, socket.socket):  # raw socket, read whatever has arrived in one go
+                if wsresbufferI >= len(wsresbuffer):
+                    r,w,e = select.select([s], [], [], serialtimeout)
+                    if r:
+                        wsresbuffer = s.recv(socketrecvsize)
+                        if not wsresbuffer:
+                            raise ConnectionResetError("socket closed by the device")
+                    else:
+                        wsresbuffer = b''
+                    wsresbufferI = 0
+
+                if len(wsresbuffer) > 0:
+                    b = wsresbuffer[wsresbufferI:wsresbufferI+1]
+                    wsresbufferI += 1
                 else:
                     b = b''
-                    
-            else:  # websocket (break down to individual bytes)
+
+            elif isinstance(s, websocket.WebSocket):  # websocket (break down to individual bytes)
                 if wsresbufferI >= len(wsresbuffer):
                     r,w,e = select.select([s], [], [], serialtimeout)
                     if r:
@@ -48,8 +298,11 @@ def yieldserialchunk(s):
                 else:
                     b = b''
 
+            else:   # serial.Serial or anything standing in for it (eg broker.BrokerSerial)
+                b = s.read()
+
                     
-        except serial.SerialException as e:
+        except (serial.SerialException, ConnectionError) as e:
             yield b"\r\n**[ys] "
             yield str(type(e)).encode("utf8")
             yield b"\r\n**[ys] "
@@ -76,6 +329,11 @@ def yieldserialchunk(s):
                 yield b''.join(res)
             yield b
             res.clear()
+        elif b == b'\x1e' or b == b'\x18':   # side result frame or mount request, which may follow output with no newline
+            if res:
+                yield b''.join(res)
+            res.clear()
+            res.append(b)
         else:
             res.append(b)
             if b == b'\n' and len(res) >= 2 and res[-2] == b'\r':
@@ -93,8 +351,43 @@ class DeviceConnector:
         self.sresSYS = sresSYS
         self._esptool_command = None
         self.sresPLOT = sresPLOT
+        self.installedhelpers = set()  # devicehelpers defined on the device since the last (re)boot
+        self.cachedcells = OrderedDict()  # hashes of the cells compiled and held by the device, least recently used first
+        self.receivedstderr = False  # whether the last receivestream got anything after the first \x04
+        self.sideresults = [ ]  # (tag, values...) frames the device sent during the last receivestream, see devicehelpers
+        self.fetchedpartial = b""  # verified bytes of the last fetchfile, for saving if it's interrupted
+        self.writebuffer = bytearray()  # waiting to go out, see sswrite
+        self.resetstats()
+        self.webreplbuffer = b""  # binary frames received ahead during a WebREPL file transfer
+        self.hostmount = None  # hostmount.HostMount serving requests from the device while cells run
+        self.devicecodecs = None  # what the firmware can (de)compress with, found on first use after a (re)boot
+        self.wiretrace = None  # wiretrace.TraceRecorder while %trace is recording
+        self.agentversion = None  # VERSION of the alpaca_agent module found on entering the raw REPL, 0 if there isn't one
+
+    # traffic and timings (time.perf_counter) since the start of the cell, for %timing
+    def resetstats(self):
+        self.stats = { "byteswritten":0, "nwrites":0, "writetime":0.0, "bytesread":0,
+                       "tfirstwrite":None,   # when the first bytes went out
+                       "tfirst04":None,      # when the first program was ended with \x04 
+                       "tfirstbyte":None,    # first byte back after that
+                       "tdone":None }        # the > ending the last program
 
     def workingserialreadall(self):  # usually used to clear the incoming buffer, results are printed out rather than used
+        res = self.workingserialreadallbytes()
+        self.stats["bytesread"] += len(res)
+        if res and self.wiretrace:
+            self.wiretrace.record(wiretrace.traceread, res)
+        return res
+
+    # the chunks of yieldserialchunk, recorded as they go by while there is a trace running
+    def yieldtracedchunk(self):
+        for rline in yieldserialchunk(self.workingserial or self.workingsocket or self.workingwebsocket):
+            if rline and self.wiretrace:
+                self.wiretrace.record(wiretrace.traceread, rline)
+            yield rline
+
+    def workingserialreadallbytes(self):
+        self.flushwrites()
         if self.workingserial:
             return self.workingserial.read_all()
 
@@ -112,16 +405,20 @@ class DeviceConnector:
         # socket case, get it all down
         res = [ ]
         while True:
-            r,w,e = select.select([self.workingsocket._sock],[],[],0)
+            r,w,e = select.select([self.workingsocket],[],[],0)
             if not r:
                 break
-            res.append(self.workingsocket._sock.recv(1000))
-            self.sres("Selected socket {}  {}\n".format(len(res), len(res[-1])))
+            b = self.workingsocket.recv(socketrecvsize)
+            if not b:
+                break
+            res.append(b)
         return b"".join(res)
 
     def disconnect(self, raw=False, verbose=False):
         if not raw:
             self.exitpastemode(verbose)   # this doesn't seem to do any good (paste mode is left on disconnect anyway)
+        self.writebuffer.clear()
+        self.resetdevicestate()   # the next connection may be to another board
 
         self.workingserialchunk = None
         if self.workingserial is not None:
@@ -138,8 +435,25 @@ class DeviceConnector:
             self.workingwebsocket.close()
             self.workingwebsocket = None
 
-    def serialconnect(self, portname, baudrate, verbose):
+    def autodetectserialport(self, baudrate, reprobe):
+        if not reprobe:
+            portname, board = cachedmicropythonport()
+            if portname:
+                self.sres("Using previously detected {} on {}\n".format(board or "MicroPython board", portname))
+                return portname
+        self.sresSYS("Probing serial ports for MicroPython...\n")
+        probes = probeserialports(baudrate)
+        for portname, score, banner in probes:
+            self.sres("  {:<20} {}\n".format(portname, (banner or "MicroPython") if score else "-"))
+        if probes and probes[0][1]:
+            return probes[0][0]
+        self.sresSYS("No MicroPython board answered\n")
+        return 0
+
+    def serialconnect(self, portname, baudrate, verbose, autodetect=False, reprobe=False):
         assert not  self.workingserial
+        if autodetect:
+            portname = self.autodetectserialport(baudrate, reprobe)
         if type(portname) is int:
             portindex = portname
             possibleports = guessserialport()
@@ -180,20 +494,47 @@ class DeviceConnector:
 
 
 
+    # serial connection held by the broker process, so it survives kernel restarts without resetting the board
+    # returns True if the broker already had the port open (and so presumably still in paste mode)
+    def brokerconnect(self, portname, baudrate, verbose):
+        assert not  self.workingserial
+        from . import broker   # needs unix sockets, so only imported when asked for
+        try:
+            bs = broker.brokerserial()
+            if type(portname) is int:
+                heldports = [ d["port"]  for d in broker.brokerstatus() ]
+                if heldports:
+                    portname = heldports[0]
+                else:
+                    possibleports = guessserialport()
+                    portname = possibleports[portname] if possibleports else ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
+            self.sresSYS("Connecting through broker to --port={} --baud={} ".format(portname, baudrate))
+            self.workingserial = bs.attach(portname, baudrate)
+        except (serial.SerialException, OSError) as e:
+            self.sres("\n{}\n".format(str(e)), 31)
+            self.workingserial = None
+            return False
+        if verbose:
+            self.sresSYS(" [connected]\n")
+            self.sres(str(self.workingserial))
+        self.sres("\n")
+        return not self.workingserial.fresh
+
     def socketconnect(self, ipnumber, portnumber):
         self.disconnect(verbose=True)
 
         self.sresSYS("Connecting to socket ({} {})\n".format(ipnumber, portnumber))
         s = socket.socket()
         try:
-            self.sres("preconnect\n")
+            s.settimeout(5)
             s.connect(socket.getaddrinfo(ipnumber, portnumber)[0][-1])
-            self.sres("Doing makefile\n")
-            self.workingsocket = s.makefile('rwb', 0)
-        except OSError as e:
-            self.sres("Socket OSError {}".format(str(e)))
+            s.settimeout(None)   # reads go through select, so writes can block
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # each write is a whole message, don't hold it back
+            self.workingsocket = s
         except ConnectionRefusedError as e:
-            self.sres("Socket ConnectionRefusedError {}".format(str(e)))
+            self.sres("Socket ConnectionRefusedError {}\n".format(str(e)))
+        except OSError as e:
+            self.sres("Socket OSError {}\n".format(str(e)))
 
 
     def websocketconnect(self, websocketurl):
@@ -213,18 +554,7 @@ class DeviceConnector:
             self.sres("WebSocketException {}\n".format(str(e)))
 
 
-    def esptool(self, espcommand, portname, binfile):
-        self.disconnect(verbose=True)
-        if type(portname) is int:
-            possibleports = guessserialport()
-            if possibleports:
-                portname = possibleports[portname]
-                if len(possibleports) > 1:
-                    self.sres("Found serial ports {}: \n".format(", ".join(possibleports)))
-            else:
-                self.sres("No possible ports found")
-                portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
-
+    def findesptool(self):
         if self._esptool_command is None:  # this section for finding what the name of the command function is; may print junk into the jupyter logs
             for command in ("esptool.py", "esptool"):  
                 try:
@@ -233,50 +563,184 @@ class DeviceConnector:
                     break
                 except (subprocess.CalledProcessError, OSError):
                     pass
-            if self._esptool_command is None:
-                self.sres("esptool not found on path\n")
-                return
+        return self._esptool_command
 
-        pargs = [self._esptool_command, "--port", portname]
+    # image writes go through flashimage, which compares the flash by MD5 first and only writes what differs
+    def esptoolargs(self, espcommand, portname, binfile, bforce=False):
         if espcommand == "erase":
-            pargs.append("erase_flash")
+            return [self._esptool_command, "--port", portname, "erase_flash"]
+        pargs = [sys.executable, "-m", "alpaca_kernel.flashimage", "--esptool", self._esptool_command, "--port", portname]
         if espcommand == "esp32":
-            pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000"])
-            pargs.append(binfile)
+            pargs.extend(["--chip", "esp32", "--baud", "115200", "--offset", "0x1000"])
         if espcommand == "esp8266":
-            pargs.extend(["--baud", "460800", "write_flash", "--flash_size=detect", "-fm", "dio", "0"])
-            pargs.append(binfile)
-        self.sresSYS("Executing:\n  {}\n\n".format(" ".join(pargs)))
-        process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in process.stdout:
-            x = line.decode()
-            self.sres(x)
-            if x[:12] == "Connecting..":
-                self.sresSYS("[Press the PRG button now if required]\n")
-        for line in process.stderr:
-            self.sres(line.decode(), n04count=1)
+            pargs.extend(["--chip", "esp8266", "--baud", "460800", "--offset", "0", "--flashargs", "--flash_size=detect -fm dio"])
+        if bforce:
+            pargs.append("--force")
+        pargs.append(binfile)
+        return pargs
+
+    # portnames is a list of port names or indexes into guessserialport(), or "all", which leaves out
+    # busyports (those of the other named connections) and any the broker is holding
+    def esptool(self, espcommand, portnames, binfile, bforce=False, busyports=()):
+        self.disconnect(verbose=True)
+        possibleports = guessserialport()
+        if portnames == "all":
+            busyports = set(busyports) | set(brokerheldports())
+            for portname in possibleports:
+                if portname in busyports:
+                    self.sres("Skipping {}, which is in use\n".format(portname))
+            portnames = [ portname  for portname in possibleports  if portname not in busyports ]
+        resolvedports = [ ]
+        for portname in portnames:
+            if type(portname) is int:
+                if possibleports:
+                    portname = possibleports[portname]
+                    if len(possibleports) > 1:
+                        self.sres("Found serial ports {}: \n".format(", ".join(possibleports)))
+                else:
+                    self.sres("No possible ports found")
+                    portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
+            if portname not in resolvedports:
+                resolvedports.append(portname)
+        if not resolvedports:
+            self.sres("No ports to flash\n", 31)
+            return
+
+        if self.findesptool() is None:
+            self.sres("esptool not found on path\n")
+            return
+
+        # what the firmware cache says the ports hold already (flashimage still checks the flash itself)
+        firmwarecache = loadjsoncache("firmwarecache.json")
+        if espcommand != "erase":
+            try:
+                with open(binfile, "rb") as fin:
+                    knownports = firmwarecache.get(hashlib.sha256(fin.read()).hexdigest(), { }).get("ports", { })
+            except OSError:
+                knownports = { }
+            for portname in resolvedports:
+                if portname in knownports:
+                    known = knownports[portname]
+                    self.sres("{} is known to hold this image (board {}, written {})\n".format(portname, known["mac"] or "unidentified",
+                              time.strftime("%Y-%m-%d %H:%M", time.localtime(known["time"]))))
+
+        pargsbyport = dict((portname, self.esptoolargs(espcommand, portname, binfile, bforce))  for portname in resolvedports)
+        for pargs in pargsbyport.values():
+            self.sresSYS("Executing:\n  {}\n".format(" ".join(pargs)))
+        self.sres("\n")
+        returncodes, flashresults = self.runesptools(pargsbyport)
+
+        # remember which image each port (and board, by MAC) holds; an erased port holds none
+        for portname in resolvedports:
+            if portname in flashresults or (espcommand == "erase" and returncodes.get(portname) == 0):
+                for entry in firmwarecache.values():
+                    entry["ports"].pop(portname, None)
+        for result in flashresults.values():
+            entry = firmwarecache.setdefault(result["sha256"], { "size":result["size"], "ports":{ } })
+            entry["file"] = result["file"]
+            entry["ports"][result["port"]] = { "mac":result["mac"], "offset":result["offset"], "time":time.time() }
+        if flashresults or espcommand == "erase":
+            savejsoncache("firmwarecache.json", dict((sha256, entry)  for sha256, entry in firmwarecache.items()  if entry["ports"]))
+
+        for portname, result in flashresults.items():
+            self.sres("{}: {}\n".format(portname, "already up to date, not written" if result["skipped"] else 
+                      "wrote {} of {} bytes".format(result["written"], result["size"])))
+
+    # runs esptool on all the ports at once, showing a progress bar per port that is redrawn with clear_output
+    def runesptools(self, pargsbyport):
+        logs = dict((portname, [ ])  for portname in pargsbyport)
+        status = dict((portname, [0, "starting"])  for portname in pargsbyport)
+        returncodes = { }
+        flashresults = { }
+        tlastdraw = 0
+        portwidth = max(map(len, pargsbyport))
+
+        def drawprogress():
+            lines = [ ]
+            for portname, (percent, message) in status.items():
+                bar = "#"*(percent//5) + "."*(20 - percent//5)
+                lines.append("{:<{}} [{}] {:3d}%  {}\n".format(portname, portwidth, bar, percent, message[:80]))
+            self.sres("".join(lines), clear_output=True)
+
+        for portname, streamname, line in streamprocesses(pargsbyport):
+            if streamname == "exit":
+                returncodes[portname] = line
+                status[portname][1] = "done" if line == 0 else "FAILED (exit code {})".format(line)
+                if line == 0:
+                    status[portname][0] = 100
+            elif line.startswith("ALPACAFLASH "):
+                flashresults[portname] = json.loads(line[12:])
+            else:
+                logs[portname].append((streamname, line))
+                mprogress = esptoolprogress.search(line)
+                if mprogress:
+                    status[portname][0] = int(mprogress.group(1))
+                else:
+                    status[portname][1] = line.strip()
+                    if line[:12] == "Connecting..":
+                        status[portname][1] += "  [Press the PRG button now if required]"
+            if time.time() - tlastdraw > 0.25 or streamname == "exit":
+                drawprogress()
+                tlastdraw = time.time()
+
+        # full logs for the ones that failed, or the only one there was
+        for portname, log in logs.items():
+            if returncodes.get(portname) != 0 or len(logs) == 1:
+                self.sres("\n{}:\n".format(portname), asciigraphicscode=(31 if returncodes.get(portname) else 34))
+                for streamname, line in log:
+                    if not esptoolprogress.search(line):
+                        self.sres("  " + line.rstrip("\n") + "\n", n04count=(1 if streamname == "stderr" else 0))
+        return returncodes, flashresults
 
     def mpycross(self, mpycrossexe, pyfile):
         pargs = [mpycrossexe, pyfile]
         self.sresSYS("Executing:  {}\n".format(" ".join(pargs)))
-        process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in process.stdout:
-            self.sres(line.decode())
-        for line in process.stderr:
-            self.sres(line.decode(), n04count=1)
-
-    def receivestream(self, bseekokay, isplotting = 0, bwarnokaypriors=True, b5secondtimeout=False, bfetchfilecapture_nchunks=0):
-        n04count = 0
+        for tag, streamname, line in streamprocesses({pyfile:pargs}):
+            if streamname != "exit":
+                self.sres(line, n04count=(1 if streamname == "stderr" else 0))
+            elif line != 0:
+                self.sres("mpy-cross failed (exit code {}){}\n".format(line, ", {} is left as it was".format(pyfile[:-3] + ".mpy")
+                          if pyfile.endswith(".py") and os.path.exists(pyfile[:-3] + ".mpy") else ""), 31)
+
+    def receivestream(self, bseekokay, isplotting = 0, bwarnokaypriors=True, b5secondtimeout=False, bfetchfilecapture_nchunks=0, n04count=0):
+        self.flushwrites()
+        self.receivedstderr = False
+        self.sideresults = [ ]
         brebootdetected = False
+        mountrequest = b""
+        sideresult = b""
         res = [ ]
         for j in range(2):  # for restarting the chunking when interrupted
             if self.workingserialchunk is None:
-                self.workingserialchunk = yieldserialchunk(self.workingserial or self.workingsocket or self.workingwebsocket)
+                self.workingserialchunk = self.yieldtracedchunk()
 
             indexprevgreaterthansign = -1
             index04line = -1
             for i, rline in enumerate(self.workingserialchunk):
                 assert rline is not None
+                if rline:
+                    self.stats["bytesread"] += len(rline)
+                    if self.stats["tfirstbyte"] is None and self.stats["tfirst04"] is not None:
+                        self.stats["tfirstbyte"] = time.perf_counter()
+
+                # request from the hostmount VFS on the device, which may have arrived in pieces
+                if (rline[:1] == b'\x18' or mountrequest) and self.hostmount:
+                    mountrequest += rline
+                    if mountrequest[-1:] == b'\n':
+                        self.writebytes(self.hostmount.handle(mountrequest.rstrip(b'\r\n')))
+                        mountrequest = b""
+                    continue
+
+                # frame of values sent back out of band from the output, which may also have arrived in pieces
+                if rline[:1] == b'\x1e' or sideresult:
+                    sideresult += rline
+                    if sideresult[-1:] == b'\n':
+                        try:
+                            self.sideresults.append(ast.literal_eval(sideresult[1:].decode().strip()))
+                        except (ValueError, SyntaxError, UnicodeDecodeError):
+                            self.sres("[unreadable frame {}]\n".format(sideresult[:40]), 31)
+                        sideresult = b""
+                    continue
 
                 # warning message when we are waiting on an OK
                 if bseekokay and bwarnokaypriors and (rline != b'OK') and (rline != b'>') and rline.strip():
@@ -295,6 +759,7 @@ class DeviceConnector:
 
                 # leaving condition where OK...x04...x04...> has been found in paste mode
                 elif rline == b'>' and n04count >= 2 and not bseekokay:
+                    self.stats["tdone"] = time.perf_counter()
                     if n04count != 2:
                         self.sres("[too many x04s %d]" % n04count)
                     break
@@ -327,6 +792,8 @@ class DeviceConnector:
                     except UnicodeDecodeError:
                         ur = str(rline)
                     if not wifimessageignore.match(ur):
+                        if n04count == 1 and ur.strip():
+                            self.receivedstderr = True
                         if bfetchfilecapture_nchunks:
                             if res and res[-1][-2:] != "\r\n":
                                 res[-1] = res[-1] + ur   # need to rejoin strings that have been split on the b"OK" string by the lexical parser
@@ -350,10 +817,209 @@ class DeviceConnector:
         return res if bfetchfilecapture_nchunks else True
 
 
-    def sendtofile(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents):
-        if not (self.workingserial or self.workingwebsocket):
-            self.sres("File transfers not implemented for sockets\n", 31)
-            return
+    # returns {"decompress": "deflate" or "zlib" or None, "compress": bool}, asking the device only once
+    def finddevicecodecs(self):
+        if self.devicecodecs is None:
+            sswrite = self.sswrite
+            if self.useagent():
+                sswrite(b"_alpacaa.codecs()\r\n")
+            else:
+                sswrite(b"try:\r\n import deflate;O='deflate',hasattr(deflate.DeflateIO,'write')\r\n")
+                sswrite(b"except ImportError:\r\n try:\r\n  import zlib;O='zlib',hasattr(zlib,'DecompIO')\r\n")
+                sswrite(b" except ImportError:\r\n  O='none',False\r\n")
+                sswrite(devicehelpers.sendframe("codecs", "O[0]", "O[1]").encode() + b"\r\ndel O\r\n")
+            sswrite(b'\r\x04')
+            self.receivestream(bseekokay=True)
+            module, flag = (self.sidevalues("codecs") or [ ("none", False) ])[0]
+            self.devicecodecs = { "decompress":(module if (module == "deflate" or flag) else None),
+                                  "compress":(module == "deflate" and flag) }
+        return self.devicecodecs
+
+    # compressed copy goes to a temporary file, then is decompressed into place by the device in 256 byte pieces
+    def sendcompressed(self, destinationfilename, bmkdir, bquiet, data, compresseddata):
+        tmpfilename = destinationfilename + ".z~"
+        self.sendtofile(tmpfilename, bmkdir, False, True, True, compresseddata, bcompress=False)
+        decompress = self.finddevicecodecs()["decompress"]
+        sswrite = self.sswrite
+        if self.useagent():
+            sswrite("_alpacaa.decompress({},{},{})\r\n".format(repr(tmpfilename), repr(destinationfilename), compresswbits).encode())
+        else:
+            sswrite("import os,{}\r\n".format(decompress).encode())
+            sswrite("O=open({},'rb');O2=open({},'wb')\r\n".format(repr(tmpfilename), repr(destinationfilename)).encode())
+            if decompress == "deflate":
+                sswrite(b"O3=deflate.DeflateIO(O,deflate.ZLIB,%d)\r\n" % compresswbits)
+            else:
+                sswrite(b"O3=zlib.DecompIO(O,%d)\r\n" % compresswbits)
+            sswrite(b"O4=bytearray(256);O5=memoryview(O4)\r\n")
+            sswrite(b"while 1:\r\n n=O3.readinto(O4)\r\n if not n: break\r\n O2.write(O5[:n])\r\n")
+            sswrite("O2.close();O.close();os.remove({})\r\n".format(repr(tmpfilename)).encode())
+            sswrite(b"del O,O2,O3,O4,O5\r\n")
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        self.sres("Sent {} bytes as {} compressed ({:.0%}) to {}.\n".format(len(data), len(compresseddata), 
+                  len(compresseddata)/max(1, len(data)), destinationfilename), clear_output=not bquiet)
+
+    # returns (size or -1 if missing, [(offset, crc32 of the file up to there)]) for the first nbytes of a device file
+    def devicefilecrcs(self, filename, nbytes):
+        self.ensurehelper("crcxfer")
+        self.writebytes("{}({},{},{})\r\n".format("_alpacaa.hash" if self.useagent() else "_alpacacrcs", repr(filename), nbytes, 
+                                                   transfercheckpoint).encode() + b'\r\x04')
+        self.receivestream(bseekokay=True)
+        stats = self.sidevalues("stat")
+        return (stats[0][0]  if stats  else -1), self.sidevalues("crc")
+
+    # the longest prefix of data that matches a checkpoint of the device file
+    def verifiedoffset(self, data, checkpoints):
+        voffset, crc, prevoffset = 0, 0, 0
+        for offset, devicecrc in checkpoints:
+            if offset > len(data):
+                break
+            crc = zlib.crc32(data[prevoffset:offset], crc)
+            prevoffset = offset
+            if crc != devicecrc:
+                break
+            voffset = offset
+        return voffset
+
+    # exactly n bytes from the binary frames of the WebREPL file transfer protocol
+    def webreplrecv(self, n):
+        t0 = time.time()
+        while len(self.webreplbuffer) < n:
+            try:
+                opcode, data = self.workingwebsocket.recv_data()
+            except websocket.WebSocketTimeoutException:
+                if time.time() - t0 > webrepltimeout:
+                    raise OSError("WebREPL file transfer timed out")
+                continue
+            if opcode == websocket.ABNF.OPCODE_BINARY:
+                self.webreplbuffer += data
+                if self.wiretrace:
+                    self.wiretrace.record(wiretrace.traceread, data)
+        res, self.webreplbuffer = self.webreplbuffer[:n], self.webreplbuffer[n:]
+        return res
+
+    def webreplsend(self, data):
+        self.flushwrites()
+        self.workingwebsocket.send(data, opcode=websocket.ABNF.OPCODE_BINARY)
+        if self.wiretrace:
+            self.wiretrace.record(wiretrace.tracewrite, data)
+
+    # sends the request header and returns the status the device answers with (0 for ok)
+    def webreplrequest(self, op, filename, size):
+        bfilename = filename.encode()
+        self.webreplbuffer = b""
+        rec = struct.pack(webreplfile, b"WA", op, 0, 0, size, len(bfilename), bfilename)
+        self.webreplsend(rec[:10])
+        self.webreplsend(rec[10:])
+        return self.webreplstatus()
+
+    def webreplstatus(self):
+        sig, code = struct.unpack("<2sH", self.webreplrecv(4))
+        return code if sig == b"WB" else -1
+
+    # returns False if the file has to go through the REPL instead
+    def webreplput(self, destinationfilename, data, bquiet):
+        if len(destinationfilename.encode()) > 64:
+            return False
+        code = self.webreplrequest(webreplputfile, destinationfilename, len(data))
+        if code != 0:
+            self.sres("WebREPL refused to write {} (status {})\n".format(destinationfilename, code), 31)
+            return False
+        for i in range(0, len(data), webreplchunksize):
+            self.webreplsend(data[i:i+webreplchunksize])
+            if not bquiet and (i//webreplchunksize)%16 == 15:
+                self.sres("{}%, {} of {} bytes".format(int(i/len(data)*100), i, len(data)), clear_output=True)
+        code = self.webreplstatus()
+        if code != 0:
+            self.sres("WebREPL failed writing {} (status {})\n".format(destinationfilename, code), 31)
+            return True   # the data has gone, so it would be in the wrong state for the REPL
+        self.sres("Sent {} bytes to {} over WebREPL.\n".format(len(data), destinationfilename), clear_output=not bquiet)
+        return True
+
+    def webreplget(self, sourcefilename, bquiet):
+        if len(sourcefilename.encode()) > 64:
+            return None
+        code = self.webreplrequest(webreplgetfile, sourcefilename, 0)
+        if code != 0:
+            self.sres("Cannot open {} (WebREPL status {})\n".format(sourcefilename, code), 31)
+            return None
+        res = bytearray()
+        while True:
+            self.webreplsend(b"\0")
+            (n,) = struct.unpack("<H", self.webreplrecv(2))
+            if n == 0:
+                break
+            res.extend(self.webreplrecv(n))
+            if not bquiet and len(res)//webreplchunksize != (len(res) - n)//webreplchunksize:
+                self.sres("{} bytes".format(len(res)), clear_output=True)
+        code = self.webreplstatus()
+        if code != 0:
+            self.sres("WebREPL failed reading {} (status {})\n".format(sourcefilename, code), 31)
+            return None
+        if not bquiet:
+            self.sres("Fetched {} bytes from {} over WebREPL.\n".format(len(res), sourcefilename), clear_output=True)
+        return bytes(res)
+
+    # sends only what has changed from the device's copy of the file; returns False if that 
+    # wasn't possible or worth it and the whole file needs sending
+    def senddelta(self, destinationfilename, data, bquiet):
+        self.ensurehelper("delta")
+        blocksize = deltablocksize(len(data))
+        self.writebytes("_alpacablocks({},{})\r\n".format(repr(destinationfilename), blocksize).encode() + b'\r\x04')
+        res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+        try:
+            values = "".join(res).split()
+            devicesize = int(values[0])
+            blocksums = [ (int(weak, 16), int(strong, 16))  for weak, strong in zip(values[1::2], values[2::2]) ]
+        except (ValueError, IndexError):
+            return False
+        if devicesize < 0:
+            return False
+        blocksums = blocksums[:devicesize//blocksize]   # a short last block can't be matched
+
+        instructions, nliteral = deltainstructions(data, blocksums, blocksize)
+        if nliteral > len(data)*deltamaxliteral:
+            return False
+        tmpfilename = destinationfilename + ".dl~"
+        if not self.sendcheckedchunks(tmpfilename, False, True, False, instructions, True,
+                                      openexpression="_alpacadelta({},{})".format(repr(destinationfilename), blocksize)):
+            self.removefile(tmpfilename)
+            return False
+        self.writebytes("_alpacadeltaend({},{})\r\n".format(repr(destinationfilename), zlib.crc32(data)).encode() + b'\r\x04')
+        self.receivestream(bseekokay=True)
+        if self.sidevalues("deltaend") != [ (1,) ]:
+            self.sres("Rebuilt {} didn't match, sending it whole\n".format(destinationfilename), 31)
+            return False
+        self.sres("Updated {} ({} bytes) sending {} bytes of changes in {} bytes.\n".format(destinationfilename, len(data), 
+                  nliteral, len(instructions)), clear_output=not bquiet)
+        return True
+
+    def sendtofile(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents, bcompress=True, bresume=False, bdelta=False):
+        if bdelta and not bappend and not bresume:
+            if self.senddelta(destinationfilename, filecontents.encode() if type(filecontents) == str else filecontents, bquiet):
+                return
+
+        if bresume:
+            bbinary, bcompress = True, False
+            if bappend:
+                self.sres("--append ignored with --resume\n", 31)
+                bappend = False
+
+        if bcompress and not bappend and len(filecontents) >= compressminbytes and self.finddevicecodecs()["decompress"]:
+            data = filecontents.encode() if type(filecontents) == str else filecontents
+            compresseddata = compressdata(data)
+            if len(compresseddata) < len(data)*compressmaxratio:
+                self.sendcompressed(destinationfilename, bmkdir, bquiet, data, compresseddata)
+                return
+
+        # WebREPL's own file transfer skips the interpreter, but can't append
+        if self.workingwebsocket and not bappend and not bresume:
+            if bmkdir and self.mkdirlines(destinationfilename):
+                self.writebytes(self.mkdirlines(destinationfilename) + b'\r\x04')
+                self.receivestream(bseekokay=True)
+            if self.webreplput(destinationfilename, filecontents.encode() if type(filecontents) == str else filecontents, bquiet):
+                return
+            bmkdir = False
 
         if not bbinary:
             lines = filecontents.splitlines(True)
@@ -362,118 +1028,294 @@ class DeviceConnector:
                 self.sres("Line length {} exceeds maximum for line ascii files, try --binary\n".format(maxlinelength), 31)
                 return
 
-        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        sswrite = self.sswrite
         #def sswrite(x):  self.sres(str(x)); lsswrite(x)
+        if bbinary:
+            self.ensurehelper("crcxfer")   # before anything is written for the same execution
 
         if bmkdir:
-            dseq = [ d  for d in destinationfilename.split("/")[:-1]  if d]
-            if dseq:
-                sswrite(b'import os\r\n')
-                for i in range(len(dseq)):
-                    sswrite('try:  os.mkdir({})\r\n'.format(repr("/".join(dseq[:i+1]))).encode())
-                    sswrite(b'except OSError:  pass\r\n')
-
-        fmodifier = ("a" if bappend else "w")+("b" if bbinary else "")
-        if bbinary:
-            sswrite(b"import ubinascii; O6 = ubinascii.a2b_base64\r\n")
-        sswrite("O=open({}, '{}')\r\n".format(repr(destinationfilename), fmodifier).encode())
-        sswrite(b'\r\x04')  # intermediate execution
-        self.receivestream(bseekokay=True)
+            sswrite(self.mkdirlines(destinationfilename))
+
         clear_output = True  # set this to False to help with debugging
         if bbinary:
             if type(filecontents) == str:
                 filecontents = filecontents.encode()
-                
-            chunksize = 30
-            nchunks = int(len(filecontents)/chunksize)
-
-            for i in range(nchunks+1):
-                bchunk = filecontents[i*chunksize:(i+1)*chunksize]
-                sswrite(b'O.write(O6("')
-                sswrite(binascii.b2a_base64(bchunk)[:-1])
-                sswrite(b'"))\r\n')
-                if (i%10) == 9:
-                    sswrite(b'\r\x04')  # intermediate executions
-                    self.receivestream(bseekokay=True)
-                    if not bquiet:
-                        self.sres("{}%, chunk {}".format(int((i+1)/(nchunks+1)*100), i+1), clear_output=clear_output)
-            self.sres("Sent {} bytes in {} chunks to {}.\n".format(len(filecontents), i+1, destinationfilename), clear_output=not bquiet)
-            
-        else:
-            i = -1
-            linechunksize = 5
+            self.sendcheckedchunks(destinationfilename, bappend, bquiet, bresume, filecontents, clear_output)
+            return
 
-            if bappend:
-                sswrite("O.write('\\n')\r\n".encode())   # avoid line concattenation on appends
-            for i, line in enumerate(lines):
-                sswrite("O.write({})\r\n".format(repr(line)).encode())
-                if (i%linechunksize) == linechunksize-1:
-                    sswrite(b'\r\x04')  # intermediate executions
-                    self.receivestream(bseekokay=True)
-                    if not bquiet:
-                        self.sres("{}%, line {}\n".format(int((i+1)/(len(lines)+1)*100), i+1), clear_output=clear_output)
-            self.sres("Sent {} lines ({} bytes) to {}.\n".format(i+1, len(filecontents), destinationfilename), clear_output=(clear_output and not bquiet))
+        fmodifier = ("a" if bappend else "w")
+        sswrite("O=open({}, '{}')\r\n".format(repr(destinationfilename), fmodifier).encode())
+        sswrite(b'\r\x04')  # intermediate execution
+        self.receivestream(bseekokay=True)
+        i = -1
+        linechunksize = 5
+
+        if bappend:
+            sswrite("O.write('\\n')\r\n".encode())   # avoid line concattenation on appends
+        for i, line in enumerate(lines):
+            sswrite("O.write({})\r\n".format(repr(line)).encode())
+            if (i%linechunksize) == linechunksize-1:
+                sswrite(b'\r\x04')  # intermediate executions
+                self.receivestream(bseekokay=True)
+                if not bquiet:
+                    self.sres("{}%, line {}\n".format(int((i+1)/(len(lines)+1)*100), i+1), clear_output=clear_output)
+        self.sres("Sent {} lines ({} bytes) to {}.\n".format(i+1, len(filecontents), destinationfilename), clear_output=(clear_output and not bquiet))
 
         sswrite("O.close()\r\n".encode())
         sswrite("del O\r\n".encode())
         sswrite(b'\r\x04')
         self.receivestream(bseekokay=True)
 
-    def fetchfile(self, sourcefilename, bbinary, bquiet):
-        if not (self.workingserial or self.workingwebsocket):
-            self.sres("File transfers not implemented for sockets\n", 31)
+    # binary data goes in groups of crc-checked lines; the device only writes a chunk that lands at the 
+    # end of the file with a good crc, and reports where the file got to, so the rest are sent again from there;
+    # openexpression can give something else with write() and tell() to send to instead of the file
+    def sendcheckedchunks(self, destinationfilename, bappend, bquiet, bresume, data, clear_output, openexpression=None):
+        sswrite = self.sswrite
+        self.ensurehelper("crcxfer")
+
+        start = 0
+        if bresume:
+            devicesize, checkpoints = self.devicefilecrcs(destinationfilename, len(data))
+            if 0 <= devicesize <= len(data):
+                start = self.verifiedoffset(data, checkpoints)
+            if start and not bquiet:
+                self.sres("Resuming {} at {} of {} bytes\n".format(destinationfilename, start, len(data)))
+
+        fmodifier = "r+b" if start else ("ab" if bappend else "wb")
+        if openexpression is None:
+            if self.useagent():
+                openexpression = "_alpacaa.put({},'{}',{})".format(repr(destinationfilename), fmodifier, start)
+            else:
+                openexpression = "open({},'{}');O.seek({})".format(repr(destinationfilename), fmodifier, start)
+        sswrite("O={};O10=_alpacawr\r\n".format(openexpression).encode())
+        sswrite(b"print(O.tell())\r\n")
+        sswrite(b'\r\x04')  # intermediate execution
+        res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+        try:
+            base = int("".join(res)) - start   # file offset of data[0], which is the end of the file when appending
+        except ValueError:
+            self.sres("".join(res), 31)
+            return False
+
+        pos, nbadchunks, failpos, nfails = start, 0, -1, 0
+        nflush = 0
+        while pos < len(data):
+            groupend = min(len(data), pos + transferchunksize*transfergroupsize)
+            for off in range(pos, groupend, transferchunksize):
+                bchunk = data[off:off+transferchunksize]
+                sswrite(b'O10(O,%d,"%s",%d)\r\n' % (base+off, binascii.b2a_base64(bchunk)[:-1], zlib.crc32(bchunk)))
+            nflush += groupend - pos
+            if bresume and nflush >= transfercheckpoint:
+                sswrite(b"O.flush()\r\n")   # so an interruption leaves something to resume from
+                nflush = 0
+            sswrite(b"print(O.tell())\r\n")
+            sswrite(b'\r\x04')  # intermediate executions
+            res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+            tells = [ int(line)  for line in "".join(res).split()  if line.isdigit() ]
+            newpos = (tells[-1] - base) if tells else pos
+            if newpos < groupend:
+                nbadchunks += 1
+                nfails = (nfails + 1) if newpos == failpos else 1
+                failpos = newpos
+                if nfails > transfermaxretries:
+                    self.sres("Chunk at offset {} failed {} times, giving up on {}\n".format(newpos, nfails, destinationfilename), 31)
+                    break
+            pos = newpos
+            if not bquiet:
+                self.sres("{}%, {} of {} bytes".format(int(pos/max(1, len(data))*100), pos, len(data)), clear_output=clear_output)
+
+        sswrite(b"O.close()\r\n")
+        sswrite(b"del O,O10\r\n")
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        if pos >= len(data):
+            self.sres("Sent {} bytes to {}{}{}.\n".format(len(data), destinationfilename, 
+                      (", resumed at {}".format(start) if start else ""),
+                      (", {} chunk(s) resent".format(nbadchunks) if nbadchunks else "")), clear_output=not bquiet)
+        return pos >= len(data)
+
+    # a whole directory as one stream of records (2 byte path length, path, 4 byte data length, data) that 
+    # the device unpacks as it arrives; [(relpath, contents)] go under destinationdir
+    def sendbundle(self, destinationdir, files, bquiet, bcompress=True):
+        archive = [ ]
+        for relpath, contents in files:
+            bpath = relpath.replace("\\", "/").encode()
+            bcontents = contents.encode() if type(contents) == str else contents
+            archive.append(struct.pack(">H", len(bpath)) + bpath + struct.pack(">I", len(bcontents)) + bcontents)
+        archive = b"".join(archive)
+        self.ensurehelper("crcxfer")
+        self.ensurehelper("unbundle")
+        destinationdir = destinationdir.rstrip("/")
+        clear_output = True
+
+        # the device can only inflate from a file, so a compressed bundle goes through a temporary one
+        compressed = None
+        if bcompress and len(archive) >= compressminbytes and self.finddevicecodecs()["decompress"]:
+            compressed = compressdata(archive)
+            if len(compressed) >= len(archive)*compressmaxratio:
+                compressed = None
+        if compressed:
+            tmpfilename = (destinationdir or ".") + ".alpz~"
+            bsent = self.sendcheckedchunks(tmpfilename, False, bquiet, False, compressed, clear_output)
+            if bsent:
+                self.writebytes("_alpacaunbundlefile({},{},{},{})\r\n".format(repr(tmpfilename), repr(destinationdir), 
+                                repr(self.finddevicecodecs()["decompress"]), compresswbits).encode() + b'\r\x04')
+                self.receivestream(bseekokay=True)
+            else:
+                self.removefile(tmpfilename)
+        else:
+            bsent = self.sendcheckedchunks(destinationdir, False, bquiet, False, archive, clear_output, 
+                                           openexpression="_alpacaunbundle({})".format(repr(destinationdir)))
+        if bsent:
+            self.sres("Sent {} files ({} bytes{}) to {}.\n".format(len(files), len(archive), 
+                      (", {} compressed".format(len(compressed)) if compressed else ""), destinationdir or "/"), clear_output=not bquiet)
+
+    # device compresses to a temporary file and reports both sizes; returns the temporary 
+    # file name if that's worth fetching instead, otherwise None
+    def compressondevice(self, sourcefilename):
+        tmpfilename = sourcefilename + ".z~"
+        sswrite = self.sswrite
+        if self.useagent():
+            sswrite("_alpacaa.compress({},{},{},{})\r\n".format(repr(sourcefilename), repr(tmpfilename), compresswbits, 
+                                                               compressminbytes).encode())
+        else:
+            sswrite(b"import os,deflate\r\n")
+            sswrite("O4=os.stat({})[6]\r\n".format(repr(sourcefilename)).encode())
+            sswrite(b"if O4>=%d:\r\n" % compressminbytes)
+            sswrite("  O=open({},'rb');O2=open({},'wb');O3=deflate.DeflateIO(O2,deflate.ZLIB,{})\r\n".format(
+                    repr(sourcefilename), repr(tmpfilename), compresswbits).encode())
+            sswrite(b"  O5=bytearray(256);O6=memoryview(O5)\r\n")
+            sswrite(b"  while 1:\r\n    n=O.readinto(O5)\r\n    if not n: break\r\n    O3.write(O6[:n])\r\n")
+            sswrite(b"  O3.close();O2.close();O.close();O7=os.stat(%s)[6];del O,O2,O3,O5,O6\r\n" % repr(tmpfilename).encode())
+            sswrite(b"else:\r\n  O7=O4\r\n")
+            sswrite(devicehelpers.sendframe("sizes", "O4", "O7").encode() + b"\r\ndel O4,O7\r\n")
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        sizes = self.sidevalues("sizes")
+        if not sizes:
             return None
-        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
-        
+        nbytes, ncompressed = sizes[0]
+        if ncompressed < nbytes*compressmaxratio:
+            return tmpfilename
+        if nbytes >= compressminbytes:
+            self.removefile(tmpfilename)
+        return None
+
+    # device code making the directories a file goes in
+    def mkdirlines(self, filename):
+        if self.useagent() and "/" in filename.strip("/"):
+            return "_alpacaa.mkdirs({})\r\n".format(repr(filename)).encode()
+        return mkdirlines(filename)
+
+    def removefile(self, filename):
+        sswrite = self.sswrite
+        if self.useagent():
+            sswrite("_alpacaa.rm({})\r\n".format(repr(filename)).encode())
+        else:
+            sswrite("import os\r\ntry: os.remove({})\r\nexcept OSError: pass\r\n".format(repr(filename)).encode())
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+
+    def fetchfile(self, sourcefilename, bbinary, bquiet, bcompress=True, resumedata=None):
+        if bcompress and resumedata is None and self.finddevicecodecs()["compress"]:
+            tmpfilename = self.compressondevice(sourcefilename)
+            if tmpfilename:
+                compresseddata = self.fetchfile(tmpfilename, True, True, bcompress=False)
+                self.removefile(tmpfilename)
+                if compresseddata is not None:
+                    try:
+                        res = zlib.decompress(compresseddata)
+                    except zlib.error as e:
+                        self.sres("Decompression failed ({}), fetching uncompressed\n".format(str(e)), 31)
+                    else:
+                        if not bquiet:
+                            self.sres("Fetched {} bytes as {} compressed from {}.\n".format(len(res), len(compresseddata), 
+                                      sourcefilename), clear_output=True)
+                        return res
+
         if not bbinary:
             self.sres("non-binary mode not implemented, switching to binary")
-        if True:
-            chunksize = 30
-            sswrite(b"import sys,os;O7=sys.stdout.write\r\n")
-            sswrite(b"import ubinascii;O8=ubinascii.b2a_base64\r\n")
-            sswrite("O=open({},'rb')\r\n".format(repr(sourcefilename)).encode())
-            sswrite(b"O9=bytearray(%d)\r\n" % chunksize)
-            sswrite("O4=os.stat({})[6]\r\n".format(repr(sourcefilename)).encode())
-            sswrite(b"print(O4)\r\n")
-            sswrite(b'\r\x04')   # intermediate execution to get chunk size
-            chunkres = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
-            try:
-                nbytes = int("".join(chunkres))
-            except ValueError:
-                self.sres(str(chunkres))
-                return None
-                
-            sswrite(b"O7(O8(O.read(O4%%%d)))\r\n" % chunksize)  # get sub-block
-            sswrite(b"while O.readinto(O9): O7(O8(O9))\r\n")
-            sswrite(b"O.close(); del O,O7,O8,O9,O4\r\n")
+        if self.workingwebsocket and resumedata is None and len(sourcefilename.encode()) <= 64:
+            return self.webreplget(sourcefilename, bquiet)
+        return self.fetchcheckedchunks(sourcefilename, bquiet, resumedata)
+
+    # the device sends each chunk as a crc32 and a line of base64; anything after a bad chunk is dropped and 
+    # requested again from that offset, and what's been verified so far is kept in self.fetchedpartial
+    def fetchcheckedchunks(self, sourcefilename, bquiet, resumedata):
+        sswrite = self.sswrite
+        self.fetchedpartial = b""
+        nbytes, checkpoints = self.devicefilecrcs(sourcefilename, len(resumedata or b""))
+        if nbytes < 0:
+            self.sres("Cannot open {}\n".format(sourcefilename), 31)
+            return None
+
+        start = 0
+        if resumedata and len(resumedata) <= nbytes:
+            start = self.verifiedoffset(resumedata, checkpoints)
+            if start and not bquiet:
+                self.sres("Resuming {} at {} of {} bytes\n".format(sourcefilename, start, nbytes))
+        res = bytearray(resumedata[:start] if start else b"")
+
+        openexpression = ("_alpacaa.get({})"  if self.useagent()  else "open({},'rb')").format(repr(sourcefilename))
+        sswrite("O={};O11=_alpacard\r\n".format(openexpression).encode())
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+
+        pos, nbadchunks, failpos, nfails = start, 0, -1, 0
+        while pos < nbytes:
+            n = min(transfersegmentsize, nbytes - pos)
+            sswrite(b"O11(O,%d,%d,%d)\r\n" % (pos, n, transferchunksize))
             sswrite(b'\r\x04')
-            chunks = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=nbytes//chunksize+1)
-            rres = [ ]
-            for ch in chunks:
+            lines = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+            segmentend = pos + n
+            for line in lines:
                 try:
-                    rres.append(binascii.a2b_base64(ch))
-                except binascii.Error as e:
-                    self.sres(str(e))
-                    self.sres(str([ch]))
-            res = b"".join(rres)
+                    crc, b64 = line.split()
+                    bchunk = binascii.a2b_base64(b64)
+                    bgood = (zlib.crc32(bchunk) == int(crc, 16))
+                except ValueError:   # includes binascii.Error
+                    bgood = False
+                if not bgood:
+                    break
+                res.extend(bchunk)
+                pos += len(bchunk)
+            self.fetchedpartial = bytes(res)
+            if pos < segmentend:
+                nbadchunks += 1
+                nfails = (nfails + 1) if pos == failpos else 1
+                failpos = pos
+                if nfails > transfermaxretries:
+                    self.sres("Chunk at offset {} failed {} times, giving up on {}\n".format(pos, nfails, sourcefilename), 31)
+                    break
             if not bquiet:
-                self.sres("Fetched {}={} bytes from {}.\n".format(len(res), nbytes, sourcefilename), clear_output=True)
-            return res
-        return None
+                self.sres("{}%, {} of {} bytes".format(int(pos/max(1, nbytes)*100), pos, nbytes), clear_output=True)
+
+        sswrite(b"O.close(); del O,O11\r\n")
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        if pos < nbytes:
+            return None
+        if not bquiet:
+            self.sres("Fetched {} bytes from {}{}{}.\n".format(len(res), sourcefilename, 
+                      (", resumed at {}".format(start) if start else ""),
+                      (", {} chunk(s) refetched".format(nbadchunks) if nbadchunks else "")), clear_output=True)
+        return bytes(res)
 
     def listdir(self, dirname, recurse):
         self.sres("Listing directory '%s'.\n" % (dirname or '/'))
-        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        sswrite = self.sswrite
         
         def ssldir(d):
-            sswrite(b"import os,sys\r\n")
-            sswrite(("for O in os.ilistdir(%s):\r\n" % repr(d)).encode())
-            sswrite(b"  sys.stdout.write(repr(O))\r\n")
-            sswrite(b"  sys.stdout.write('\\n')\r\n")
-            sswrite(b"del O\r\n")
+            if self.useagent():
+                sswrite(("_alpacaa.ls(%s)\r\n" % repr(d)).encode())
+            else:
+                sswrite(b"import os\r\n")
+                sswrite(("for O in os.ilistdir(%s):\r\n" % repr(d)).encode())
+                sswrite(b"  " + devicehelpers.sendframe("ls", "O").encode() + b"\r\n")
+                sswrite(b"del O\r\n")
             sswrite(b'\r\x04')
-            k = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
-            ll = list(map(ast.literal_eval, k))
+            self.receivestream(bseekokay=True)
+            ll = [ l  for (l,) in self.sidevalues("ls") ]
             ll.sort()
             for l in ll:
                 if l[1] == 0x4000:
@@ -492,10 +1334,90 @@ class DeviceConnector:
         return None
         
         
+    def mount(self, localdir):
+        if not self.serialexists():
+            self.sres("No serial connected\n", 31)
+            return
+        if self.workingwebsocket:
+            self.sres("%mount needs a serial or socket connection\n", 31)
+            return
+        if not os.path.isdir(localdir):
+            self.sres("No directory {}\n".format(localdir), 31)
+            return
+        self.ensurehelper("hostmount")
+        self.hostmount = hostmount.HostMount(localdir)
+        mp = repr(hostmount.mountpoint)
+        self.writebytes("import os,sys\r\ntry: os.umount({})\r\nexcept OSError: pass\r\n".format(mp).encode())
+        self.writebytes("os.mount(_alpacarfs(),{})\r\nif {} not in sys.path: sys.path.insert(0,{})\r\n".format(mp, mp, mp).encode())
+        self.writebytes(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        self.sres("Mounted {} at {}\n".format(self.hostmount.localdir, hostmount.mountpoint))
+
+    def unmount(self):
+        if not self.hostmount or not self.serialexists():
+            self.sres("Nothing mounted\n")
+            return
+        mp = repr(hostmount.mountpoint)
+        self.writebytes("import os,sys\r\ntry: os.umount({})\r\nexcept OSError: pass\r\n".format(mp).encode())
+        self.writebytes("if {} in sys.path: sys.path.remove({})\r\n".format(mp, mp).encode())
+        self.writebytes(b'\r\x04')
+        self.receivestream(bseekokay=True)
+        self.sres("Unmounted {} after {} requests ({} bytes)\n".format(self.hostmount.localdir, self.hostmount.nrequests, 
+                                                                      self.hostmount.nbytesserved))
+        self.hostmount = None
+
+    def starttrace(self, filename):
+        self.stoptrace()
+        self.flushwrites()
+        self.wiretrace = wiretrace.TraceRecorder(filename)
+        if self.workingserial:
+            note = "serial {} at baudrate {}".format(self.workingserial.port, self.workingserial.baudrate)
+        else:
+            note = str(self.workingsocket or self.workingwebsocket or "nothing connected")
+        self.wiretrace.record(wiretrace.tracenote, note)
+
+    def stoptrace(self):
+        if self.wiretrace:
+            self.flushwrites()
+            self.wiretrace.close()
+            self.wiretrace = None
+
+    # plays the [(direction, seconds, data)] of a trace through receivestream in place of the device, at speed 
+    # times the recorded rate or as fast as possible; each write ending in \x04 is taken as a program whose 
+    # reply receivestream parses, and the reads after other writes go as read_all() did; returns (bytes, seconds)
+    def replaytrace(self, records, speed=None):
+        replay = wiretrace.ReplaySerial(records, speed, serialtimeout)
+        self.workingserial = replay
+        self.workingserialchunk = None
+        t0 = time.perf_counter()
+        for direction, t, data in records:
+            if direction == wiretrace.tracenote:
+                self.sresSYS("[trace of {}]\n".format(data.decode(errors="replace")))
+            elif direction == wiretrace.tracewrite:
+                replay.nwrites += 1
+                if data[-1:] == b'\x04' and replay.unread():
+                    self.receivestream(bseekokay=True)
+                else:
+                    replay.read_all()
+        self.workingserial = None
+        self.workingserialchunk = None
+        return replay.nbytesread, time.perf_counter() - t0
+
+    # everything the kernel set up on the device goes on a (re)boot
+    def resetdevicestate(self):
+        self.installedhelpers.clear()
+        self.cachedcells.clear()
+        self.devicecodecs = None
+        self.agentversion = None
+        if self.hostmount:
+            self.sres("[{} no longer mounted at {}]\n".format(self.hostmount.localdir, hostmount.mountpoint), 31)
+            self.hostmount = None
+
     def enterpastemode(self, verbose=True):         # I don't think we ever make a connection and it's still in paste mode (this is revoked on connection break, but I am trying to use exitpastemode to make it better)
+        self.resetdevicestate()
         # now sort out connection situation
-        if self.workingserial or self.workingwebsocket:
-            sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        if self.serialexists():
+            sswrite = self.sswrite
             
             time.sleep(0.2)   # try to give a moment to connect before issuing the Ctrl-C
             sswrite(b'\x03')    # ctrl-C: kill off running programs
@@ -520,22 +1442,50 @@ class DeviceConnector:
             if verbose and l:
                 self.sres('\n[\\r\\x01] ')
                 self.sres(str(l))
-            sswrite(b'1\x04')         # single character program to run so receivestream works
-        else:
-            self.workingsocket.write(b'1\x04')         # single character program "1" to run so receivestream works
+            sswrite(devicehelpers.agentprobe.encode() + b'\x04')   # program to run so receivestream works, which also finds the agent
             
-        return self.receivestream(bseekokay=True, bwarnokaypriors=False, b5secondtimeout=True)
+        res = self.receivestream(bseekokay=True, bwarnokaypriors=False, b5secondtimeout=True)
+        if res and self.agentversion is None:
+            self.foundagent()
+        return res
+
+    # the agent is used if the probe that enterpastemode sent found the right version of it
+    def foundagent(self):
+        versions = self.sidevalues("agent")
+        self.agentversion = versions[0][0]  if versions  else 0
+        if self.useagent():
+            self.installedhelpers.update(devicehelpers.agenthelpers)
+        elif self.agentversion:
+            self.sres("[{} on the device is {}, so it's not being used; %agent install replaces it]\n".format(devicehelpers.agentfile,
+                      "version {} not {}".format(self.agentversion, devicehelpers.agentversion)  if self.agentversion > 0  else "broken"), 31)
+
+    def useagent(self):
+        return self.agentversion == devicehelpers.agentversion
+
+    # after installing or removing the agent, imports whatever is there now
+    def probeagent(self):
+        self.writebytes(b"import sys\r\nsys.modules.pop('alpaca_agent',None)\r\n" + devicehelpers.agentprobe.encode() + b'\r\x04')
+        self.receivestream(bseekokay=True)
+        self.foundagent()
+
+    def installagent(self):
+        self.sendtofile(devicehelpers.agentfile, False, False, True, True, devicehelpers.agent.encode())
+        self.probeagent()
+
+    def removeagent(self):
+        self.removefile(devicehelpers.agentfile)
+        self.probeagent()
         
 
         
     def exitpastemode(self, verbose):   # try to make it clean
-        if self.workingserial or self.workingwebsocket:
-            sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        if self.serialexists():
+            sswrite = self.sswrite
             try:
                 sswrite(b'\r\x03\x02')    # ctrl-C; ctrl-B to exit paste mode
                 time.sleep(0.1)
                 l = self.workingserialreadall()
-            except serial.SerialException as e:
+            except (serial.SerialException, OSError) as e:
                 self.sres("serial exception on close {}\n".format(str(e)))
                 return
             
@@ -545,37 +1495,208 @@ class DeviceConnector:
                 self.sres(str(l))
         
 
+    # buffers writes to go out as one serial write, socket send or websocket frame when a control code 
+    # completes a message, or before anything is read back; returns the number of bytes
+    def sswrite(self, bytestosend):
+        self.writebuffer.extend(bytestosend)
+        if len(self.writebuffer) >= writebuffermax or protocolboundary.search(bytestosend):
+            self.flushwrites()
+        return len(bytestosend)
+
+    def flushwrites(self):
+        if not self.writebuffer:
+            return
+        bytestosend = bytes(self.writebuffer)
+        self.writebuffer.clear()
+        t0 = time.perf_counter()
+        if self.workingserial:
+            self.workingserial.write(bytestosend)
+        elif self.workingwebsocket:
+            self.workingwebsocket.send(bytestosend)
+        elif self.workingsocket:
+            self.workingsocket.sendall(bytestosend)
+        t1 = time.perf_counter()
+        if self.wiretrace:
+            self.wiretrace.record(wiretrace.tracewrite, bytestosend)
+        self.stats["nwrites"] += 1
+        self.stats["byteswritten"] += len(bytestosend)
+        self.stats["writetime"] += t1 - t0
+        if self.stats["tfirstwrite"] is None:
+            self.stats["tfirstwrite"] = t0
+        if self.stats["tfirst04"] is None and b'\x04' in bytestosend:
+            self.stats["tfirst04"] = t1
+
+    # writes straight away
     def writebytes(self, bytestosend):
+        nbyteswritten = self.sswrite(bytestosend)
+        self.flushwrites()
         if self.workingserial:
-            nbyteswritten = self.workingserial.write(bytestosend)
             return ("serial.write {} bytes to {} at baudrate {}\n".format(nbyteswritten, self.workingserial.port, self.workingserial.baudrate))
         elif self.workingwebsocket:
-            nbyteswritten = self.workingwebsocket.send(bytestosend)
             return ("serial.write {} bytes to {}\n".format(nbyteswritten, "websocket"))  # don't worry; it always includes more bytes than you think
         else:
-            nbyteswritten = self.workingsocket.write(bytestosend)
             return ("serial.write {} bytes to {}\n".format(nbyteswritten, str(self.workingsocket)))
 
+    # defines one of the devicehelpers on the device if it hasn't been since the last reboot
+    def ensurehelper(self, name):
+        for dependency in devicehelpers.helperdependencies.get(name, []):
+            self.ensurehelper(dependency)
+        if name not in self.installedhelpers:
+            self.writebytes(devicehelpers.helpers[name].encode() + b'\r\x04')
+            if self.receivestream(bseekokay=True):
+                self.installedhelpers.add(name)
+
+    # the binary body for a _alpacarx() call already sent with \r\x04, keeping only a couple of 
+    # chunks in flight between acks; returns the number of \x04s seen (ie 0 unless the device gave an error)
+    def sendrawbinary(self, data, chunksize=128, window=2):
+        if self.workingserialchunk is None:
+            self.workingserialchunk = self.yieldtracedchunk()
+        nchunks = (len(data) + chunksize - 1)//chunksize
+        nsent, nacked, ntimeouts = 0, 0, 0
+        bokay = False
+        while nacked < nchunks:
+            while bokay and nsent < nchunks and nsent - nacked < window:
+                self.writebytes(data[nsent*chunksize:(nsent+1)*chunksize])
+                nsent += 1
+            self.flushwrites()
+            rline = next(self.workingserialchunk)
+            self.stats["bytesread"] += len(rline)
+            if rline == b'OK':
+                bokay = True
+            elif rline == b'\x06\r\n':
+                nacked += 1
+                ntimeouts = 0
+            elif rline == b'\x04':
+                return 1
+            elif rline == b'':
+                ntimeouts += 1
+                if ntimeouts == 2:
+                    return 0
+                # bytes have gone missing, so pad out the read to get the device out of it (the load will then fail)
+                self.sres("[binary transfer stalled at {}/{}]".format(nacked*chunksize, len(data)), 31)
+                self.writebytes(bytes(chunksize*window))
+            else:
+                self.sres(rline.decode(errors="replace"))
+        return 0
+
+    # runs a cell compiled by mpy-cross, the bytes going in binary if the link can take it
+    # suffix is more device code to run after the cell in the same program
+    def runmpycell(self, mpybytes, isplotting=0, suffix=""):
+        self.ensurehelper("mpyexec")
+        suffix = suffix and ("\n" + suffix).encode()
+        if self.workingserial or self.workingsocket:
+            self.writebytes(b"_alpacampy(%d)%s\r\x04" % (len(mpybytes), suffix))
+            n04count = self.sendrawbinary(mpybytes)
+            self.receivestream(bseekokay=False, isplotting=isplotting, n04count=n04count)
+        else:
+            self.writebytes(b"_alpacampy(0,'" + binascii.b2a_base64(mpybytes)[:-1] + b"')" + suffix + b"\r\x04")
+            self.receivestream(bseekokay=True, isplotting=isplotting)
+
+    # sends the cell once to be compiled and kept on the device, and after that just its hash
+    def runcachedcell(self, cellcontents, cachesize, isplotting=0, suffix=""):
+        self.ensurehelper("cellcache")
+        h = hashlib.sha1(cellcontents.encode()).hexdigest()[:16]
+        if h in self.cachedcells:
+            self.cachedcells.move_to_end(h)
+            self.writebytes(("_alpacarun('%s')" % h + (suffix and "\n" + suffix) + "\r\x04").encode())
+            self.receivestream(bseekokay=True, isplotting=isplotting)
+            if self.receivedstderr:   # could be that the device lost it, so send it in full next time
+                self.cachedcells.pop(h, None)
+            return
+
+        evicted = [ ]
+        while self.cachedcells and len(self.cachedcells) >= cachesize:
+            evicted.append(self.cachedcells.popitem(last=False)[0])
+        program = [ ]
+        if evicted:
+            program.append("_alpacadrop(%s)" % ",".join(map(repr, evicted)))
+        program.append("_alpacastore(%r,%r)" % (h, cellcontents))
+        program.append("_alpacarun(%r)" % h)
+        if suffix:
+            program.append(suffix)
+        self.writebytes("\n".join(program).encode() + b'\r\x04')
+        self.receivestream(bseekokay=True, isplotting=isplotting)
+        if not self.receivedstderr:
+            self.cachedcells[h] = True
+
+    # the values of the frames with this tag from the last receivestream
+    def sidevalues(self, tag):
+        return [ res[1:]  for res in self.sideresults  if type(res) == tuple and res[:1] == (tag,) ]
+
+    # returns (microseconds, mode actually used, [(line or function, hits, microseconds)]) or None if the cell
+    # didn't get as far as finishing; mode is "l" for lines, "f" for functions or "" for the total time only
+    def runprofiledcell(self, cellcontents, mode, isplotting=0):
+        self.ensurehelper("profiler")
+        self.writebytes("_alpacaprofile({},{})\r\x04".format(repr(cellcontents), repr(mode)).encode())
+        self.receivestream(bseekokay=True, isplotting=isplotting)
+        profiles = self.sidevalues("profile")
+        return profiles[0]  if profiles  else None
+
+    # the cell as lines of source, buffered so that it and the \x04 after it go out in one write
+    def runsourcecell(self, cellcontents, isplotting=0, suffix="", bsuppressendcode=False):
+        r = self.workingserialreadall()
+        if r:
+            self.sres('[priorstuff] ')
+            self.sres(str(r))
+
+        for line in cellcontents.splitlines(True):
+            if line:
+                if line[-2:] == '\r\n':
+                    line = line[:-2]
+                elif line[-1] == '\n':
+                    line = line[:-1]
+                self.writeline(line)
+        for line in suffix.splitlines():
+            self.writeline(line)
+
+        if bsuppressendcode:
+            self.flushwrites()
+        else:
+            self.writebytes(b'\r\x04')
+            self.receivestream(bseekokay=True, isplotting=isplotting)
+
+    # returns (free, allocated) heap bytes before and after the cell, or None if the reading didn't come back;
+    # the helper is defined in the same program as the first cell so that it costs no round trip of its own
+    def runheapcell(self, cellcontents, bcollect=False, meminfo=0, isplotting=0, suffix=""):
+        program = [ ]
+        if "heap" not in self.installedhelpers:
+            program.append(devicehelpers.heap)
+        program.append("_alpacaheap({},{},{})".format(repr(cellcontents), int(bcollect), meminfo))
+        if suffix:
+            program.append(suffix)
+        self.writebytes("\n".join(program).encode() + b'\r\x04')
+        self.receivestream(bseekokay=True, isplotting=isplotting)
+        heaps = self.sidevalues("heap")
+        if not heaps:
+            return None
+        self.installedhelpers.add("heap")
+        return heaps[0]
+
+    # device code to follow a cell that evaluates the user_expressions of the execute request in the same
+    # round trip, bringing the helper along the first time
+    def userexpressionsprogram(self, expressions):
+        program = [ ]
+        if "userexpressions" not in self.installedhelpers:
+            program.append(devicehelpers.userexpressions)
+        program.append("_alpacaexprs({})".format(repr(expressions)))
+        return "\n".join(program)
+
+    # {name: (1, repr) or (0, exception name, message)} from that program, empty if the cell didn't get to it
+    def userexpressionresults(self):
+        exprs = self.sidevalues("exprs")
+        if not exprs:
+            return { }
+        self.installedhelpers.add("userexpressions")
+        return exprs[0][0]
+
     def sendrebootmessage(self):
-        if self.workingserial:
-            self.workingserial.write(b"\x03\r")  # quit any running program
-            self.workingserial.write(b"\x02\r")  # exit the paste mode with ctrl-B
-            self.workingserial.write(b"\x04\r")  # soft reboot code
-        elif self.workingwebsocket:
-            self.workingwebsocket.send(b"\x03\r")  # quit any running program
-            self.workingwebsocket.send(b"\x02\r")  # exit the paste mode with ctrl-B
-            self.workingwebsocket.send(b"\x04\r")  # soft reboot code
+        self.resetdevicestate()
+        if self.serialexists():
+            # quit any running program, exit the paste mode with ctrl-B, soft reboot code
+            self.writebytes(b"\x03\r" + b"\x02\r" + b"\x04\r")
 
     def writeline(self, line):
-        if self.workingserial:
-            self.workingserial.write(line.encode("utf8"))
-            self.workingserial.write(b'\r\n')
-        elif self.workingwebsocket:
-            self.workingwebsocket.send(line.encode("utf8"))
-            self.workingwebsocket.send(b'\r\n')
-        else:
-            self.workingsocket.write(line.encode("utf8"))
-            self.workingsocket.write(b'\r\n')
+        self.sswrite(line.encode("utf8") + b'\r\n')
 
     def serialexists(self):
         return self.workingserial or self.workingsocket or self.workingwebsocket
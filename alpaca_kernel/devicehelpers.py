@@ -0,0 +1,606 @@
+"""MicroPython source for the small helpers the kernel defines on the device.
+
+Each helper is sent once per connection by ``DeviceConnector.ensurehelper`` (a soft reboot loses them).
+Names start with _alpaca so they don't collide with the user's globals.
+
+Values come back to the kernel as frames in the output: ``\\x1e``, the repr of a tuple of a tag and the
+values, and a newline.  ``yieldserialchunk`` starts a new chunk at the ``\\x1e``, even after output with no
+newline, and ``DeviceConnector.receivestream`` takes them out of the output and evaluates them
+as Python literals (so bytes need no encoding), leaving them in ``sideresults``.
+"""
+
+# reads n raw bytes from the REPL input with Ctrl-C disabled, acking each chunk with \x06
+# so the kernel doesn't overrun the UART receive buffer
+rxbinary = """
+def _alpacarx(n, k=128):
+    import sys, micropython
+    b = bytearray(n)
+    m = memoryview(b)
+    i = 0
+    try:
+        import select
+        p = select.poll()
+        p.register(sys.stdin, select.POLLIN)
+    except Exception:
+        p = None
+    micropython.kbd_intr(-1)
+    try:
+        while i < n:
+            if p and not p.poll(3000):
+                raise OSError('binary receive timed out at %d/%d' % (i, n))
+            i += sys.stdin.buffer.readinto(m[i:i+min(k, n-i)])
+            print('\\x06')
+    finally:
+        micropython.kbd_intr(3)
+    return b
+"""
+
+# imports a cell compiled by mpy-cross straight out of RAM through a one-file VFS,
+# then copies what it defined into the REPL globals; functions it defines keep the module's
+# globals, so they see the REPL's names as they were when the cell ran, not later rebindings
+mpyexec = """
+class _alpacaramvfs:
+    def __init__(self, b):
+        self.b = b
+    def mount(self, readonly, mkfs):
+        pass
+    def umount(self):
+        pass
+    def chdir(self, p):
+        pass
+    def getcwd(self):
+        return ''
+    def ilistdir(self, p):
+        return iter(())
+    def stat(self, p):
+        if p.endswith('_alpacacell.mpy'):
+            return (32768, 0, 0, 0, 0, 0, len(self.b), 0, 0, 0)
+        raise OSError(2)
+    def open(self, p, mode):
+        import io
+        if p.endswith('_alpacacell.mpy'):
+            return io.BytesIO(self.b)
+        raise OSError(2)
+
+def _alpacampy(n, b64=None):
+    import os, sys
+    if b64 is None:
+        b = _alpacarx(n)
+    else:
+        import ubinascii
+        b = ubinascii.a2b_base64(b64)
+    os.mount(_alpacaramvfs(b), '/_alpacaram')
+    sys.path.insert(0, '/_alpacaram')
+    try:
+        m = __import__('_alpacacell')
+    finally:
+        sys.path.remove('/_alpacaram')
+        os.umount('/_alpacaram')
+        sys.modules.pop('_alpacacell', None)
+    g = globals()
+    for k, v in m.__dict__.items():
+        if k[0] != '_':
+            g[k] = v
+"""
+
+# cells compiled once and kept by hash, so a rerun only needs _alpacarun(hash) sending
+cellcache = """
+_alpacacells = {}
+def _alpacastore(h, src):
+    _alpacacells[h] = compile(src, '<cell>', 'exec')
+def _alpacarun(h):
+    c = _alpacacells.get(h)
+    if c is None:
+        raise KeyError('cell no longer cached on the device, run it again')
+    exec(c, globals())
+def _alpacadrop(*hs):
+    for h in hs:
+        _alpacacells.pop(h, None)
+"""
+
+# file transfers in base64 chunks each checked by crc32, so that a bad chunk is sent again on its own
+# and an interrupted transfer can carry on from the last offset where both ends agree
+crcxfer = """
+try:
+    from ubinascii import crc32 as _alpacacrc
+except ImportError:
+    def _alpacacrc(b, c=0):
+        c ^= 0xffffffff
+        for x in b:
+            c ^= x
+            for i in range(8):
+                c = (c >> 1) ^ (0xedb88320 & -(c & 1))
+        return c ^ 0xffffffff
+def _alpacawr(f, off, b64, crc):
+    import ubinascii
+    if f.tell() != off:
+        return
+    try:
+        b = ubinascii.a2b_base64(b64)
+    except ValueError:
+        return
+    if _alpacacrc(b) == crc:
+        f.write(b)
+def _alpacard(f, off, n, k):
+    import sys, ubinascii
+    f.seek(off)
+    m = memoryview(bytearray(k))
+    while n > 0:
+        r = f.readinto(m[:min(k, n)])
+        if not r:
+            break
+        sys.stdout.write('%08x %s' % (_alpacacrc(m[:r]), ubinascii.b2a_base64(m[:r]).decode()))
+        n -= r
+def _alpacacrcs(fn, n, blk):
+    import os
+    try:
+        s = os.stat(fn)[6]
+    except OSError:
+        print('\\x1e' + repr(('stat', -1)))
+        return
+    print('\\x1e' + repr(('stat', s)))
+    n = min(s, n)
+    c, i = 0, 0
+    m = memoryview(bytearray(256))
+    with open(fn, 'rb') as f:
+        while i < n:
+            r = f.readinto(m[:min(256, n-i)])
+            if not r:
+                break
+            c = _alpacacrc(m[:r], c)
+            i += r
+            if i % blk == 0 or i == n:
+                print('\\x1e' + repr(('crc', i, c)))
+"""
+
+# read-only VFS whose calls are requests to the kernel (see hostmount.py for the protocol)
+hostmount = """
+import io
+def _alpacareq(c, *a):
+    import sys, micropython, ubinascii
+    f = [ ('%x' % x) if type(x) is int else ubinascii.hexlify(x.encode()).decode()  for x in a ]
+    sys.stdout.write('\\x18' + c + ' '.join(f) + '\\n')
+    micropython.kbd_intr(-1)
+    try:
+        n = int(sys.stdin.buffer.read(8), 16)
+        return sys.stdin.buffer.read(n) if n else b''
+    finally:
+        micropython.kbd_intr(3)
+
+class _alpacarfile(io.IOBase):
+    def __init__(self, fid, size, text):
+        self.fid, self.size, self.text = fid, size, text
+        self.pos, self.b, self.bpos = 0, b'', 0
+    def _fill(self, n):
+        if not (self.bpos <= self.pos < self.bpos + len(self.b)):
+            self.b = _alpacareq('r', self.fid, self.pos, max(n, 512))
+            self.bpos = self.pos
+        return memoryview(self.b)[self.pos - self.bpos:]
+    def readinto(self, buf):
+        n = 0
+        while n < len(buf) and self.pos < self.size:
+            m = self._fill(len(buf) - n)
+            if not m:
+                break
+            k = min(len(m), len(buf) - n)
+            buf[n:n+k] = m[:k]
+            n += k
+            self.pos += k
+        return n
+    def read(self, n=-1):
+        b = bytearray(self.size - self.pos if n < 0 else n)
+        b = bytes(memoryview(b)[:self.readinto(b)])
+        return b.decode() if self.text else b
+    def readline(self):
+        l = b''
+        while self.pos < self.size:
+            m = self._fill(1)
+            if not m:
+                break
+            i = bytes(m).find(b'\\n')
+            k = len(m) if i < 0 else i + 1
+            l += m[:k]
+            self.pos += k
+            if i >= 0:
+                break
+        return l.decode() if self.text else l
+    def __iter__(self):
+        return self
+    def __next__(self):
+        l = self.readline()
+        if not l:
+            raise StopIteration
+        return l
+    def write(self, b):
+        raise OSError(30)
+    def ioctl(self, req, arg):
+        return 0
+    def close(self):
+        self.b = b''
+    def __enter__(self):
+        return self
+    def __exit__(self, *a):
+        self.close()
+
+class _alpacarfs:
+    def __init__(self):
+        self.cwd = '/'
+    def _abs(self, p):
+        return p if p.startswith('/') else self.cwd + p
+    def mount(self, readonly, mkfs):
+        pass
+    def umount(self):
+        pass
+    def chdir(self, p):
+        self.cwd = self._abs(p).rstrip('/') + '/'
+    def getcwd(self):
+        return self.cwd.rstrip('/') or '/'
+    def ilistdir(self, p):
+        for l in _alpacareq('l', self._abs(p)).decode().split('\\n'):
+            if l:
+                t, s, name = l.split(' ', 2)
+                yield (name, int(t), 0, int(s))
+    def stat(self, p):
+        r = _alpacareq('s', self._abs(p))
+        if not r:
+            raise OSError(2)
+        t, s, m = [ int(x)  for x in r.split() ]
+        return (t, 0, 0, 0, 0, 0, s, m, m, m)
+    def statvfs(self, p):
+        return (512, 512, 0, 0, 0, 0, 0, 0, 0, 255)
+    def open(self, p, mode):
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            raise OSError(30)
+        r = _alpacareq('o', self._abs(p))
+        if not r:
+            raise OSError(2)
+        fid, s = [ int(x)  for x in r.split() ]
+        return _alpacarfile(fid, s, 'b' not in mode)
+    def mkdir(self, p):
+        raise OSError(30)
+    def remove(self, p):
+        raise OSError(30)
+    def rmdir(self, p):
+        raise OSError(30)
+    def rename(self, a, b):
+        raise OSError(30)
+"""
+
+# unpacks a stream of (2 byte path length, path, 4 byte data length, data) records into files under root as
+# it is written, holding back only an incomplete record header
+unbundle = """
+class _alpacaunbundle:
+    def __init__(self, root):
+        self.root = root + '/' if root else ''
+        self.n, self.b, self.f, self.left, self.dirs = 0, b'', None, 0, set()
+    def tell(self):
+        return self.n
+    def _open(self, p):
+        import os
+        p = self.root + p
+        d = ''
+        for x in p.split('/')[:-1]:
+            d += x
+            if d and d not in self.dirs:
+                try:
+                    os.mkdir(d)
+                except OSError:
+                    pass
+                self.dirs.add(d)
+            d += '/'
+        return open(p, 'wb')
+    def write(self, b):
+        nb = len(b)
+        self.n += nb
+        b = self.b + bytes(b)
+        i = 0
+        while i < len(b):
+            if self.f:
+                k = min(self.left, len(b) - i)
+                self.f.write(b[i:i+k])
+                i += k
+                self.left -= k
+            else:
+                if len(b) - i < 2:
+                    break
+                pl = (b[i] << 8) | b[i+1]
+                if len(b) - i < pl + 6:
+                    break
+                self.f = self._open(b[i+2:i+2+pl].decode())
+                self.left = int.from_bytes(b[i+2+pl:i+6+pl], 'big')
+                i += pl + 6
+            if self.f and not self.left:
+                self.f.close()
+                self.f = None
+        self.b = b[i:]
+        return nb
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+def _alpacaunbundlefile(fn, root, codec, wbits):
+    import os
+    u = _alpacaunbundle(root)
+    with open(fn, 'rb') as f:
+        if codec == 'deflate':
+            import deflate
+            d = deflate.DeflateIO(f, deflate.ZLIB, wbits)
+        else:
+            import zlib
+            d = zlib.DecompIO(f, wbits)
+        m = memoryview(bytearray(256))
+        while True:
+            n = d.readinto(m)
+            if not n:
+                break
+            u.write(m[:n])
+    u.close()
+    os.remove(fn)
+"""
+
+# rsync-like update of a file: the block sums of the old copy, then a stream of 9 byte instructions
+# (C, first block, number of blocks) copying from the old file or (L, 0, length) followed by literal data,
+# rebuilt into a temporary file that only replaces the old one if its crc32 is right
+delta = """
+def _alpacablocks(fn, blk):
+    import os
+    try:
+        s = os.stat(fn)[6]
+    except OSError:
+        print(-1)
+        return
+    print(s)
+    m = memoryview(bytearray(blk))
+    with open(fn, 'rb') as f:
+        while True:
+            n = f.readinto(m)
+            if not n:
+                break
+            print('%x %x' % (sum(m[:n]), _alpacacrc(m[:n])))
+
+class _alpacadelta:
+    def __init__(self, fn, blk):
+        self.blk = blk
+        self.src = open(fn, 'rb')
+        self.f = open(fn + '.dl~', 'wb')
+        self.n, self.b, self.left = 0, b'', 0
+        self.m = memoryview(bytearray(blk))
+    def tell(self):
+        return self.n
+    def write(self, b):
+        nb = len(b)
+        self.n += nb
+        b = self.b + bytes(b)
+        i = 0
+        while i < len(b):
+            if self.left:
+                k = min(self.left, len(b) - i)
+                self.f.write(b[i:i+k])
+                i += k
+                self.left -= k
+            elif len(b) - i < 9:
+                break
+            else:
+                x = int.from_bytes(b[i+1:i+5], 'big')
+                y = int.from_bytes(b[i+5:i+9], 'big')
+                if b[i] == 67:
+                    self.src.seek(x*self.blk)
+                    for j in range(y):
+                        self.f.write(self.m[:self.src.readinto(self.m)])
+                else:
+                    self.left = y
+                i += 9
+        self.b = b[i:]
+        return nb
+    def close(self):
+        self.src.close()
+        self.f.close()
+
+def _alpacadeltaend(fn, crc):
+    import os
+    t = fn + '.dl~'
+    c = 0
+    m = memoryview(bytearray(256))
+    with open(t, 'rb') as f:
+        while True:
+            n = f.readinto(m)
+            if not n:
+                break
+            c = _alpacacrc(m[:n], c)
+    if c != crc:
+        os.remove(t)
+        print('\\x1e' + repr(('deltaend', 0)))
+        return
+    try:
+        os.rename(t, fn)
+    except OSError:
+        os.remove(fn)
+        os.rename(t, fn)
+    print('\\x1e' + repr(('deltaend', 1)))
+"""
+
+# runs a cell between time.ticks_us() readings and, where the firmware has sys.settrace, adds up the time
+# and hits per line ('l') or per function ('f'); the results go back as one \x1e line when it finishes
+profiler = """
+def _alpacaprofile(src, mode=''):
+    import sys, time
+    c = compile(src, '<cell>', 'exec')
+    st = {}
+    p = [None, 0]
+    stk = []
+    tu, td = time.ticks_us, time.ticks_diff
+    def tl(f, e, a):
+        n = tu()
+        if p[0] is not None:
+            s = st.get(p[0])
+            if s is None:
+                s = st[p[0]] = [0, 0]
+            s[0] += 1
+            s[1] += td(n, p[1])
+        p[0] = '%s:%d' % (f.f_code.co_filename, f.f_lineno)  if e == 'line'  else None
+        p[1] = tu()
+        return tl
+    def tf(f, e, a):
+        if e == 'call':
+            stk.append(tu())
+        elif e == 'return' and stk:
+            k = '%s:%s' % (f.f_code.co_filename, f.f_code.co_name)
+            s = st.get(k)
+            if s is None:
+                s = st[k] = [0, 0]
+            s[0] += 1
+            s[1] += td(tu(), stk.pop())
+        return tf
+    t = {'l':tl, 'f':tf}.get(mode)  if hasattr(sys, 'settrace')  else None
+    t0 = tu()
+    try:
+        if t:
+            sys.settrace(t)
+        exec(c, globals())
+    finally:
+        if t:
+            sys.settrace(None)
+        dt = td(tu(), t0)
+        print('\\x1e' + repr(('profile', dt, mode if t else '', [ (k, s[0], s[1])  for k, s in st.items() ])))
+"""
+
+# runs a cell between readings of the GC heap, which go back as one \x1e line even when the cell fails
+# (as with a MemoryError); c collects the garbage first so the second reading is of what the cell kept
+heap = """
+def _alpacaheap(src, c=0, v=0):
+    import gc
+    f0, a0 = gc.mem_free(), gc.mem_alloc()
+    try:
+        exec(compile(src, '<cell>', 'exec'), globals())
+    finally:
+        if c:
+            gc.collect()
+        f1, a1 = gc.mem_free(), gc.mem_alloc()
+        if v:
+            import micropython
+            micropython.mem_info(v-1) if v > 1 else micropython.mem_info()
+        print('\\x1e' + repr(('heap', f0, a0, f1, a1)))
+"""
+
+# evaluates the user_expressions of an execute request after the cell, as (1, repr) or (0, exception name, message)
+userexpressions = """
+def _alpacaexprs(d):
+    r = {}
+    for k, e in d.items():
+        try:
+            r[k] = (1, repr(eval(e, globals())))
+        except Exception as x:
+            r[k] = (0, type(x).__name__, str(x))
+    print('\\x1e' + repr(('exprs', r)))
+"""
+
+helpers = { "rxbinary":rxbinary, "mpyexec":mpyexec, "cellcache":cellcache, "crcxfer":crcxfer, "hostmount":hostmount,
+            "unbundle":unbundle, "delta":delta, "profiler":profiler, "heap":heap,
+            "userexpressions":userexpressions }
+helperdependencies = { "mpyexec":["rxbinary"], "delta":["crcxfer"] }
+
+# device code that sends the values of the expressions back in a frame tagged with tag
+def sendframe(tag, *expressions):
+    return "print('\\x1e'+repr(({},{})))".format(repr(tag), ",".join(expressions))
+
+# calls of the agent module (see agent below) that stand in for the snippets DeviceConnector would
+# otherwise send, each reporting back in frames
+agentcalls = """
+import os
+def _f(*v):
+    print('\\x1e' + repr(v))
+def ls(d):
+    for e in os.ilistdir(d):
+        _f('ls', e)
+def hash(fn, n, blk):
+    _alpacacrcs(fn, n, blk)
+def put(fn, mode, off):
+    f = open(fn, mode)
+    f.seek(off)
+    return f
+def get(fn):
+    return open(fn, 'rb')
+def rm(fn):
+    try:
+        os.remove(fn)
+    except OSError:
+        pass
+def mkdirs(fn):
+    p = ''
+    for d in fn.split('/')[:-1]:
+        if d:
+            p += d
+            try:
+                os.mkdir(p)
+            except OSError:
+                pass
+            p += '/'
+def codecs():
+    try:
+        import deflate
+        _f('codecs', 'deflate', hasattr(deflate.DeflateIO, 'write'))
+    except ImportError:
+        try:
+            import zlib
+            _f('codecs', 'zlib', hasattr(zlib, 'DecompIO'))
+        except ImportError:
+            _f('codecs', 'none', False)
+def _copy(f, g):
+    m = memoryview(bytearray(256))
+    while True:
+        n = f.readinto(m)
+        if not n:
+            break
+        g.write(m[:n])
+def decompress(src, dst, wbits):
+    with open(src, 'rb') as f:
+        try:
+            import deflate
+            z = deflate.DeflateIO(f, deflate.ZLIB, wbits)
+        except ImportError:
+            import zlib
+            z = zlib.DecompIO(f, wbits)
+        with open(dst, 'wb') as g:
+            _copy(z, g)
+    os.remove(src)
+def compress(src, dst, wbits, minbytes):
+    n = os.stat(src)[6]
+    if n < minbytes:
+        _f('sizes', n, n)
+        return
+    import deflate
+    with open(src, 'rb') as f:
+        with open(dst, 'wb') as g:
+            z = deflate.DeflateIO(g, deflate.ZLIB, wbits)
+            _copy(f, z)
+            z.close()
+    _f('sizes', n, os.stat(dst)[6])
+"""
+
+# the agent is a module kept on the device's filesystem with the file transfer helpers and calls for
+# housekeeping, so they don't need sending and compiling again after every connect or reboot; %agent
+# installs it, and the kernel only uses one whose VERSION is the same as agentversion
+agentversion = 1
+agentfile = "alpaca_agent.py"
+agenthelpers = [ "rxbinary", "crcxfer", "delta", "unbundle" ]
+agent = "# helpers for alpaca_kernel, installed with %agent\nVERSION = {}\n".format(agentversion) + \
+        "".join(helpers[name]  for name in agenthelpers) + agentcalls
+
+# run in place of the 1 that enterpastemode sends to sync with the raw REPL, it imports the agent as _alpacaa
+# with its helpers into the REPL globals if it's the right version, and sends back the version found
+agentprobe = """try:
+ import alpaca_agent as _alpacaa
+ if _alpacaa.VERSION == {}:
+  for O in dir(_alpacaa):
+   if O[:7] == '_alpaca': globals()[O] = getattr(_alpacaa, O)
+  del O
+ {}
+except ImportError:
+ {}
+except Exception:
+ {}
+""".format(agentversion, sendframe("agent", "_alpacaa.VERSION"), sendframe("agent", "0"), sendframe("agent", "-1"))
+
+# first line of a cell compiled to bytecode so it can see the REPL globals (tracebacks are one line out)
+mpycellprefix = "from __main__ import *\n"
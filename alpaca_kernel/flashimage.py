@@ -0,0 +1,137 @@
+"""Flash a firmware image, skipping the parts the board already holds.
+
+Run per port by ``DeviceConnector.esptool`` as ``python -m alpaca_kernel.flashimage``.  The flash is compared
+block by block with the image using the esptool stub's flash MD5 command, and only the regions that
+differ are handed to esptool write_flash.  Where esptool rewrites the flash mode and size in the image
+header, the header bytes already in flash go into the image before it is compared.  The last line printed
+is ``ALPACAFLASH {json}`` for the kernel.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+flashblocksize = 0x4000   # must be a multiple of the 4kB flash sector
+
+# write_flash options with which esptool rewrites bytes 2 and 3 (flash mode, size and frequency) of a
+# bootloader or esp8266 image header, so the flash never holds the image exactly as it is in the file
+headerflashargs = ("--flash_mode", "-fm", "--flash_size", "-fs", "--flash_freq", "-ff")
+headeroffsets = (0x0, 0x1000)   # where the chips' first stage images go
+
+
+def blockmd5s(image, blocksize=flashblocksize):
+    return [ hashlib.md5(image[i:i+blocksize]).hexdigest()  for i in range(0, len(image), blocksize) ]
+
+
+def esptoolpatchesheader(image, offset, flashargs):
+    return image[:1] == b"\xe9" and offset in headeroffsets and any(a.split("=")[0] in headerflashargs  for a in flashargs.split())
+
+
+# the image as it would be in flash after esptool has put in the header bytes it read back from there
+def patchedimage(image, flashheader):
+    return image[:2] + flashheader[2:4] + image[4:]  if flashheader  else image
+
+
+def connectesp(port, baud):
+    import esptool   # only used as a library for the comparison, which is skipped when it isn't importable
+    try:
+        from esptool.cmds import detect_chip
+    except ImportError:
+        detect_chip = esptool.ESPLoader.detect_chip
+    esp = detect_chip(port, baud)
+    return esp.run_stub()
+
+
+# returns (mac, [md5 of each block of flash], first 4 bytes of flash if bheader else None)
+# or raises if the comparison can't be done
+def flashmd5s(port, baud, offset, image, blocksize=flashblocksize, bheader=False):
+    esp = connectesp(port, baud)
+    try:
+        mac = ":".join("%02x" % x  for x in esp.read_mac())
+        flashheader = esp.read_flash(offset, 4)  if bheader  else None
+        md5s = [ ]
+        for i in range(0, len(image), blocksize):
+            md5 = esp.flash_md5sum(offset + i, len(image[i:i+blocksize]))
+            md5s.append(md5.decode() if type(md5) == bytes else md5)
+        esp.hard_reset()
+    finally:
+        esp._port.close()
+    return mac, md5s, flashheader
+
+
+# merges the differing blocks into [(startoffset, endoffset)] runs within the image
+def changedregions(imagemd5s, devicemd5s, imagelength, blocksize=flashblocksize):
+    regions = [ ]
+    for i, (a, b) in enumerate(zip(imagemd5s, devicemd5s)):
+        if a != b:
+            start, end = i*blocksize, min((i+1)*blocksize, imagelength)
+            if regions and regions[-1][1] == start:
+                regions[-1] = (regions[-1][0], end)
+            else:
+                regions.append((start, end))
+    return regions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write only the changed parts of a firmware image")
+    parser.add_argument('--esptool', type=str, default="esptool.py")
+    parser.add_argument('--port', type=str, required=True)
+    parser.add_argument('--chip', type=str, default="auto")
+    parser.add_argument('--baud', type=int, default=460800)
+    parser.add_argument('--offset', type=lambda x: int(x, 0), default=0x1000)
+    parser.add_argument('--flashargs', type=str, default="", help="extra write_flash arguments, eg '--flash_size=detect -fm dio'")
+    parser.add_argument('--force', action='store_true', help="skip the comparison and write the whole image")
+    parser.add_argument('binfile', type=str)
+    args = parser.parse_args(argv)
+
+    with open(args.binfile, "rb") as fin:
+        image = fin.read()
+    result = { "port":args.port, "sha256":hashlib.sha256(image).hexdigest(), "size":len(image), "file":os.path.abspath(args.binfile),
+               "offset":args.offset, "mac":None, "written":len(image), "skipped":False }
+
+    regions = [ (0, len(image)) ]
+    if not args.force:
+        try:
+            print("Comparing {} with flash by MD5...".format(os.path.basename(args.binfile)), flush=True)
+            bheader = esptoolpatchesheader(image, args.offset, args.flashargs)
+            mac, devicemd5s, flashheader = flashmd5s(args.port, args.baud, args.offset, image, bheader=bheader)
+            result["mac"] = mac
+            regions = changedregions(blockmd5s(patchedimage(image, flashheader)), devicemd5s, len(image))
+        except Exception as e:   # esptool missing as a library, old ROM without the stub, etc: just write everything
+            print("Could not compare with flash ({}: {}), writing the whole image".format(type(e).__name__, e), flush=True)
+
+    result["written"] = sum(end - start  for start, end in regions)
+    if not regions:
+        result["skipped"] = True
+        print("Flash already holds this image, skipping the write", flush=True)
+    else:
+        if regions != [ (0, len(image)) ]:
+            print("Writing {} changed region(s), {} of {} bytes".format(len(regions), result["written"], len(image)), flush=True)
+        with tempfile.TemporaryDirectory() as td:
+            pargs = [args.esptool, "--port", args.port, "--baud", str(args.baud)]
+            if args.chip != "auto":
+                pargs.extend(["--chip", args.chip])
+            pargs.extend(["write_flash", "-z"] + args.flashargs.split())
+            for start, end in regions:
+                if (start, end) == (0, len(image)):
+                    regionfile = args.binfile
+                else:
+                    regionfile = os.path.join(td, "region%x.bin" % start)
+                    with open(regionfile, "wb") as fout:
+                        fout.write(image[start:end])
+                pargs.extend(["0x%x" % (args.offset + start), regionfile])
+            sys.stdout.flush()
+            returncode = subprocess.call(pargs)
+            if returncode != 0:
+                return returncode
+
+    print("ALPACAFLASH " + json.dumps(result), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
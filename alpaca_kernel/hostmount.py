@@ -0,0 +1,98 @@
+"""A directory on the PC served read-only to the device, like ``mpremote mount``.
+
+The hostmount device helper mounts a VFS whose calls turn into request lines of
+``\\x18`` + command letter + space separated lowercase hex fields, written to stdout while the cell runs.
+``DeviceConnector.receivestream`` hands those lines to ``HostMount.handle`` and writes the reply straight
+back to the device's stdin as 8 hex digits of length followed by the data.
+
+    s <path>            stat: "mode size mtime", or nothing if it doesn't exist
+    l <path>            listdir: lines of "mode size name"
+    o <path>            open: "fid size", or nothing if it isn't a file
+    r <fid> <off> <n>   read n bytes from off
+
+Files are read whole when opened and kept while their mtime is unchanged, so edits on the PC
+are seen by the next open and rereads of the same file (eg repeated imports) don't touch the disk.
+"""
+
+import binascii
+import os
+from collections import OrderedDict
+
+mountpoint = "/remote"
+maxopenfiles = 64
+maxcachedbytes = 16*1024*1024
+
+
+class HostMount:
+    def __init__(self, localdir):
+        self.localdir = os.path.abspath(localdir)
+        self.openfiles = OrderedDict()   # fid -> contents
+        self.filecache = OrderedDict()   # localpath -> (mtime, contents)
+        self.nextfid = 1
+        self.nrequests = 0
+        self.nbytesserved = 0
+
+    # device path (relative to the mount point) to a local path that can't climb out of localdir
+    def localpath(self, devicepath):
+        parts = [ p  for p in devicepath.replace("\\", "/").split("/")  if p and p != "." ]
+        if ".." in parts:
+            return None
+        return os.path.join(self.localdir, *parts)
+
+    def readfile(self, localpath):
+        mtime = os.path.getmtime(localpath)
+        cached = self.filecache.get(localpath)
+        if cached and cached[0] == mtime:
+            self.filecache.move_to_end(localpath)
+            return cached[1]
+        with open(localpath, "rb") as fin:
+            contents = fin.read()
+        self.filecache[localpath] = (mtime, contents)
+        while sum(len(c)  for m, c in self.filecache.values()) > maxcachedbytes and len(self.filecache) > 1:
+            self.filecache.popitem(last=False)
+        return contents
+
+    # takes the request line (without \r\n) and returns the bytes to write back to the device
+    def handle(self, requestline):
+        self.nrequests += 1
+        command = requestline[1:2].decode()
+        fields = requestline[2:].split()
+        try:
+            res = self.dispatch(command, fields)
+        except (OSError, ValueError, KeyError):
+            res = b""
+        self.nbytesserved += len(res)
+        return b"%08x" % len(res) + res
+
+    def dispatch(self, command, fields):
+        if command == "r":
+            fid, offset, n = [ int(f, 16)  for f in fields ]
+            return self.openfiles[fid][offset:offset+n]
+
+        localpath = self.localpath(binascii.unhexlify(fields[0]).decode() if fields else "")
+        if localpath is None:
+            return b""
+        if command == "s":
+            st = os.stat(localpath)
+            mode = 0x4000 if os.path.isdir(localpath) else 0x8000
+            return b"%d %d %d" % (mode, (0 if mode == 0x4000 else st.st_size), int(st.st_mtime))
+        if command == "l":
+            entries = [ ]
+            for name in sorted(os.listdir(localpath)):
+                fp = os.path.join(localpath, name)
+                if os.path.isdir(fp):
+                    entries.append(b"%d 0 %s" % (0x4000, name.encode()))
+                elif os.path.isfile(fp):
+                    entries.append(b"%d %d %s" % (0x8000, os.path.getsize(fp), name.encode()))
+            return b"\n".join(entries)
+        if command == "o":
+            if not os.path.isfile(localpath):
+                return b""
+            contents = self.readfile(localpath)
+            fid = self.nextfid
+            self.nextfid += 1
+            self.openfiles[fid] = contents
+            while len(self.openfiles) > maxopenfiles:
+                self.openfiles.popitem(last=False)
+            return b"%d %d" % (fid, len(contents))
+        return b""
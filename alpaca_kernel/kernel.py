@@ -1,9 +1,11 @@
 import ast
 import base64
-import binascii
+import json
 import logging
 import os
+import queue
 import re
+import threading
 import traceback
 import time
 import urllib
@@ -18,6 +20,11 @@ import websocket  # only for WebSocketConnectionClosedException
 from ipykernel.kernelbase import Kernel
 
 from . import deviceconnector
+from . import devicehelpers
+from . import minify
+from . import mpycache
+from .plotparse import PLOT_PREFIX, unpack_Thonny_string, unpack_plot_data
+from . import wiretrace
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -43,7 +50,6 @@ VALID_ATTRIBUTES = {'legend': 'legend',
                     'title': 'set_title'}
 # Key: accepted input, Value: function to run as ouput
 ATTRIBUTE_PREFIX = '%matplotlib --'  # Prefix to recognize attribute
-PLOT_PREFIX = '%matplotlibdata --'
 
 # --------------------------------------------------------------------
 
@@ -63,9 +69,14 @@ ap_serialconnect.add_argument('--raw', help='Just open connection', action='stor
 ap_serialconnect.add_argument('--port', type=str, default=0)
 ap_serialconnect.add_argument('--baud', type=int, default=115200)
 ap_serialconnect.add_argument('--verbose', action='store_true')
+ap_serialconnect.add_argument('--auto', help='Find the port with a MicroPython board on it', action='store_true')
+ap_serialconnect.add_argument('--reprobe', help='With --auto, probe all ports again rather than using the cached result', action='store_true')
+ap_serialconnect.add_argument('--broker', help='Hold the port in a background broker so kernel restarts keep the connection', action='store_true')
+ap_serialconnect.add_argument('--name', type=str, help='Keep this as a named device alongside the other connections')
 
 ap_socketconnect = argparse.ArgumentParser(prog="%socketconnect", add_help=False)
 ap_socketconnect.add_argument('--raw', help='Just open connection', action='store_true')
+ap_socketconnect.add_argument('--verbose', '-v', action='store_true')
 ap_socketconnect.add_argument('ipnumber', type=str)
 ap_socketconnect.add_argument('portnumber', type=int)
 
@@ -78,6 +89,20 @@ ap_websocketconnect.add_argument('websocketurl', type=str, default="ws://192.168
 ap_websocketconnect.add_argument("--password", type=str)
 ap_websocketconnect.add_argument('--verbose', action='store_true')
 
+ap_device = argparse.ArgumentParser(prog="%device", description="list the named devices or switch to one", add_help=False)
+ap_device.add_argument('name', type=str, nargs="?")
+
+ap_broadcast = argparse.ArgumentParser(prog="%%broadcast", description="run the cell on several named devices at the same time",
+                                       add_help=False)
+ap_broadcast.add_argument('--all', action='store_true')
+ap_broadcast.add_argument('names', type=str, nargs="*")
+
+ap_profile = argparse.ArgumentParser(prog="%%profile", description="time the cell on the device and show where the time went",
+                                     add_help=False)
+ap_profile.add_argument('--lines', '-l', help="time each line (needs a firmware with sys.settrace)", action='store_true')
+ap_profile.add_argument('--functions', '-f', help="time each function call (needs a firmware with sys.settrace)", action='store_true')
+ap_profile.add_argument('--top', '-n', type=int, default=20, help="number of hot spots to show")
+
 ap_writebytes = argparse.ArgumentParser(prog="%writebytes", add_help=False)
 ap_writebytes.add_argument('--binary', '-b', action='store_true')
 ap_writebytes.add_argument('--verbose', '-v', action='store_true')
@@ -95,6 +120,11 @@ ap_sendtofile.add_argument('--execute', '-x', action='store_true')
 ap_sendtofile.add_argument('--source', help="source file", type=str, default="<<cellcontents>>", nargs="?")
 ap_sendtofile.add_argument('--quiet', '-q', action='store_true')
 ap_sendtofile.add_argument('--QUIET', '-Q', action='store_true')
+ap_sendtofile.add_argument('--nompy', help="don't cross-compile a --source directory even when mpy-cross is set", action='store_true')
+ap_sendtofile.add_argument('--nocompress', help="don't send compressed even if the device could decompress", action='store_true')
+ap_sendtofile.add_argument('--delta', help="only send the blocks that differ from the copy already on the device", action='store_true')
+ap_sendtofile.add_argument('--nobundle', help="send a directory file by file instead of as one archive", action='store_true')
+ap_sendtofile.add_argument('--resume', help="carry on from where an interrupted transfer to the same file got to (implies --binary)", action='store_true')
 ap_sendtofile.add_argument('destinationfilename', type=str, nargs="?")
 
 ap_ls = argparse.ArgumentParser(prog="%ls", description="list directory of the microcontroller's file system",
@@ -110,18 +140,68 @@ ap_fetchfile.add_argument('--print', '-p', action="store_true")
 ap_fetchfile.add_argument('--load', '-l', action="store_true")
 ap_fetchfile.add_argument('--quiet', '-q', action='store_true')
 ap_fetchfile.add_argument('--QUIET', '-Q', action='store_true')
+ap_fetchfile.add_argument('--nocompress', help="don't have the device compress the file first", action='store_true')
+ap_fetchfile.add_argument('--resume', help="carry on from where an interrupted fetch into the same file got to, and keep what arrived if interrupted", action='store_true')
 ap_fetchfile.add_argument('sourcefilename', type=str)
 ap_fetchfile.add_argument('destinationfilename', type=str, nargs="?")
 
 ap_mpycross = argparse.ArgumentParser(prog="%mpy-cross", add_help=False)
 ap_mpycross.add_argument('--set-exe', type=str)
+ap_mpycross.add_argument('--march', type=str, help="architecture for the native emitter, eg xtensawin")
+ap_mpycross.add_argument('--build', type=str, help="cross-compile a whole directory into the build cache")
 ap_mpycross.add_argument('pyfile', type=str, nargs="?")
 
 ap_esptool = argparse.ArgumentParser(prog="%esptool", add_help=False)
-ap_esptool.add_argument('--port', type=str, default=0)
+ap_esptool.add_argument('--port', type=str, action='append', help='can be given several times to flash in parallel')
+ap_esptool.add_argument('--all', help='flash every serial port found', action='store_true')
+ap_esptool.add_argument('--force', help='write the whole image even if the flash already matches it', action='store_true')
 ap_esptool.add_argument('espcommand', choices=['erase', 'esp32', 'esp8266'])
 ap_esptool.add_argument('binfile', type=str, nargs="?")
 
+ap_agent = argparse.ArgumentParser(prog="%agent", description="keep the kernel's file helpers in a module on the device",
+                                   add_help=False)
+ap_agent.add_argument('mode', choices=['install', 'remove', 'status'], nargs="?", default="status")
+
+ap_bytecode = argparse.ArgumentParser(prog="%bytecode", description="compile cells with mpy-cross on the PC before sending them",
+                                      add_help=False)
+ap_bytecode.add_argument('mode', choices=['on', 'off'])
+
+ap_cellcache = argparse.ArgumentParser(prog="%cellcache", description="keep compiled cells on the device and rerun them by hash",
+                                       add_help=False)
+ap_cellcache.add_argument('mode', choices=['on', 'off'])
+ap_cellcache.add_argument('--size', type=int, default=16, help="number of cells the device keeps")
+ap_cellcache.add_argument('--minbytes', type=int, default=256, help="smaller cells are just sent")
+
+ap_minify = argparse.ArgumentParser(prog="%minify", description="strip comments, docstrings and indentation from cells before sending",
+                                    add_help=False)
+ap_minify.add_argument('mode', choices=['on', 'off'])
+
+ap_timing = argparse.ArgumentParser(prog="%timing", description="show where the time went in recent cells",
+                                    add_help=False)
+ap_timing.add_argument('--last', '-n', type=int, default=10, help="number of cells to show")
+ap_timing.add_argument('--export', type=str, help="append the records to a JSON lines file")
+ap_timing.add_argument('--clear', action='store_true')
+
+ap_heap = argparse.ArgumentParser(prog="%heap", description="read the device's heap before and after each cell, in the same round trip",
+                                  add_help=False)
+ap_heap.add_argument('mode', choices=['on', 'off', 'show'], nargs="?", default="show")
+ap_heap.add_argument('--threshold', type=int, help="warn when a cell leaves less free heap than this (default a tenth of the heap)")
+ap_heap.add_argument('--collect', action='store_true', help="gc.collect() before the reading after the cell")
+ap_heap.add_argument('--meminfo', action='count', default=0, help="print micropython.mem_info() after each cell (twice for the block map)")
+ap_heap.add_argument('--last', '-n', type=int, default=10, help="number of cells to show")
+ap_heap.add_argument('--clear', action='store_true')
+
+ap_trace = argparse.ArgumentParser(prog="%trace", description="record the bytes to and from the device, or play a recording back",
+                                   add_help=False)
+ap_trace.add_argument('mode', choices=['start', 'stop', 'replay'])
+ap_trace.add_argument('tracefile', type=str, nargs="?")
+ap_trace.add_argument('--speed', type=float, default=0, help="replay at this multiple of the recorded speed (default as fast as possible)")
+
+ap_mount = argparse.ArgumentParser(prog="%mount", description="serve a directory on the PC to the device read-only at /remote",
+                                   add_help=False)
+ap_mount.add_argument('--unmount', '-u', action='store_true')
+ap_mount.add_argument('localdir', type=str, nargs="?")
+
 ap_capture = argparse.ArgumentParser(prog="%capture", description="capture output printed by device and save to a file",
                                      add_help=False)
 ap_capture.add_argument('--quiet', '-q', action='store_true')
@@ -135,6 +215,71 @@ ap_writefilepc.add_argument('--execute', '-x', action='store_true')
 ap_writefilepc.add_argument('destinationfilename', type=str)
 
 
+timinghistorylength = 1000
+
+def timingtable(records):
+    def ms(x):
+        return "      -"  if x is None  else "{:7.1f}".format(x*1000)
+    lines = [ "cell    total   prep  write  bytes out  1st byte   exec  bytes in   plot\n" ]
+    for r in records:
+        lines.append("{:>4} {} {} {} {:>10} {} {} {:>9} {}\n".format(r["execution_count"], ms(r["total"]), ms(r["preprocess"]), 
+                     ms(r["writetime"]), r["byteswritten"], ms(r["firstbyte"]), ms(r["execution"]), r["bytesread"], 
+                     ms(r["sresplot"] + r["sendplot"])))
+    lines.append("(times in ms)\n")
+    return "".join(lines)
+
+
+# hot spots from _alpacaprofile, biggest first, with the source of the cell's own lines
+def profiletable(microseconds, mode, stats, requestedmode, cellcontents, top):
+    lines = [ "{:.3f} ms on the device\n".format(microseconds/1000) ]
+    if requestedmode and not mode:
+        lines.append("(no sys.settrace in this firmware, so only the total; it needs MICROPY_PY_SYS_SETTRACE)\n")
+    if not mode:
+        return "".join(lines)
+    celllines = cellcontents.splitlines()
+    stats = sorted(stats, key=lambda s: -s[2])
+    # lines add up to the traced time, but a function's time includes the functions it calls
+    tracedmicroseconds = max(1, sum(s[2]  for s in stats)  if mode == "l"  else max([microseconds] + [ s[2]  for s in stats ]))
+    lines.append("{:<28} {:>8} {:>11} {:>6} {:>9}\n".format("line" if mode == "l" else "function", "hits", 
+                 "ms" if mode == "l" else "incl ms", "%", "us/hit"))
+    for key, hits, us in stats[:top]:
+        source = ""
+        if mode == "l" and key.startswith("<cell>:"):
+            n = int(key[len("<cell>:"):])
+            source = "  " + celllines[n-1].strip()[:40]  if 0 < n <= len(celllines)  else ""
+        lines.append("{:<28} {:>8} {:11.3f} {:6.1f} {:9.1f}{}\n".format(key, hits, us/1000, us*100/tracedmicroseconds, 
+                     us/max(1, hits), source))
+    if len(stats) > top:
+        lines.append("({} more)\n".format(len(stats) - top))
+    lines.append("(sys.settrace slows everything it traces, so compare these with each other rather than with the total)\n")
+    return "".join(lines)
+
+
+def heaptable(records):
+    lines = [ "cell   free before    free after    change   allocated      heap\n" ]
+    for r in records:
+        lines.append("{:>4} {:>13} {:>13} {:>+9} {:>11} {:>9}\n".format(r["execution_count"], r["free_before"], r["free"],
+                     r["free"] - r["free_before"], r["alloc"], r["free"] + r["alloc"]))
+    lines.append("(bytes)\n")
+    return "".join(lines)
+
+
+# the user_expressions of an execute_reply from DeviceConnector.userexpressionresults
+def userexpressionsreply(results):
+    reply = { }
+    for name, result in results.items():
+        if result[0]:
+            reply[name] = { "status":"ok", "data":{ "text/plain":result[1] }, "metadata":{ } }
+        else:
+            reply[name] = { "status":"error", "ename":result[1], "evalue":result[2], "traceback":[ ] }
+    return reply
+
+
+# takes the line numbers in the tracebacks of the device back to the cell as written
+def maptracebacklines(output, linemap):
+    return re.sub(r'(File "<(?:stdin|cell)>", line )(\d+)', lambda m: m.group(1) + str(linemap(int(m.group(2)))), output)
+
+
 def parseap(ap, percentstringargs1):
     try:
         return ap.parse_known_args(percentstringargs1)[0]
@@ -154,78 +299,6 @@ def _to_png(fig):
         base64.b64encode(imgdata.getvalue()))
 
 
-def string_to_numpy(string):
-    line_Items = []
-    width = None
-    for line in string.split("],"):
-        line_Parts = line.split()
-        n = len(line_Parts)
-        if n == 0:
-            continue
-        if width is None:
-            width = n
-        else:
-            assert n == width, "Invalid Array"
-        line = line.split("[")[-1].split("]")[0]
-
-        line_Items.append(np.fromstring(line, dtype=float, sep=','))
-    return np.array(line_Items)
-
-
-def string_is_array(string):
-    if string.count('[') != string.count(']'):
-        return False
-    if sum(cc.isalpha() for cc in string) > 0:  # cant contain alphanumerics
-        return False
-
-    number_of_numbers = 0
-    number_flag = False
-    for cc in string:
-        if cc.isnumeric() and not number_flag:  # recognize start of number
-            number_flag = True
-        if number_flag and cc in [']', ',']:  # recognize end of number
-            number_flag = False
-            number_of_numbers += 1
-
-    if number_of_numbers != string.count(',') + 1:
-        return False
-
-    return True
-
-
-def unpack_Thonny_string(output):
-    ii_label_start = 0
-    ii_number_start = 0
-    ii_number_end = 0
-    points = {}
-
-    number_flag = False
-    for ii, cc in enumerate(output):
-        # Previous end is new start
-        if cc.isnumeric() and output[ii - 1] == ' ' and not number_flag:  # recognize start of number
-            number_flag = True
-            ii_number_start = ii
-
-        at_end = ii == len(output) - 1
-        if number_flag and (cc in [' '] or at_end):  # recognize end of number
-            ii_number_end = ii
-
-            if at_end:
-                ii_number_end = ii + 1
-
-            print(ii_label_start, ii_number_start, ii_number_end)
-            label = output[ii_label_start:ii_number_start].split(':')[0]
-            label = label.rstrip()
-            number = output[ii_number_start:ii_number_end]
-            points[label] = float(number)
-
-            # Prep for new loop
-            number_flag = False
-            ii_label_start = ii_number_end + 1
-
-    return points
-
-
 # Complete streaming of data to file with a quiet mode (listing number of lines)
 # Set this up for pulse reading and plotting in a second jupyter page
 
@@ -268,8 +341,26 @@ class ALPACAKernel(Kernel):
         Kernel.__init__(self, **kwargs)
 
         self.silent = False
+        self.celltiming = { }  # seconds spent in sresPLOT and sendPLOT this cell
+        self.timinghistory = [ ]  # a record per cell for %timing
+        self.lasttiming = None
+        self.heapmode = None  # the %heap on options while it's on
+        self.heaphistory = [ ]  # a record per cell for %heap
+        self.lastheap = None
+        self.userexpressions = { }  # of the execute request, evaluated on the device at the end of the cell
+        self.userexpressionresults = { }
+        self.sresPLOT = self.timedcall("sresplot", self.sresPLOT)
+        self.sendPLOT = self.timedcall("sendplot", self.sendPLOT)
         self.dc = deviceconnector.DeviceConnector(self.sres, self.sresSYS, self.sresPLOT)
+        self.dcname = "default"
+        self.dcs = {self.dcname: self.dc}  # named devices, self.dc is the one cells go to
         self.mpycrossexe = None
+        self.mpycrossarch = None
+        self.bytecodemode = False
+        self.minifymode = False
+        self.cellcachesize = 0  # 0 for off
+        self.cellcacheminbytes = 256
+        self.sreslinemap = None  # maps line numbers in device tracebacks back to the cell as written
 
         self.srescapturemode = 0  # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
         self.srescapturedoutputfile = None  # used by %capture command
@@ -298,11 +389,19 @@ class ALPACAKernel(Kernel):
 
         if percentcommand == ap_serialconnect.prog:
             apargs = parseap(ap_serialconnect, percentstringargs[1:])
+            if apargs.name:
+                self.selectdevice(apargs.name)
 
             self.dc.disconnect(apargs.verbose)
-            self.dc.serialconnect(apargs.port, apargs.baud, apargs.verbose)
+            breattached = False
+            if apargs.broker:
+                breattached = self.dc.brokerconnect(apargs.port, apargs.baud, apargs.verbose)
+            else:
+                self.dc.serialconnect(apargs.port, apargs.baud, apargs.verbose, autodetect=(apargs.auto or apargs.reprobe), reprobe=apargs.reprobe)
             if self.dc.workingserial:
-                if not apargs.raw:
+                if breattached:
+                    self.sresSYS("Reattached (device state kept).\n")
+                elif not apargs.raw:
                     if self.dc.enterpastemode(verbose=apargs.verbose):
                         self.sresSYS("Ready.\n")
                     else:
@@ -351,14 +450,20 @@ class ALPACAKernel(Kernel):
                 if apargs.verbose:
                     self.sres(str(self.dc.workingsocket))
                 self.sres("\n")
-                # if not apargs.raw:
-                #    self.dc.enterpastemode()
+                if not apargs.raw:
+                    if self.dc.enterpastemode(verbose=apargs.verbose):
+                        self.sresSYS("Ready.\n")
+                    else:
+                        self.sres("Disconnecting [paste mode not working]\n", 31)
+                        self.dc.disconnect(verbose=apargs.verbose)
+                        cellcontents = ""
             return cellcontents.strip() and cellcontents or None
 
         if percentcommand == ap_esptool.prog:
             apargs = parseap(ap_esptool, percentstringargs[1:])
             if apargs and (apargs.espcommand == "erase" or apargs.binfile):
-                self.dc.esptool(apargs.espcommand, apargs.port, apargs.binfile)
+                busyports = [ dc.workingserial.port  for dc in self.dcs.values()  if dc is not self.dc and dc.workingserial ]
+                self.dc.esptool(apargs.espcommand, "all" if apargs.all else (apargs.port or [0]), apargs.binfile, apargs.force, busyports)
             else:
                 self.sres(ap_esptool.format_help())
                 self.sres("Please download the bin file from https://micropython.org/download/#{}".format(
@@ -386,40 +491,151 @@ class ALPACAKernel(Kernel):
 
         if percentcommand == "%mpy-cross":
             apargs = parseap(ap_mpycross, percentstringargs[1:])
-            if apargs and apargs.set_exe:
-                self.mpycrossexe = apargs.set_exe
-            elif apargs.pyfile:
+            if apargs and (apargs.set_exe or apargs.march):
+                if apargs.set_exe:
+                    self.mpycrossexe = apargs.set_exe
+                if apargs.march:
+                    self.mpycrossarch = apargs.march
                 if self.mpycrossexe:
-                    self.dc.mpycross(self.mpycrossexe, apargs.pyfile)
-                else:
+                    self.sres("{}\n".format(mpycache.mpycrossversion(self.mpycrossexe) or "mpy-cross did not report a version"))
+            elif apargs and (apargs.pyfile or apargs.build):
+                if not self.mpycrossexe:
                     self.sres("Cross compiler executable not yet set\n", 31)
                     self.sres(
                         "try: %mpy-cross --set-exe /home/julian/extrepositories/micropython/mpy-cross/mpy-cross\n")
-                if self.mpycrossexe:
-                    self.mpycrossexe = "/home/julian/extrepositories/micropython/mpy-cross/mpy-cross"
+                elif apargs.build:
+                    self.buildmpytree(apargs.build)
+                else:
+                    self.dc.mpycross(self.mpycrossexe, apargs.pyfile)
             else:
                 self.sres(ap_mpycross.format_help())
             return cellcontents.strip() and cellcontents or None
 
+        if percentcommand == ap_bytecode.prog:
+            apargs = parseap(ap_bytecode, percentstringargs[1:])
+            if apargs:
+                self.bytecodemode = (apargs.mode == "on")
+                if self.bytecodemode and not self.mpycrossexe:
+                    self.sres("Cells will be sent as source until %mpy-cross --set-exe is given\n", 31)
+            else:
+                self.sres(ap_bytecode.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_cellcache.prog:
+            apargs = parseap(ap_cellcache, percentstringargs[1:])
+            if apargs:
+                self.cellcachesize = max(1, apargs.size) if apargs.mode == "on" else 0
+                self.cellcacheminbytes = apargs.minbytes
+                if not self.cellcachesize and self.dc.cachedcells and self.dc.serialexists():
+                    self.dc.writebytes(b"_alpacacells.clear()\r\x04")
+                    self.dc.receivestream(bseekokay=True)
+                    self.dc.cachedcells.clear()
+            else:
+                self.sres(ap_cellcache.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_minify.prog:
+            apargs = parseap(ap_minify, percentstringargs[1:])
+            if apargs:
+                self.minifymode = (apargs.mode == "on")
+            else:
+                self.sres(ap_minify.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_trace.prog:
+            apargs = parseap(ap_trace, percentstringargs[1:])
+            if apargs and apargs.mode == "stop":
+                if self.dc.wiretrace:
+                    tr = self.dc.wiretrace
+                    self.sres("Recorded {} writes ({} bytes) and {} reads ({} bytes) to {}\n".format(tr.nrecords[wiretrace.tracewrite], 
+                              tr.nbytes[wiretrace.tracewrite], tr.nrecords[wiretrace.traceread], tr.nbytes[wiretrace.traceread], tr.filename))
+                else:
+                    self.sres("No trace running\n")
+                self.dc.stoptrace()
+            elif apargs and apargs.tracefile and apargs.mode == "start":
+                self.dc.starttrace(apargs.tracefile)
+                self.sres("Recording to {}\n".format(apargs.tracefile))
+            elif apargs and apargs.tracefile:
+                try:
+                    records = wiretrace.readtrace(apargs.tracefile)
+                except (OSError, ValueError) as e:
+                    self.sres("{}\n".format(e), 31)
+                    return None
+                replaydc = deviceconnector.DeviceConnector(self.sres, self.sresSYS, self.sresPLOT)
+                nbytes, seconds = replaydc.replaytrace(records, apargs.speed or None)
+                self.sres("\n[replayed {} bytes in {:.3f}s, {:.0f}kB/s]\n".format(nbytes, seconds, nbytes/max(seconds, 1e-6)/1000))
+            else:
+                self.sres(ap_trace.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_timing.prog:
+            apargs = parseap(ap_timing, percentstringargs[1:])
+            if apargs and apargs.clear:
+                self.timinghistory.clear()
+            elif apargs and apargs.export:
+                with open(apargs.export, "a") as fout:
+                    for record in self.timinghistory:
+                        fout.write(json.dumps(record) + "\n")
+                self.sres("Appended {} records to {}\n".format(len(self.timinghistory), apargs.export))
+            elif apargs:
+                self.sres(timingtable(self.timinghistory[-max(1, apargs.last):]))
+            else:
+                self.sres(ap_timing.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_heap.prog:
+            apargs = parseap(ap_heap, percentstringargs[1:])
+            if apargs and apargs.clear:
+                self.heaphistory.clear()
+            elif apargs and apargs.mode == "on":
+                self.heapmode = { "threshold":apargs.threshold, "collect":apargs.collect, "meminfo":apargs.meminfo }
+                if self.bytecodemode or self.cellcachesize:
+                    self.sres("Cells go as source while %heap is on, not by %bytecode or %cellcache\n", 31)
+            elif apargs and apargs.mode == "off":
+                self.heapmode = None
+            elif apargs:
+                self.sres(heaptable(self.heaphistory[-max(1, apargs.last):]))
+            else:
+                self.sres(ap_heap.format_help())
+            return cellcontents.strip() and cellcontents or None
+
         if percentcommand == "%comment":
             self.sres(" ".join(percentstringargs[1:]), asciigraphicscode=32)
             return cellcontents.strip() and cellcontents or None
 
         if percentcommand == "%lsmagic":
+            self.sres(re.sub("usage: ", "", ap_agent.format_usage()))
+            self.sres("    install the helpers for file transfers and listings on the device so they don't need sending each time\n\n")
+            self.sres(re.sub("usage: ", "", ap_bytecode.format_usage()))
+            self.sres("    compile cells with mpy-cross and send the bytecode (falls back to source)\n\n")
             self.sres(re.sub("usage: ", "", ap_capture.format_usage()))
             self.sres("    records output to a file\n\n")
+            self.sres(re.sub("usage: ", "", ap_cellcache.format_usage()))
+            self.sres("    compile big cells once on the device and rerun them by hash\n\n")
             self.sres("%comment\n    print this into output\n\n")
+            self.sres(re.sub("usage: ", "", ap_broadcast.format_usage()))
+            self.sres("    run the cell on several named devices at once\n\n")
+            self.sres(re.sub("usage: ", "", ap_device.format_usage()))
+            self.sres("    list the named devices (%serialconnect --name) or switch cells to one of them\n\n")
             self.sres(re.sub("usage: ", "", ap_disconnect.format_usage()))
             self.sres("    disconnects from web/serial connection\n\n")
             self.sres(re.sub("usage: ", "", ap_esptool.format_usage()))
             self.sres("    commands for flashing your esp-device\n\n")
             self.sres(re.sub("usage: ", "", ap_fetchfile.format_usage()))
             self.sres("    fetch and save a file from the device\n\n")
+            self.sres(re.sub("usage: ", "", ap_heap.format_usage()))
+            self.sres("    track the free heap on the device across each cell and warn when it runs low\n\n")
             self.sres(re.sub("usage: ", "", ap_ls.format_usage()))
             self.sres("    list files on the device\n\n")
             self.sres("%lsmagic\n    list magic commands\n\n")
+            self.sres(re.sub("usage: ", "", ap_minify.format_usage()))
+            self.sres("    send cells without comments, docstrings and blank lines\n\n")
             self.sres(re.sub("usage: ", "", ap_mpycross.format_usage()))
             self.sres("    cross-compile a .py file to a .mpy file\n\n")
+            self.sres(re.sub("usage: ", "", ap_mount.format_usage()))
+            self.sres("    serve a PC directory to the device at /remote so imports see edits without %sendtofile\n\n")
+            self.sres(re.sub("usage: ", "", ap_profile.format_usage()))
+            self.sres("    run the cell timed on the device with ticks_us, and per line or function with sys.settrace\n\n")
             self.sres(re.sub("usage: ", "", ap_readbytes.format_usage()))
             self.sres("    does serial.read_all()\n\n")
             self.sres("%rebootdevice\n    reboots device\n\n")
@@ -431,6 +647,10 @@ class ALPACAKernel(Kernel):
             self.sres("    connects to a socket of a device over wifi\n\n")
             self.sres("%suppressendcode\n    doesn't send x04 or wait to read after sending the contents of the cell\n")
             self.sres("  (assists for debugging using %writebytes and %readbytes)\n\n")
+            self.sres(re.sub("usage: ", "", ap_timing.format_usage()))
+            self.sres("    break down the time of recent cells into link, device and plotting\n\n")
+            self.sres(re.sub("usage: ", "", ap_trace.format_usage()))
+            self.sres("    record everything sent to and read from the device, and replay it without the device\n\n")
             self.sres(re.sub("usage: ", "", ap_websocketconnect.format_usage()))
             self.sres("    connects to the webREPL websocket of an ESP8266 over wifi\n")
             self.sres("    websocketurl defaults to ws://192.168.4.1:8266 but be sure to be connected\n\n")
@@ -446,10 +666,73 @@ class ALPACAKernel(Kernel):
             self.dc.disconnect(raw=apargs.raw, verbose=True)
             return None
 
+        if percentcommand == ap_device.prog:
+            apargs = parseap(ap_device, percentstringargs[1:])
+            if apargs and apargs.name:
+                self.selectdevice(apargs.name)
+            for name, dc in self.dcs.items():
+                connection = dc.workingserial or dc.workingsocket or dc.workingwebsocket
+                self.sres("{} {:<12} {}\n".format("*" if dc is self.dc else " ", name,
+                                                   connection.port if dc.workingserial else (connection or "(not connected)")))
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_broadcast.prog:
+            apargs = parseap(ap_broadcast, percentstringargs[1:])
+            if apargs and (apargs.all or apargs.names):
+                names = [ name  for name, dc in self.dcs.items()  if dc.serialexists() ] if apargs.all else apargs.names
+                self.broadcastcell(names, cellcontents)
+            else:
+                self.sres(ap_broadcast.format_help())
+            return None
+
         # remaining commands require a connection
         if not self.dc.serialexists():
             return cellcontents
 
+        if percentcommand == ap_mount.prog:
+            apargs = parseap(ap_mount, percentstringargs[1:])
+            if apargs and apargs.unmount:
+                self.dc.unmount()
+            elif apargs and apargs.localdir:
+                self.dc.mount(apargs.localdir)
+            elif apargs and self.dc.hostmount:
+                self.sres("{} mounted at {}, {} requests ({} bytes) so far\n".format(self.dc.hostmount.localdir, 
+                          deviceconnector.hostmount.mountpoint, self.dc.hostmount.nrequests, self.dc.hostmount.nbytesserved))
+            else:
+                self.sres(ap_mount.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_agent.prog:
+            apargs = parseap(ap_agent, percentstringargs[1:])
+            if apargs and apargs.mode == "install":
+                self.dc.installagent()
+            elif apargs and apargs.mode == "remove":
+                self.dc.removeagent()
+            if apargs:
+                if self.dc.useagent():
+                    self.sres("{} version {} is in use\n".format(devicehelpers.agentfile, self.dc.agentversion))
+                elif self.dc.agentversion == -1:
+                    self.sres("{} is on the device but fails to import\n".format(devicehelpers.agentfile), 31)
+                elif self.dc.agentversion:
+                    self.sres("{} is version {}, this kernel needs version {}\n".format(devicehelpers.agentfile, self.dc.agentversion, 
+                              devicehelpers.agentversion), 31)
+                else:
+                    self.sres("No {} on the device\n".format(devicehelpers.agentfile))
+            else:
+                self.sres(ap_agent.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_profile.prog:
+            apargs = parseap(ap_profile, percentstringargs[1:])
+            if apargs and cellcontents.strip():
+                mode = "l" if apargs.lines else ("f" if apargs.functions else "")
+                res = self.dc.runprofiledcell(cellcontents, mode, isplotting=self.sresplotmode)
+                if res:
+                    self.sresSYS(profiletable(*res, mode, cellcontents, apargs.top))
+            else:
+                self.sres(ap_profile.format_help())
+            return None
+
         if percentcommand == ap_plot.prog:
             apargs = parseap(ap_plot, percentstringargs[1:])
             if apargs.mode == 'matplotlib':
@@ -548,15 +831,27 @@ class ALPACAKernel(Kernel):
         if percentcommand == ap_fetchfile.prog:
             apargs = parseap(ap_fetchfile, percentstringargs[1:])
             if apargs:
-                fetchedcontents = self.dc.fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet)
+                dstfile = apargs.destinationfilename or os.path.basename(apargs.sourcefilename)
+                resumedata = None
+                if apargs.resume and os.path.isfile(dstfile):
+                    resumedata = open(dstfile, "rb").read()
+                fetchedcontents = None
+                try:
+                    fetchedcontents = self.dc.fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet, not apargs.nocompress,
+                                                        resumedata)
+                finally:
+                    # interrupted, connection lost or gave up on a chunk
+                    if fetchedcontents is None and apargs.resume and len(self.dc.fetchedpartial) > len(resumedata or b""):
+                        self.sres("Keeping the {} bytes fetched in {} for --resume\n".format(len(self.dc.fetchedpartial), repr(dstfile)))
+                        with open(dstfile, "wb") as fout:
+                            fout.write(self.dc.fetchedpartial)
                 if apargs.print:
                     self.sres(fetchedcontents.decode() if type(fetchedcontents) == bytes else fetchedcontents,
                               clear_output=True)
 
                 if (apargs.destinationfilename or (not apargs.print and not apargs.load)) and fetchedcontents:
-                    dstfile = apargs.destinationfilename or os.path.basename(apargs.sourcefilename)
                     self.sres("Saving file to {}".format(repr(dstfile)))
-                    fout = open(dstfile, "wb" if apargs.binary else "w")
+                    fout = open(dstfile, "wb" if (apargs.binary or apargs.resume) else "w")
                     fout.write(fetchedcontents)
                     fout.close()
 
@@ -587,7 +882,8 @@ class ALPACAKernel(Kernel):
                 destfn = apargs.destinationfilename
 
                 def sendtofile(filename, contents):
-                    self.dc.sendtofile(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet, contents)
+                    self.dc.sendtofile(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet, contents,
+                                       not apargs.nocompress, apargs.resume, apargs.delta)
 
                 if apargs.source == "<<cellcontents>>":
                     filecontents = cellcontents
@@ -611,19 +907,38 @@ class ALPACAKernel(Kernel):
                     elif os.path.isdir(apargs.source):
                         if apargs.execute:
                             self.sres("Cannot excecute folder\n", 31)
+                        mpybuilt, mpyerrors = { }, { }
+                        if self.mpycrossexe and not apargs.nompy:
+                            mpybuilt, mpyerrors = self.buildmpytree(apargs.source)
+                        dirfiles = [ ]   # (relpath on the device, contents, bbinary)
                         for root, dirs, files in os.walk(apargs.source):
                             for fn in files:
                                 skip = False
                                 fp = os.path.join(root, fn)
                                 relpath = os.path.relpath(fp, apargs.source)
-                                if relpath.endswith('.py'):
-                                    # Check for compiled copy, skip py if exists
-                                    if os.path.exists(fp[:-3] + '.mpy'):
+                                if relpath in mpybuilt:
+                                    # Freshly compiled copy from the build cache goes instead of the source
+                                    dirfiles.append((relpath[:-3] + '.mpy', mpybuilt[relpath], True))
+                                    continue
+                                if relpath.endswith('.py') and relpath not in mpyerrors:
+                                    # Check for compiled copy, skip py if exists and is up to date
+                                    if os.path.exists(fp[:-3] + '.mpy') and not mpycache.mpyoutofdate(fp[:-3] + '.mpy'):
                                         skip = True
+                                if relpath.endswith('.mpy') and ((relpath[:-4] + '.py') in mpybuilt or (relpath[:-4] + '.py') in mpyerrors
+                                                                 or mpycache.mpyoutofdate(fp)):
+                                    skip = True  # stale compiled copy next to the source
                                 if not skip:
-                                    destpath = os.path.join(destfn, relpath).replace('\\', '/')
                                     filecontents = open(os.path.join(root, fn), mode).read()
-                                    sendtofile(destpath, filecontents)
+                                    dirfiles.append((relpath, filecontents, apargs.binary))
+
+                        if apargs.nobundle or apargs.append or apargs.resume or apargs.delta:
+                            for relpath, filecontents, bbinary in dirfiles:
+                                destpath = os.path.join(destfn, relpath).replace('\\', '/')
+                                self.dc.sendtofile(destpath, apargs.mkdir, apargs.append, bbinary, apargs.quiet, filecontents,
+                                                   not apargs.nocompress, apargs.resume, apargs.delta)
+                        else:
+                            self.dc.sendbundle(destfn, [ (relpath, filecontents)  for relpath, filecontents, bbinary in dirfiles ], 
+                                               apargs.quiet, not apargs.nocompress)
             else:
                 self.sres(ap_sendtofile.format_help())
             return cellcontents  # allows for repeat %sendtofile in same cell
@@ -631,32 +946,157 @@ class ALPACAKernel(Kernel):
         self.sres("Unrecognized percentline {}\n".format([percentline]), 31)
         return cellcontents
 
-    def runnormalcell(self, cellcontents, bsuppressendcode):
-        cmdlines = cellcontents.splitlines(True)
-        r = self.dc.workingserialreadall()
-        if r:
-            self.sres('[priorstuff] ')
-            self.sres(str(r))
-
-        for line in cmdlines:
-            if line:
-                if line[-2:] == '\r\n':
-                    line = line[:-2]
-                elif line[-1] == '\n':
-                    line = line[:-1]
-                self.dc.writeline(line)
-                r = self.dc.workingserialreadall()
-                if r:
-                    self.sres('[duringwriting] ')
-                    self.sres(str(r))
-
-                    # if self.sresplotmode == 1:
-                    #    self.sres('Plotting ON')
-                    #    self.sresPLOT(str(r))
-
-        if not bsuppressendcode:
-            self.dc.writebytes(b'\r\x04')
-            self.dc.receivestream(bseekokay=True, isplotting=self.sresplotmode)
+    def selectdevice(self, name):
+        if name not in self.dcs:
+            self.dcs[name] = deviceconnector.DeviceConnector(self.sres, self.sresSYS, self.sresPLOT)
+        self.dc = self.dcs[name]
+        self.dcname = name
+
+    # runs the same cell on each device in its own thread; output comes back through a queue 
+    # so that only this thread talks to the iopub socket, and is tagged with the device name.
+    # Each thread holds back its output until a line is complete and maps its own traceback
+    # line numbers, so that lines from different devices don't get mixed up
+    def broadcastcell(self, names, cellcontents):
+        dcs = [ ]
+        for name in names:
+            if name not in self.dcs or not self.dcs[name].serialexists():
+                self.sres("No connected device named {}\n".format(name), 31)
+            else:
+                dcs.append((name, self.dcs[name]))
+        if not dcs or not cellcontents.strip():
+            return
+
+        linemap = None
+        if self.minifymode:
+            cellcontents, linemap = self.minifycell(cellcontents)
+        outputqueue = queue.Queue()
+
+        def broadcastworker(name, dc):
+            pending = [ ]   # [(output, asciigraphicscode, n04count)] since the last complete line
+            def tsres(output, asciigraphicscode=None, n04count=0, clear_output=False):
+                if n04count and linemap:
+                    output = maptracebacklines(output, linemap)
+                i = output.rfind("\n") + 1
+                if i:
+                    pending.append((output[:i], asciigraphicscode, n04count))
+                    outputqueue.put((name, pending[:]))
+                    pending.clear()
+                if output[i:]:
+                    pending.append((output[i:], asciigraphicscode, n04count))
+            savedsres = (dc.sres, dc.sresSYS, dc.sresPLOT)
+            dc.sres, dc.sresPLOT = tsres, tsres
+            dc.sresSYS = lambda output, clear_output=False: tsres(output, asciigraphicscode=34)
+            try:
+                self.runnormalcell(cellcontents, False, dc=dc, isplotting=0)
+            except Exception as e:
+                tsres("\n{}: {}\n".format(type(e).__name__, str(e)), 31, 1)
+            finally:
+                dc.sres, dc.sresSYS, dc.sresPLOT = savedsres
+                if pending:
+                    outputqueue.put((name, pending))
+                outputqueue.put((name, None))
+
+        threads = [ threading.Thread(target=broadcastworker, args=(name, dc), daemon=True)  for name, dc in dcs ]
+        for thread in threads:
+            thread.start()
+
+        atlinestart = dict((name, True) for name, dc in dcs)
+        nrunning = len(threads)
+        tinterrupted = None
+        while nrunning:
+            try:
+                name, pieces = outputqueue.get(timeout=serialtimeout)
+            except queue.Empty:
+                if tinterrupted and time.time() - tinterrupted > 5:
+                    self.sres("\nGave up waiting for {} devices\n".format(nrunning), 31)
+                    break
+                continue
+            except KeyboardInterrupt:
+                self.sresSYS("\n\n*** Sending Ctrl-C to {}\n\n".format(", ".join(name for name, dc in dcs)))
+                for name, dc in dcs:
+                    dc.writebytes(b'\r\x03')
+                tinterrupted = time.time()
+                continue
+            if pieces is None:
+                nrunning -= 1
+                if not atlinestart[name]:   # the device's last line, so end it before the others carry on
+                    self.sres("\n")
+                    atlinestart[name] = True
+                continue
+            for output, asciigraphicscode, n04count in pieces:
+                taggedoutput = [ ]
+                for line in output.splitlines(True):
+                    if atlinestart[name]:
+                        taggedoutput.append("[{}] ".format(name))
+                    taggedoutput.append(line)
+                    atlinestart[name] = (line[-1:] == "\n")
+                self.sres("".join(taggedoutput), asciigraphicscode=asciigraphicscode, n04count=n04count)
+
+    def buildmpytree(self, sourcedir):
+        buildcache = mpycache.MpyBuildCache(self.mpycrossexe, ["-march=" + self.mpycrossarch] if self.mpycrossarch else [])
+        t0 = time.time()
+        mpybuilt, errors, ncachehits = buildcache.buildtree(sourcedir)
+        self.sresSYS("mpy-cross: {} modules ({} unchanged) in {:.2f}s\n".format(len(mpybuilt) + len(errors), ncachehits,
+                                                                                time.time() - t0))
+        for relpath, error in errors.items():
+            self.sres("{} not compiled, sending source:\n{}\n".format(relpath, error), 31)
+        return mpybuilt, errors
+
+    # returns False if the cell couldn't be compiled, so should be sent as source
+    def runbytecodecell(self, cellcontents, isplotting, suffix=""):
+        if not self.mpycrossexe:
+            return False
+        if mpycache.declaresglobals(cellcontents):
+            self.sres("[global statement in the cell, sending source]\n", 31)
+            return False
+        buildcache = mpycache.MpyBuildCache(self.mpycrossexe, ["-march=" + self.mpycrossarch] if self.mpycrossarch else [])
+        mpybytes, error, bcachehit = buildcache.compile((devicehelpers.mpycellprefix + cellcontents).encode(), "<cell>")
+        if mpybytes is None:
+            self.sres("[mpy-cross failed, sending source]\n{}\n".format(error.rstrip()), 31)
+            return False
+        linemap = self.sreslinemap or (lambda n: n)
+        self.sreslinemap = lambda n: linemap(n - devicehelpers.mpycellprefix.count("\n"))
+        self.dc.runmpycell(mpybytes, isplotting=isplotting, suffix=suffix)
+        return True
+
+    def runheapcell(self, cellcontents, isplotting, suffix=""):
+        res = self.dc.runheapcell(cellcontents, self.heapmode["collect"], self.heapmode["meminfo"], isplotting=isplotting, suffix=suffix)
+        if res is None:
+            self.sres("[no heap reading came back]\n", 31)
+            return
+        freebefore, allocbefore, free, alloc = res
+        record = { "execution_count":self.execution_count, "time":time.time(), "device":self.dcname,
+                   "free_before":freebefore, "alloc_before":allocbefore, "free":free, "alloc":alloc }
+        self.lastheap = record
+        self.heaphistory.append(record)
+        del self.heaphistory[:-timinghistorylength]
+        threshold = self.heapmode["threshold"] or (free + alloc)//10
+        if free < threshold:
+            self.sres("[free heap down to {} of {} bytes, below {}]\n".format(free, free + alloc, threshold), 31)
+
+    # returns the minified cell and the function taking its line numbers back to the cell as written
+    def minifycell(self, cellcontents):
+        minified, linemap = minify.minifysource(cellcontents)
+        self.sresSYS("[minified {} -> {} bytes, {} saved]\n".format(len(cellcontents), len(minified), len(cellcontents) - len(minified)))
+        return minified, (lambda n: linemap[n-1] if 0 < n <= len(linemap) else n)
+
+    def runnormalcell(self, cellcontents, bsuppressendcode, dc=None, isplotting=None):
+        if self.minifymode and dc is None:   # a broadcast cell is minified once before it goes to the threads
+            cellcontents, self.sreslinemap = self.minifycell(cellcontents)
+        # the user_expressions are evaluated by the same program as the cell, after it
+        suffix = self.dc.userexpressionsprogram(self.userexpressions)  if (self.userexpressions and not bsuppressendcode and dc is None)  else ""
+        if self.heapmode and not bsuppressendcode and dc is None:
+            self.runheapcell(cellcontents, self.sresplotmode if isplotting is None else isplotting, suffix)
+            return
+        if self.cellcachesize and not bsuppressendcode and len(cellcontents) >= self.cellcacheminbytes:
+            (dc or self.dc).runcachedcell(cellcontents, self.cellcachesize,
+                                          isplotting=(self.sresplotmode if isplotting is None else isplotting), suffix=suffix)
+            return
+        if self.bytecodemode and not bsuppressendcode and dc is None:
+            if self.runbytecodecell(cellcontents, self.sresplotmode if isplotting is None else isplotting, suffix):
+                return
+        (dc or self.dc).runsourcecell(cellcontents, isplotting=(self.sresplotmode if isplotting is None else isplotting),
+                                      suffix=suffix, bsuppressendcode=bsuppressendcode)
 
     def sendcommand(self, cellcontents):
         bsuppressendcode = False  # can't yet see how to get this signal through
@@ -688,6 +1128,8 @@ class ALPACAKernel(Kernel):
         # run the cell contents as normal
         if cellcontents:
             self.runnormalcell(cellcontents, bsuppressendcode)
+            if self.userexpressions:
+                self.userexpressionresults = userexpressionsreply(self.dc.userexpressionresults())
         return None
 
     def sresSYS(self, output, clear_output=False):  # system call
@@ -715,6 +1157,8 @@ class ALPACAKernel(Kernel):
 
         if clear_output:  # used when updating lines printed
             self.send_response(self.iopub_socket, 'clear_output', {"wait": True})
+        if n04count and self.sreslinemap:
+            output = maptracebacklines(output, self.sreslinemap)
         if asciigraphicscode:
             output = "\x1b[{}m{}\x1b[0m".format(asciigraphicscode, output)
 
@@ -792,26 +1236,7 @@ class ALPACAKernel(Kernel):
 
                 try:  # Normal plot, no settings
                     output = output.replace(PLOT_PREFIX, '')
-                    kk = output.rfind('}')
-                    settings = output[:kk + 1]
-                    data = output[kk + 1:]
-
-                    settings = ast.literal_eval(settings)
-
-                    ii = data.find('], [')
-                    xx_hex_data, yy_hex_data = (data[2: ii], data[ii + 4:data.rfind(']') - 1])
-
-                    xx_returned_data = bytearray(binascii.unhexlify(xx_hex_data))
-                    yy_returned_data = bytearray(binascii.unhexlify(yy_hex_data))
-
-                    try:
-                        yy_shape_string = data[data.rfind('('):]
-                        yy_shape = ast.literal_eval(yy_shape_string)
-                    except Exception as e:
-                        raise RuntimeError(f'Couldn\'t read shape from string: {yy_shape_string}') from e
-
-                    self.xx = np.frombuffer(xx_returned_data, dtype=np.float32)
-                    self.yy = np.frombuffer(yy_returned_data, dtype='f').reshape(yy_shape)
+                    settings, self.xx, self.yy = unpack_plot_data(output)
 
                 except Exception as e:
                     # Incorrect formatting, this should not happen when using
@@ -1057,11 +1482,54 @@ class ALPACAKernel(Kernel):
             return plot_uuid  # Return new UUID for futre reference
             # logging.debug(f'Created new display data')
 
+    # wraps a method so the time spent in it adds up in self.celltiming[key]
+    def timedcall(self, key, f):
+        def timedf(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.celltiming[key] = self.celltiming.get(key, 0.0) + time.perf_counter() - t0
+        return timedf
+
+    def recordtiming(self, tstart, status):
+        tend = time.perf_counter()
+        stats = self.dc.stats
+        def since(t, tref):
+            return round(t - tref, 6)  if (t is not None and tref is not None)  else None
+        record = { "execution_count":self.execution_count, "time":time.time(), "device":self.dcname, "status":status,
+                   "total":round(tend - tstart, 6),
+                   "preprocess":since(stats["tfirstwrite"], tstart),    # magics, minify, compiling etc before anything is sent
+                   "byteswritten":stats["byteswritten"], "nwrites":stats["nwrites"], "writetime":round(stats["writetime"], 6),
+                   "firstbyte":since(stats["tfirstbyte"], stats["tfirst04"]),
+                   "execution":since(stats["tdone"], stats["tfirst04"]),  # from the first \x04 to the last >
+                   "bytesread":stats["bytesread"],
+                   "sresplot":round(self.celltiming.get("sresplot", 0.0), 6),   # includes any sendPLOT for live plots
+                   "sendplot":round(self.celltiming.get("sendplot", 0.0), 6) }
+        self.lasttiming = record
+        self.timinghistory.append(record)
+        del self.timinghistory[:-timinghistorylength]
+
+    # the timing and heap readings of the cell go in the execute_reply metadata
+    def finish_metadata(self, parent, metadata, reply_content):
+        metadata = Kernel.finish_metadata(self, parent, metadata, reply_content)
+        if self.lasttiming and self.lasttiming["execution_count"] == self.execution_count:
+            metadata["alpaca_timing"] = self.lasttiming
+        if self.lastheap and self.lastheap["execution_count"] == self.execution_count:
+            metadata["alpaca_heap"] = self.lastheap
+        return metadata
+
     def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
         self.silent = silent
+        self.sreslinemap = None
+        self.userexpressions = user_expressions or { }
+        self.userexpressionresults = { }
         if not code.strip():
             return {'status': 'ok', 'execution_count': self.execution_count, 'payload': [], 'user_expressions': {}}
 
+        tstart = time.perf_counter()
+        self.celltiming = { "sresplot":0.0, "sendplot":0.0 }
+        self.dc.resetstats()
         interrupted = False
 
         # clear buffer out before executing any commands (except the readbytes one)
@@ -1139,10 +1607,13 @@ class ALPACAKernel(Kernel):
                     self.sres("\n\nKeyboard interrupt while waiting response on Ctrl-C\n\n")
                 except OSError as e:
                     self.sres("\n\n***OSError while issuing a Ctrl-C [%s]\n\n" % str(e.strerror))
+            self.recordtiming(tstart, "abort")
             return {'status': 'abort', 'execution_count': self.execution_count}
 
         # everything already gone out with send_response(), but could detect errors (text between the two \x04s
 
         payload = [
             set_next_input_payload] if set_next_input_payload else []  # {"source": "set_next_input", "text": "some cell content", "replace": False}
-        return {'status': 'ok', 'execution_count': self.execution_count, 'payload': payload, 'user_expressions': {}}
+        self.recordtiming(tstart, "ok")
+        return {'status': 'ok', 'execution_count': self.execution_count, 'payload': payload,
+                'user_expressions': self.userexpressionresults}
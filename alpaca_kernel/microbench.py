@@ -0,0 +1,171 @@
+"""Timings of the kernel's parsing hot paths on synthetic but realistic input.
+
+Run as ``python -m alpaca_kernel.microbench``.  ``yieldserialchunk`` and ``receivestream`` are fed raw REPL
+streams of many short lines, long base64 runs (as fetchfile gets), plot packets and ESP32 wifi log noise;
+the plotparse functions get the strings the plot modes see.  Each case reports calls per second, the input
+rate where there is one, and the peak bytes allocated during a call (tracemalloc).  --output and --compare
+work as in alpaca_kernel.benchmark.
+"""
+
+import argparse
+import binascii
+import json
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+import serial
+
+from . import deviceconnector
+from . import plotparse
+from . import wiretrace
+from .benchmark import comparisontable
+
+microbenchfile = "alpacamicrobench.jsonl"
+
+
+# what the device sends back for a program printing these lines: OK, stdout, \x04, no error, \x04, >
+def replystream(lines):
+    return b"OK" + b"".join(lines) + b"\x04\x04>"
+
+def shortlines(n=2000):
+    return [ b"%d\r\n" % i  for i in range(n) ]
+
+def base64lines(n=500, rng=random.Random(1)):
+    res = [ ]
+    for i in range(n):
+        chunk = bytes(rng.getrandbits(8)  for j in range(deviceconnector.transferchunksize))
+        res.append(b"%08x " % binascii.crc32(chunk) + binascii.b2a_base64(chunk).rstrip() + b"\r\n")
+    return res
+
+def plotpacket(npoints=200, nlines=2):
+    xx = np.arange(npoints, dtype=np.float32)
+    yy = np.sin(np.arange(npoints*nlines, dtype=np.float32)/10).reshape((nlines, npoints))
+    return "{}{{'fmt': 'r-', 'label': 'sin'}}[[{}], [{}]]{}".format(plotparse.PLOT_PREFIX, binascii.hexlify(xx.tobytes()).decode(),
+                                                                binascii.hexlify(yy.tobytes()).decode(), str(yy.shape))
+
+def thonnyline(i=7):
+    return "Random walk: {} just random: {:.3f} sine: {:.4f}".format(i, (i*37 % 101)/7, np.sin(i/10))
+
+def wifinoiselines(n=1000):
+    res = [ ]
+    for i in range(n):
+        if i%4 == 0:
+            res.append(b"\x1b[0;32mI (%d) wifi: state: run -> auth (b0)\x1b[0m\r\n" % (1000+i))
+        else:
+            res.append(b"reading %d %d\r\n" % (i, i*i))
+    return res
+
+
+# the bytes of a stream one read() at a time, as serial.Serial gives them
+class StreamSerial(serial.Serial):
+    def __init__(self, data):
+        self.data = data
+        self.i = 0
+        self.is_open = True
+
+    def read(self, size=1):
+        if self.i >= len(self.data):
+            raise serial.SerialException("end of stream")
+        res = self.data[self.i:self.i+size]
+        self.i += size
+        return res
+
+
+def chunkall(stream):
+    return sum(1  for rline in deviceconnector.yieldserialchunk(StreamSerial(stream)))
+
+def nullsres(output, *args, **kwargs):
+    pass
+
+def receiveall(stream):
+    dc = deviceconnector.DeviceConnector(nullsres, nullsres, nullsres)
+    dc.workingserial = wiretrace.ReplaySerial([ (wiretrace.traceread, 0.0, stream) ])
+    return dc.receivestream(bseekokay=True, isplotting=1)
+
+
+def benchcases():
+    cases = [ ]   # (name, function, argument, bytes of input per call or None)
+    for streamname, lines in [("shortlines", shortlines()), ("base64", base64lines()), ("wifinoise", wifinoiselines())]:
+        stream = replystream(lines)
+        cases.append(("yieldserialchunk_" + streamname, chunkall, stream, len(stream)))
+        cases.append(("receivestream_" + streamname, receiveall, stream, len(stream)))
+    packetstream = replystream([ plotpacket().encode() + b"\r\n"  for i in range(50) ])
+    cases.append(("receivestream_plotpackets", receiveall, packetstream, len(packetstream)))
+
+    packet = plotpacket()
+    cases.append(("unpack_plot_data", plotparse.unpack_plot_data, packet.replace(plotparse.PLOT_PREFIX, ''), len(packet)))
+    arraystring = str([ [ round(x*0.1, 3)  for x in range(50) ]  for i in range(4) ])
+    cases.append(("string_to_numpy", plotparse.string_to_numpy, arraystring, len(arraystring)))
+    cases.append(("string_is_array", plotparse.string_is_array, arraystring, len(arraystring)))
+    cases.append(("unpack_Thonny_string", plotparse.unpack_Thonny_string, thonnyline(), None))
+    return cases
+
+
+# returns (calls per second, peak bytes allocated during one call)
+def measure(f, arg, mintime=0.2, repeat=3):
+    timer = timeit.Timer(lambda: f(arg))
+    number, seconds = timer.autorange()
+    number = max(1, int(number*mintime/max(seconds, 1e-9)))
+    best = min(timer.repeat(repeat=repeat, number=number))/number
+
+    tracemalloc.start()
+    try:
+        f(arg)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        f(arg)
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    return 1/best, peak
+
+
+def runmicrobenchmarks(namefilter=""):
+    results, rows = { }, [ ]
+    for name, f, arg, nbytes in benchcases():
+        if namefilter not in name:
+            continue
+        opspersecond, peak = measure(f, arg)
+        results[name + "_ops_per_s"] = opspersecond
+        rows.append((name, opspersecond, nbytes, peak))
+    return results, rows
+
+
+def resultstable(rows):
+    lines = [ "{:<36} {:>12} {:>10} {:>9} {:>10}\n".format("", "calls/s", "us/call", "MB/s", "peak kB") ]
+    for name, opspersecond, nbytes, peak in rows:
+        mbps = "{:9.2f}".format(opspersecond*nbytes/1e6)  if nbytes  else "        -"
+        lines.append("{:<36} {:12.1f} {:10.1f} {} {:10.1f}\n".format(name, opspersecond, 1e6/opspersecond, mbps, peak/1000))
+    return "".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the kernel's stream and plot parsing")
+    parser.add_argument('--filter', type=str, default="", help="only the cases whose name contains this")
+    parser.add_argument('--output', type=str, default=microbenchfile, help="JSON lines file the results are appended to")
+    parser.add_argument('--compare', type=str, help="results file whose last run to compare with")
+    args = parser.parse_args(argv)
+
+    results, rows = runmicrobenchmarks(args.filter)
+    print(resultstable(rows), end="")
+
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as fin:
+            lines = [ line  for line in fin  if line.strip() ]
+        if lines:
+            print()
+            print(comparisontable(results, json.loads(lines[-1])["results"]), end="")
+
+    if args.output:
+        with open(args.output, "a") as fout:
+            fout.write(json.dumps({ "time":time.time(), "python":sys.version.split()[0], "results":results }) + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Shrinks cell source before it goes down a slow link.
+
+Comments, docstrings and blank lines are dropped and indentation becomes one space per level.
+The text of each remaining line is otherwise left alone, so nothing inside strings or brackets changes,
+and the returned line map takes line numbers in device tracebacks back to the cell as written.
+"""
+
+import io
+import token
+import tokenize
+
+STRINGSTARTS = { token.STRING, getattr(token, "FSTRING_START", None) }
+STRINGENDS = { token.STRING, getattr(token, "FSTRING_END", None) }
+
+
+# returns (minified source, [original line number of each minified line])
+# the source comes back unchanged if it doesn't tokenize
+def minifysource(source):
+    lines = source.splitlines(True)
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return source, list(range(1, len(lines)+1))
+
+    cuts = { }             # row -> [(startcol, endcol)] of text to remove (endcol None for end of line)
+    instring = set()       # rows that start inside a multi-line string, to be kept verbatim
+    endinstring = set()    # rows that end inside a multi-line string, so keep their trailing spaces
+    replacements = { }     # row -> text replacing the whole line (an emptied block needs a pass)
+    indentlevel = { }      # row -> indent level of the logical line starting there
+
+    level = 0
+    blocks = [ ]            # [row of its first statement, whether any statement in it is kept] for each open block
+    bstatementstart = True  # the next token begins a statement
+    stringstart = None      # (row, began a statement) for the string being read
+    for i, tok in enumerate(tokens):
+        (srow, scol), (erow, ecol) = tok.start, tok.end
+        if tok.type in (tokenize.COMMENT, tokenize.NL):
+            if tok.type == tokenize.COMMENT:
+                cuts.setdefault(srow, [ ]).append((scol, None))
+            continue
+        if tok.type == token.INDENT:
+            level += 1
+            blocks.append([ None, False ])
+        elif tok.type == token.DEDENT:
+            level -= 1
+            firstrow, bkept = blocks.pop()
+            if not bkept and firstrow is not None:
+                replacements[firstrow] = "pass"   # every statement in the block was a docstring
+        elif bstatementstart and tok.type not in (token.NEWLINE, token.ENDMARKER):
+            indentlevel[srow] = level
+            if blocks:
+                if blocks[-1][0] is None:
+                    blocks[-1][0] = srow
+                if tok.type not in STRINGSTARTS:
+                    blocks[-1][1] = True
+
+        if tok.type in STRINGSTARTS and stringstart is None:
+            stringstart = (srow, bstatementstart)
+        if tok.type in STRINGENDS and stringstart is not None:
+            stringstartrow, bstringstatement = stringstart
+            if erow > stringstartrow:
+                instring.update(range(stringstartrow+1, erow+1))
+                endinstring.update(range(stringstartrow, erow))
+
+            # a statement consisting only of a string is a docstring (or as good as one)
+            following = [ t.type  for t in tokens[i+1:i+40]  if t.type not in (tokenize.COMMENT, tokenize.NL) ]
+            if bstringstatement and following and following[0] in (token.NEWLINE, token.ENDMARKER):
+                for row in range(stringstartrow, erow+1):
+                    replacements[row] = ""
+                    instring.discard(row)
+            elif bstringstatement and blocks:
+                blocks[-1][1] = True
+            stringstart = None
+
+        bstatementstart = tok.type in (token.NEWLINE, token.INDENT, token.DEDENT)
+
+    res, linemap = [ ], [ ]
+    for row, line in enumerate(lines, 1):
+        if row in replacements:
+            newline = replacements[row]
+        else:
+            newline = line.rstrip("\r\n")
+            for startcol, endcol in sorted(cuts.get(row, [ ]), reverse=True):
+                newline = newline[:startcol] + (newline[endcol:] if endcol is not None else "")
+        if row not in endinstring:
+            newline = newline.rstrip()
+        if row not in instring and newline.strip():
+            newline = " "*indentlevel.get(row, 0) + newline.lstrip()
+        if newline.strip() or row in instring:
+            res.append(newline)
+            linemap.append(row)
+    return "\n".join(res) + ("\n" if res else ""), linemap
@@ -0,0 +1,140 @@
+"""Content-addressed cache of mpy-cross output, with the compiles of a source tree run in parallel.
+
+Entries are keyed by (source hash, mpy-cross version, arch flags) so a changed file, compiler or target
+always rebuilds, and an unchanged tree costs one hash per file.  Least recently used entries are evicted.
+"""
+
+import hashlib
+import io
+import os
+import subprocess
+import tempfile
+import tokenize
+from concurrent.futures import ThreadPoolExecutor
+
+from .deviceconnector import alpacacachedir
+
+mpycachemaxbytes = 64*1024*1024
+
+# files that the device runs by name at boot, so must stay as .py
+mpyskipfiles = ("boot.py", "main.py")
+
+mpycrossversions = { }   # (exe, mtime) -> version string
+
+
+# a .mpy beside a .py that has been saved since it was compiled
+def mpyoutofdate(mpyfile):
+    pyfile = mpyfile[:-4] + ".py"
+    return os.path.exists(pyfile) and os.path.getmtime(pyfile) > os.path.getmtime(mpyfile)
+
+
+# a %bytecode cell runs as an imported module, so a global statement would refer to that module's
+# globals and not the REPL's; such cells (and ones that don't tokenize) are sent as source instead
+def declaresglobals(source):
+    try:
+        return any(tok.type == tokenize.NAME and tok.string == "global"
+                   for tok in tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return True
+
+
+def mpycrossversion(mpycrossexe):
+    try:
+        key = (mpycrossexe, os.path.getmtime(mpycrossexe))
+    except OSError:
+        key = (mpycrossexe, None)
+    if key not in mpycrossversions:
+        try:
+            res = subprocess.run([mpycrossexe, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10)
+            mpycrossversions[key] = res.stdout.decode(errors="replace").strip()
+        except (OSError, subprocess.TimeoutExpired):
+            mpycrossversions[key] = ""
+    return mpycrossversions[key]
+
+
+class MpyBuildCache:
+    def __init__(self, mpycrossexe, archflags=(), cachedir=None, maxbytes=mpycachemaxbytes):
+        self.mpycrossexe = mpycrossexe
+        self.archflags = list(archflags)
+        self.cachedir = cachedir or alpacacachedir("mpy")
+        self.maxbytes = maxbytes
+        self.version = mpycrossversion(mpycrossexe)
+
+    def cachekey(self, source, sourcename):
+        h = hashlib.sha256()
+        h.update(self.version.encode())
+        h.update(b"\0" + " ".join(self.archflags).encode() + b"\0")
+        h.update(sourcename.encode() + b"\0")   # it ends up in the tracebacks
+        h.update(source)
+        return h.hexdigest()
+
+    # returns (mpybytes or None, error text, bcachehit)
+    def compile(self, source, sourcename):
+        cachefile = os.path.join(self.cachedir, self.cachekey(source, sourcename) + ".mpy")
+        try:
+            with open(cachefile, "rb") as fin:
+                mpybytes = fin.read()
+            os.utime(cachefile)   # mtime marks it as recently used
+            return mpybytes, "", True
+        except OSError:
+            pass
+
+        with tempfile.TemporaryDirectory() as td:
+            pyfile = os.path.join(td, "source.py")   # sourcename only goes in the .mpy, it may not be a valid file name
+            with open(pyfile, "wb") as fout:
+                fout.write(source)
+            mpyfile = pyfile[:-3] + ".mpy"
+            pargs = [self.mpycrossexe] + self.archflags + ["-s", sourcename, "-o", mpyfile, pyfile]
+            try:
+                res = subprocess.run(pargs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError as e:
+                return None, str(e), False
+            if res.returncode != 0 or not os.path.exists(mpyfile):
+                return None, res.stdout.decode(errors="replace"), False
+            with open(mpyfile, "rb") as fin:
+                mpybytes = fin.read()
+
+        with open(cachefile + ".tmp", "wb") as fout:
+            fout.write(mpybytes)
+        os.replace(cachefile + ".tmp", cachefile)
+        return mpybytes, "", False
+
+    # cross-compiles every .py under sourcedir; returns ({relpath: mpybytes}, {relpath: error}, ncachehits)
+    def buildtree(self, sourcedir, maxworkers=None):
+        relpaths = [ ]
+        for root, dirs, files in os.walk(sourcedir):
+            for fn in files:
+                if fn.endswith(".py") and fn not in mpyskipfiles:
+                    relpaths.append(os.path.relpath(os.path.join(root, fn), sourcedir))
+
+        def compilerelpath(relpath):
+            with open(os.path.join(sourcedir, relpath), "rb") as fin:
+                source = fin.read()
+            return self.compile(source, relpath.replace("\\", "/"))
+
+        # each worker only waits on its mpy-cross process, so threads are enough to keep the cores busy
+        with ThreadPoolExecutor(max_workers=maxworkers or os.cpu_count() or 4) as executor:
+            results = list(executor.map(compilerelpath, relpaths))
+
+        built, errors, ncachehits = { }, { }, 0
+        for relpath, (mpybytes, error, bcachehit) in zip(relpaths, results):
+            if mpybytes is None:
+                errors[relpath] = error
+            else:
+                built[relpath] = mpybytes
+                ncachehits += bcachehit
+        self.evict()
+        return built, errors, ncachehits
+
+    def evict(self):
+        entries = [ ]
+        for fn in os.listdir(self.cachedir):
+            if fn.endswith(".mpy"):
+                st = os.stat(os.path.join(self.cachedir, fn))
+                entries.append((st.st_mtime, st.st_size, fn))
+        entries.sort(reverse=True)
+        total = 0
+        for mtime, size, fn in entries:
+            total += size
+            if total > self.maxbytes:
+                os.remove(os.path.join(self.cachedir, fn))
@@ -0,0 +1,845 @@
+"""A stand-in MicroPython board, for running the kernel (and its benchmarks) without hardware.
+
+``SimulatedDevice`` acts out the REPL of a board on top of CPython: the friendly REPL with its banner,
+Ctrl-A raw REPL (``OK``, output, ``\\x04``, traceback, ``\\x04``, ``>``), raw-paste, Ctrl-E paste mode,
+Ctrl-C interrupts and Ctrl-D soft reboots.  Cells run with their own globals, a filesystem rooted in a
+directory on the PC, and small ``os``/``sys``/``time``/``gc``/``micropython``/``ubinascii``/``deflate``/``select``
+modules standing in for the firmware's.  What needs real hardware (``machine`` pins, ``os.mount``, .mpy imports) isn't there.
+
+Run as ``python -m alpaca_kernel.simulator`` it serves the board on a pseudo-terminal for ``%serialconnect``,
+a TCP port for ``%socketconnect`` and a WebREPL port for ``%websocketconnect``, with each direction held to
+the given baud rate and latency.  The first line printed is ``ALPACASIM {json}`` with where to find it.
+"""
+
+import argparse
+import base64
+import binascii
+import builtins
+import codeop
+import ctypes
+import errno
+import gc
+import hashlib
+import json
+import os
+import posixpath
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+import types
+import zlib
+
+simversion = (1, 22, 0)
+simheapsize = 111168      # bytes of GC heap reported by gc.mem_free()+gc.mem_alloc(), as on an ESP32
+rawpastewindow = 128      # bytes the host can send in raw-paste mode before waiting for a \x01
+simpollinterval = 0.05    # blocking waits wake up this often so a Ctrl-C can get in
+
+webreplpassword = "alpaca"
+webreplfile = "<2sBBQLH64s"   # same request header as deviceconnector.webreplfile
+
+
+class SoftReset(BaseException):
+    pass
+
+
+# the stdout of the device: text gets \n turned into \r\n as the firmware does, .buffer writes raw bytes
+class DeviceStdout:
+    def __init__(self, device):
+        self.device = device
+        self.buffer = types.SimpleNamespace(write=self.writebytes)
+
+    def write(self, s):
+        self.device.write(s.encode("utf8").replace(b"\n", b"\r\n"))
+        return len(s)
+
+    def writebytes(self, b):
+        self.device.write(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+
+class DeviceStdin:
+    def __init__(self, device):
+        self.device = device
+        self.buffer = types.SimpleNamespace(read=self.device.getbytes, readinto=self.readinto)
+
+    def read(self, n=1):
+        return self.device.getbytes(n).decode("utf8", "replace")
+
+    def readinto(self, buf):
+        data = self.device.getbytes(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        res = bytearray()
+        while res[-1:] != b"\n":
+            res.extend(self.device.getbytes(1))
+        return res.decode("utf8", "replace")
+
+
+# deflate.DeflateIO of recent firmware, for the compressed transfers
+class DeflateIO:
+    RAW, ZLIB, GZIP, AUTO = 1, 2, 3, 0
+
+    def __init__(self, stream, format=AUTO, wbits=0, close=False):
+        self.stream = stream
+        self.bclose = close
+        wbits = wbits or 15
+        self.wbits = { self.RAW:-wbits, self.ZLIB:wbits, self.GZIP:16+wbits, self.AUTO:32+wbits }[format]
+        self.decompressor = None
+        self.compressor = None
+        self.pending = b""
+
+    def read(self, n=-1):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj(self.wbits)
+        res = bytearray(self.pending)
+        while n < 0 or len(res) < n:
+            data = self.decompressor.unconsumed_tail or self.stream.read(256)
+            if not data:
+                res.extend(self.decompressor.flush())
+                break
+            res.extend(self.decompressor.decompress(data, max(n - len(res), 0) if n >= 0 else 0))
+        if n >= 0:
+            self.pending = bytes(res[n:])
+            del res[n:]
+        else:
+            self.pending = b""
+        return bytes(res)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(9, zlib.DEFLATED, self.wbits if self.wbits < 32 else self.wbits - 32)
+        self.stream.write(self.compressor.compress(bytes(data)))
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.stream.write(self.compressor.flush())
+        if self.bclose:
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SimulatedDevice:
+    def __init__(self, root, output, heapsize=simheapsize):
+        self.root = os.path.abspath(root)
+        self.output = output          # takes the bytes the device sends
+        self.heapsize = heapsize
+        self.inbuffer = bytearray()
+        self.incondition = threading.Condition()
+        self.executing = False        # Ctrl-C only interrupts while a program is running
+        self.executinglock = threading.Lock()
+        self.thread = None
+        self.mode = "friendly"
+        self.kbdintr = 3
+        self.nexecuted = 0
+        self.newinterpreter()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if data:
+            self.output(data)
+
+    # bytes arriving from the host; the interrupt character is acted on straight away, as the UART interrupt does
+    def feed(self, data):
+        with self.executinglock:
+            if self.executing and self.kbdintr is not None and bytes([self.kbdintr]) in data:
+                data = data.replace(bytes([self.kbdintr]), b"")
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.thread.ident), ctypes.py_object(KeyboardInterrupt))
+        with self.incondition:
+            self.inbuffer.extend(data)
+            self.incondition.notify_all()
+
+    def waitinput(self, timeout=None):
+        tend = None if timeout is None else time.time() + timeout
+        with self.incondition:
+            while not self.inbuffer:
+                if tend is not None and time.time() >= tend:
+                    return False
+                self.incondition.wait(simpollinterval)
+        return True
+
+    # blocks until n bytes have come
+    def getbytes(self, n):
+        res = bytearray()
+        while len(res) < n:
+            self.waitinput()
+            with self.incondition:
+                k = min(n - len(res), len(self.inbuffer))
+                res.extend(self.inbuffer[:k])
+                del self.inbuffer[:k]
+        return bytes(res)
+
+    def getbyte(self):
+        return self.getbytes(1)[0]
+
+    # device path to a path under root that can't climb out of it
+    def localpath(self, path):
+        path = path.decode() if type(path) == bytes else str(path)
+        devicepath = posixpath.normpath(posixpath.join(self.cwd, path))
+        return os.path.join(self.root, *[ p  for p in devicepath.split("/")  if p ])
+
+    def banner(self):
+        return ("MicroPython v{}.{}.{} on 2024-01-01; alpaca simulator with CPython {}\r\n".format(*simversion, sys.version.split()[0]) +
+                'Type "help()" for more information.\r\n').encode()
+
+    # fresh globals, modules and working directory, as after a soft reboot
+    def newinterpreter(self):
+        self.cwd = "/"
+        self.kbdintr = 3
+        self.stdout = DeviceStdout(self)
+        self.stdin = DeviceStdin(self)
+        self.builtins = dict(vars(builtins))
+        self.builtins.update(open=self.open, print=self.print, input=self.input, __import__=self.importmodule)
+        self.mainmodule = types.ModuleType("__main__")
+        self.globals = self.mainmodule.__dict__
+        self.globals["__builtins__"] = self.builtins
+        self.modules = { "__main__":self.mainmodule }
+        self.firmwaremodules = self.makefirmwaremodules()
+        self.modules.update(self.firmwaremodules)
+        gc.collect()
+        self.heapbaseline = tracemalloc.get_traced_memory()[0]  # so the heap starts empty on each soft reboot
+
+    def softreset(self):
+        self.write(b"MPY: soft reboot\r\n")
+        self.newinterpreter()
+        for bootfile in (["boot.py", "main.py"]  if self.mode == "friendly"  else ["boot.py"]):
+            if os.path.isfile(self.localpath("/" + bootfile)):
+                with open(self.localpath("/" + bootfile), "rb") as fin:
+                    error, breset = self.execute(fin.read(), "exec", sourcename=bootfile)
+                self.write(error)
+
+    def open(self, file, mode="r", *args, **kwargs):
+        if "b" not in mode:
+            kwargs.setdefault("newline", "")   # the firmware doesn't translate line endings
+        return builtins.open(self.localpath(file), mode, *args, **kwargs)
+
+    def print(self, *args, sep=" ", end="\n", file=None):
+        (file or self.stdout).write(sep.join(map(str, args)) + end)
+
+    def input(self, prompt=""):
+        self.stdout.write(prompt)
+        line = bytearray()
+        while True:
+            c = self.getbyte()
+            if c == 0x0d:
+                self.write(b"\r\n")
+                return line.decode("utf8", "replace")
+            if c != 0x0a:
+                line.append(c)
+                self.write(bytes([c]))
+
+    def importmodule(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0 and name in self.modules:
+            return self.modules[name]
+        if level == 0 and "." not in name:
+            for d in self.modules["sys"].path:
+                for fn in (name + ".py", name + "/__init__.py"):
+                    localfile = self.localpath(posixpath.join(d or self.cwd, fn))
+                    if os.path.isfile(localfile):
+                        module = types.ModuleType(name)
+                        module.__file__ = posixpath.join(d, fn)
+                        module.__dict__["__builtins__"] = self.builtins
+                        self.modules[name] = module
+                        with open(localfile, "rb") as fin:
+                            source = fin.read()
+                        try:
+                            exec(compile(source, module.__file__, "exec"), module.__dict__)
+                        except BaseException:
+                            del self.modules[name]
+                            raise
+                        return module
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    # modules of the firmware that the kernel and its device helpers rely on
+    def makefirmwaremodules(self):
+        device = self
+        def module(name, **attrs):
+            m = types.ModuleType(name)
+            m.__dict__.update(attrs)
+            return m
+
+        def stat(path):
+            st = os.stat(self.localpath(path))
+            mode = 0x4000 if os.path.isdir(self.localpath(path)) else 0x8000
+            return (mode, 0, 0, 0, 0, 0, (0 if mode == 0x4000 else st.st_size), int(st.st_atime), int(st.st_mtime), int(st.st_ctime))
+        def ilistdir(path="."):
+            for name in sorted(os.listdir(self.localpath(path))):
+                st = stat(posixpath.join(path, name))
+                yield (name, st[0], 0, st[6])
+        def chdir(path):
+            if not os.path.isdir(self.localpath(path)):
+                raise OSError(errno.ENOENT)
+            device.cwd = posixpath.normpath(posixpath.join(device.cwd, path))
+        def mount(*args, **kwargs):
+            raise OSError(errno.EPERM)
+        def uname():
+            return types.SimpleNamespace(sysname="simulator", nodename="simulator", release="{}.{}.{}".format(*simversion),
+                                         version="v{}.{}.{} alpaca simulator".format(*simversion), machine="CPython")
+        uos = module("os", sep="/",
+                     listdir=lambda path=".": sorted(os.listdir(self.localpath(path))), ilistdir=ilistdir, stat=stat,
+                     mkdir=lambda path: os.mkdir(self.localpath(path)), rmdir=lambda path: os.rmdir(self.localpath(path)),
+                     remove=lambda path: os.remove(self.localpath(path)), unlink=lambda path: os.remove(self.localpath(path)),
+                     rename=lambda a, b: os.replace(self.localpath(a), self.localpath(b)),
+                     getcwd=lambda: device.cwd, chdir=chdir, mount=mount, umount=mount, uname=uname,
+                     statvfs=lambda path="/": (4096, 4096, 512, 256, 256, 0, 0, 0, 0, 255),
+                     sync=lambda: None, urandom=os.urandom, dupterm=lambda *args: None)
+
+        def sysexit(code=0):
+            raise SystemExit(code)
+        def print_exception(e, file=None):
+            (file or self.stdout).write(self.formatexception(e))
+        # as on a firmware built with MICROPY_PY_SYS_SETTRACE, seeing only the device's code and not the simulator's
+        def settrace(tracefunc):
+            def devicetrace(frame, event, arg):
+                if frame.f_code.co_filename == __file__:
+                    return None
+                return devicetrace  if tracefunc(frame, event, arg)  else None
+            sys.settrace(devicetrace  if tracefunc  else None)
+        usys = module("sys", stdout=self.stdout, stdin=self.stdin, stderr=self.stdout, path=["", "/lib"], argv=[],
+                      modules=self.modules, platform="simulator", byteorder=sys.byteorder, maxsize=2**31-1,
+                      version="3.4.0; MicroPython v{}.{}.{}".format(*simversion), version_info=(3, 4, 0),
+                      implementation=types.SimpleNamespace(name="micropython", version=simversion + ("",), _mpy=0),
+                      exit=sysexit, print_exception=print_exception, settrace=settrace)
+
+        ticksperiod = 1 << 30
+        def ticks(scale):
+            return lambda: int(time.perf_counter()*scale) % ticksperiod
+        def sleep(seconds):   # in short steps so that a Ctrl-C gets through
+            tend = time.perf_counter() + seconds
+            while True:
+                remaining = tend - time.perf_counter()
+                if remaining <= 0:
+                    break
+                time.sleep(min(remaining, simpollinterval))
+        utime = module("time", time=time.time, time_ns=time.time_ns, localtime=time.localtime, gmtime=time.gmtime,
+                       mktime=time.mktime, sleep=sleep, sleep_ms=lambda ms: sleep(ms/1000), sleep_us=lambda us: sleep(us/1e6),
+                       ticks_ms=ticks(1e3), ticks_us=ticks(1e6), ticks_cpu=ticks(1e6),
+                       ticks_diff=lambda a, b: ((a - b + ticksperiod//2) % ticksperiod) - ticksperiod//2,
+                       ticks_add=lambda a, b: (a + b) % ticksperiod)
+
+        def memalloc():
+            return max(0, min(tracemalloc.get_traced_memory()[0] - self.heapbaseline, self.heapsize))  if tracemalloc.is_tracing()  else 0
+        ugc = module("gc", collect=gc.collect, enable=gc.enable, disable=gc.disable, isenabled=gc.isenabled,
+                     mem_alloc=memalloc, mem_free=lambda: self.heapsize - memalloc(), threshold=lambda *args: -1)
+
+        def kbd_intr(c):
+            device.kbdintr = c  if c >= 0  else None
+        def mem_info(verbose=None):
+            self.stdout.write("stack: 736 out of 15360\nGC: total: {}, used: {}, free: {}\n".format(self.heapsize, memalloc(), self.heapsize - memalloc()))
+        micropython = module("micropython", const=lambda x: x, kbd_intr=kbd_intr, mem_info=mem_info,
+                             opt_level=lambda level=None: 0, alloc_emergency_exception_buf=lambda n: None,
+                             heap_lock=lambda: 0, heap_unlock=lambda: 0, stack_use=lambda: 736, qstr_info=lambda verbose=None: None,
+                             schedule=lambda f, arg: f(arg) or True, native=lambda f: f, viper=lambda f: f)
+
+        class poll:
+            def __init__(self):
+                self.registered = { }
+            def register(self, obj, eventmask=5):
+                self.registered[id(obj)] = (obj, eventmask)
+            modify = register
+            def unregister(self, obj):
+                self.registered.pop(id(obj), None)
+            def poll(self, timeout=-1):
+                objs = [ obj  for obj, eventmask in self.registered.values()  if obj is device.stdin and eventmask & 1 ]
+                if objs and device.waitinput(None if timeout < 0 else timeout/1000):
+                    return [ (objs[0], 1) ]
+                return [ ]
+            ipoll = poll
+        uselect = module("select", poll=poll, POLLIN=1, POLLOUT=4, POLLERR=8, POLLHUP=16)
+
+        ubinascii = module("binascii", a2b_base64=binascii.a2b_base64, b2a_base64=binascii.b2a_base64, crc32=binascii.crc32,
+                           hexlify=binascii.hexlify, unhexlify=binascii.unhexlify)
+        udeflate = module("deflate", DeflateIO=DeflateIO, RAW=DeflateIO.RAW, ZLIB=DeflateIO.ZLIB, GZIP=DeflateIO.GZIP, AUTO=DeflateIO.AUTO)
+        def machinereset():
+            raise SoftReset()
+        machine = module("machine", reset=machinereset, soft_reset=machinereset, freq=lambda *args: 240000000,
+                         unique_id=lambda: hashlib.sha1(self.root.encode()).digest()[:6])
+
+        res = { }
+        for name, m in [("os", uos), ("sys", usys), ("time", utime), ("gc", ugc), ("micropython", micropython),
+                        ("select", uselect), ("binascii", ubinascii), ("deflate", udeflate), ("machine", machine)]:
+            res[name] = m
+            res["u" + name] = m
+        return res
+
+    # a traceback as the firmware prints it, without the frames of the simulator itself
+    def formatexception(self, e):
+        lines = [ "Traceback (most recent call last):\n" ]
+        for frame in traceback.extract_tb(e.__traceback__):
+            if frame.filename != __file__ and not frame.filename.startswith(os.path.dirname(os.__file__)):
+                lines.append('  File "{}", line {}, in {}\n'.format(frame.filename, frame.lineno, frame.name))
+        if isinstance(e, SyntaxError) and len(lines) == 1:
+            lines.append('  File "{}", line {}\n'.format(e.filename, e.lineno))
+        message = e.msg  if isinstance(e, SyntaxError)  else str(e)
+        lines.append("{}: {}\n".format(type(e).__name__, message)  if message  else "{}\n".format(type(e).__name__))
+        return "".join(lines)
+
+    # runs source in the REPL globals; returns the error text and whether it asked for a soft reset
+    def execute(self, source, kind, sourcename="<stdin>"):
+        self.nexecuted += 1
+        if type(source) == bytes:
+            source = source.decode("utf8", "replace")
+        source = source.replace("\r\n", "\n").replace("\r", "\n")
+        berror, breset = "", False
+        try:
+            bexpression = False
+            if kind == "single":   # an expression at the friendly REPL prints its repr
+                try:
+                    code = compile(source, sourcename, "eval")
+                    bexpression = True
+                except SyntaxError:
+                    code = compile(source, sourcename, "exec")
+            else:
+                code = compile(source, sourcename, "exec")
+            with self.executinglock:
+                self.executing = True
+            try:
+                res = eval(code, self.globals)  if bexpression  else exec(code, self.globals)
+                if bexpression and res is not None:
+                    self.stdout.write(repr(res) + "\n")
+            finally:
+                with self.executinglock:
+                    self.executing = False
+        except (SystemExit, SoftReset):
+            breset = True
+        except BaseException as e:
+            berror = self.formatexception(e)
+        return berror.replace("\n", "\r\n").encode("utf8"), breset
+
+    def run(self):
+        self.write(self.banner())
+        while True:
+            try:
+                if self.mode == "raw":
+                    self.rawrepl()
+                else:
+                    self.friendlyrepl()
+            except KeyboardInterrupt:   # landed just after a program finished
+                pass
+
+    def friendlyrepl(self):
+        source, line = "", bytearray()
+        self.write(b">>> ")
+        while True:
+            c = self.getbyte()
+            if c == 0x01:
+                self.write(b"\r\n")
+                self.mode = "raw"
+                self.write(b"raw REPL; CTRL-B to exit\r\n")
+                return
+            elif c == 0x02:
+                self.write(b"\r\n" + self.banner())
+                source, line = "", bytearray()
+                self.write(b">>> ")
+            elif c == 0x03:
+                source, line = "", bytearray()
+                self.write(b"\r\n>>> ")
+            elif c == 0x04:
+                if not source and not line:
+                    self.write(b"\r\n")
+                    self.softreset()
+                    self.write(self.banner())
+                    self.write(b">>> ")
+            elif c == 0x05:
+                self.pastemode()
+                source, line = "", bytearray()
+                self.write(b">>> ")
+            elif c in (0x08, 0x7f):
+                if line:
+                    line.pop()
+                    self.write(b"\x08 \x08")
+            elif c == 0x0d:
+                self.write(b"\r\n")
+                source += line.decode("utf8", "replace") + "\n"
+                line.clear()
+                try:
+                    bcomplete = codeop.compile_command(source, "<stdin>", "single") is not None
+                except (SyntaxError, ValueError, OverflowError):
+                    bcomplete = True
+                if not source.strip():
+                    source = ""
+                    self.write(b">>> ")
+                elif not bcomplete:
+                    self.write(b"... ")
+                else:
+                    error, breset = self.execute(source, "single")
+                    self.write(error)
+                    if breset:
+                        self.softreset()
+                        self.write(self.banner())
+                    source = ""
+                    self.write(b">>> ")
+            elif c != 0x0a:
+                line.append(c)
+                self.write(bytes([c]))
+
+    def pastemode(self):
+        self.write(b"\r\npaste mode; Ctrl-C to cancel, Ctrl-D to finish\r\n=== ")
+        source = bytearray()
+        while True:
+            c = self.getbyte()
+            if c == 0x03:
+                self.write(b"\r\n")
+                return
+            elif c == 0x04:
+                self.write(b"\r\n")
+                error, breset = self.execute(bytes(source), "exec")
+                self.write(error)
+                if breset:
+                    self.softreset()
+                    self.write(self.banner())
+                return
+            elif c == 0x0d:
+                source.append(0x0a)
+                self.write(b"\r\n=== ")
+            elif c != 0x0a:
+                source.append(c)
+                self.write(bytes([c]))
+
+    def rawrepl(self):
+        while self.mode == "raw":
+            self.write(b">")
+            line = bytearray()
+            while True:
+                c = self.getbyte()
+                if c == 0x01:
+                    self.write(b"raw REPL; CTRL-B to exit\r\n>")
+                    line.clear()
+                elif c == 0x02:
+                    self.write(b"\r\n")
+                    self.mode = "friendly"
+                    self.write(self.banner())
+                    return
+                elif c == 0x03:
+                    line.clear()
+                elif c == 0x04:
+                    break
+                elif c == 0x05 and not line:
+                    if self.getbytes(2) == b"A\x01":
+                        self.rawpaste()
+                        break
+                    self.write(b"R\x00")
+                else:
+                    line.append(c)
+            if c == 0x05:
+                continue
+            if not line:
+                self.write(b"OK\r\n")
+                self.softreset()
+                self.write(b"raw REPL; CTRL-B to exit\r\n")
+                continue
+            self.write(b"OK")
+            self.runraw(bytes(line))
+
+    def runraw(self, source):
+        error, breset = self.execute(source, "exec")
+        self.write(b"\x04" + error + b"\x04")
+        if breset:
+            self.softreset()
+            self.write(b"raw REPL; CTRL-B to exit\r\n")
+
+    # raw-paste mode: the host sends the program in windows of rawpastewindow bytes, each one asked for with \x01
+    def rawpaste(self):
+        self.write(b"R\x01" + struct.pack("<H", rawpastewindow) + b"\x01")
+        source = bytearray()
+        nwindow = 0
+        while True:
+            c = self.getbyte()
+            if c == 0x04:
+                self.write(b"\x04")
+                break
+            source.append(c)
+            nwindow += 1
+            if nwindow == rawpastewindow:
+                self.write(b"\x01")
+                nwindow = 0
+        self.runraw(bytes(source))
+
+
+# passes chunks on to deliver() as a wire of baudrate bits/s (10 bits a byte) and latency seconds would
+class PacedLink:
+    def __init__(self, deliver, baudrate=0, latency=0.0):
+        self.deliver = deliver
+        self.baudrate = baudrate
+        self.latency = latency
+        self.tfree = 0.0   # when the wire will have finished sending what it has already been given
+        self.queue = queue.Queue()
+        if baudrate or latency:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, data):
+        if not (self.baudrate or self.latency):
+            self.deliver(data)
+            return
+        now = time.perf_counter()
+        self.tfree = max(now, self.tfree) + (len(data)*10/self.baudrate  if self.baudrate  else 0)
+        self.queue.put((self.tfree + self.latency, data))
+
+    def run(self):
+        while True:
+            tdue, data = self.queue.get()
+            wait = tdue - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            self.deliver(data)
+
+
+# serves the device on a pseudo-terminal, whose name is given to %serialconnect --port
+class PtyTransport:
+    def __init__(self, device, baudrate, latency):
+        import tty
+        self.master, self.slave = os.openpty()   # the slave is kept open so the master doesn't get EIO between connections
+        tty.setraw(self.slave)
+        self.portname = os.ttyname(self.slave)
+        self.tohost = PacedLink(self.writemaster, baudrate, latency)
+        self.todevice = PacedLink(device.feed, baudrate, latency)
+        threading.Thread(target=self.readmaster, daemon=True).start()
+
+    def fromdevice(self, data):
+        self.tohost.send(data)
+
+    def writemaster(self, data):
+        while data:
+            data = data[os.write(self.master, data):]
+
+    def readmaster(self):
+        while True:
+            self.todevice.send(os.read(self.master, 4096))
+
+
+# serves the raw REPL bytes on a TCP port, for %socketconnect; a new connection takes over from the last
+class TcpTransport:
+    def __init__(self, device, port, baudrate, latency):
+        self.device = device
+        self.connection = None
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.tohost = PacedLink(self.sendhost, baudrate, latency)
+        self.todevice = PacedLink(device.feed, baudrate, latency)
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def fromdevice(self, data):
+        self.tohost.send(data)
+
+    def sendhost(self, data):
+        try:
+            if self.connection:
+                self.connection.sendall(data)
+        except OSError:
+            self.connection = None
+
+    def accept(self):
+        while True:
+            connection, address = self.server.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connection = connection
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        while True:
+            try:
+                data = connection.recv(4096)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            self.todevice.send(data)
+        if self.connection is connection:
+            self.connection = None
+
+
+# the WebREPL of the firmware: a password, then text frames for the REPL and binary frames for file transfers
+class WebreplTransport(TcpTransport):
+    def __init__(self, device, port, baudrate, latency, password=webreplpassword):
+        self.password = password
+        TcpTransport.__init__(self, device, port, baudrate, latency)
+
+    # REPL output goes as text frames, like the firmware, unless it isn't utf8
+    def fromdevice(self, data):
+        try:
+            data.decode("utf8")
+            self.tohost.send(self.frame(0x1, data))
+        except UnicodeDecodeError:
+            self.tohost.send(self.frame(0x2, data))
+
+    @staticmethod
+    def frame(opcode, payload):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack("!BB", 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+        return header + payload
+
+    @staticmethod
+    def recvexactly(connection, n):
+        res = bytearray()
+        while len(res) < n:
+            data = connection.recv(n - len(res))
+            if not data:
+                raise ConnectionError("websocket closed")
+            res.extend(data)
+        return bytes(res)
+
+    def recvframe(self, connection):
+        b0, b1 = self.recvexactly(connection, 2)
+        n = b1 & 0x7f
+        if n == 126:
+            (n,) = struct.unpack("!H", self.recvexactly(connection, 2))
+        elif n == 127:
+            (n,) = struct.unpack("!Q", self.recvexactly(connection, 8))
+        mask = self.recvexactly(connection, 4)  if b1 & 0x80  else b"\0\0\0\0"
+        payload = bytes(b ^ mask[i%4]  for i, b in enumerate(self.recvexactly(connection, n)))
+        return b0 & 0x0f, payload
+
+    def serve(self, connection):
+        try:
+            request = b""
+            while b"\r\n\r\n" not in request:
+                request += self.recvexactly(connection, 1)
+            key = [ line.split(b":", 1)[1].strip()  for line in request.split(b"\r\n")  if line.lower().startswith(b"sec-websocket-key:") ][0]
+            accept = base64.b64encode(hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
+            connection.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                               b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            connection.sendall(self.frame(0x1, b"Password: "))
+            password = b""
+            while b"\r" not in password:
+                opcode, payload = self.recvframe(connection)
+                password += payload
+            if password.split(b"\r")[0].decode() != self.password:
+                connection.sendall(self.frame(0x1, b"\r\nAccess denied\r\n"))
+                return
+            connection.sendall(self.frame(0x1, b"\r\nWebREPL connected\r\n>>> "))
+            self.connection = connection
+            transfer = None
+            while True:
+                opcode, payload = self.recvframe(connection)
+                if opcode == 0x8:
+                    break
+                elif opcode == 0x9:
+                    self.sendhost(self.frame(0xa, payload))
+                elif opcode == 0x1:
+                    self.todevice.send(payload)
+                elif opcode == 0x2:
+                    transfer = self.filetransfer(transfer, payload)
+        except (OSError, ConnectionError, IndexError):
+            pass
+        finally:
+            if self.connection is connection:
+                self.connection = None
+            connection.close()
+
+    # advances the GET/PUT file transfer state [header bytes, op, file, bytes left] with a binary frame
+    def filetransfer(self, transfer, payload):
+        def reply(code):
+            self.tohost.send(self.frame(0x2, struct.pack("<2sH", b"WB", code)))
+        if transfer is None or transfer[1] is None:
+            header = (transfer[0]  if transfer  else b"") + payload
+            if len(header) < struct.calcsize(webreplfile):
+                return [ header, None, None, 0 ]
+            sig, op, reserved, reserved2, size, fnamelength, fname = struct.unpack(webreplfile, header)
+            localfile = self.device.localpath(fname[:fnamelength])
+            try:
+                fobj = open(localfile, "wb"  if op == 1  else "rb")
+            except OSError:
+                reply(1)
+                return None
+            reply(0)
+            if op == 1 and size == 0:
+                fobj.close()
+                reply(0)
+                return None
+            return [ b"", op, fobj, size ]
+        header, op, fobj, remaining = transfer
+        if op == 1:
+            fobj.write(payload)
+            remaining -= len(payload)
+            if remaining <= 0:
+                fobj.close()
+                reply(0)
+                return None
+            return [ b"", op, fobj, remaining ]
+        data = fobj.read(1024)   # each \0 from the host asks for the next piece
+        self.tohost.send(self.frame(0x2, struct.pack("<H", len(data)) + data))
+        if not data:
+            fobj.close()
+            reply(0)
+            return None
+        return transfer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="A simulated MicroPython board to connect the kernel to")
+    parser.add_argument('--root', type=str, help="directory holding the device's filesystem (default a new temporary one)")
+    parser.add_argument('--pty', action='store_true', help="serve on a pseudo-terminal for %%serialconnect (the default)")
+    parser.add_argument('--tcp', type=int, help="serve the raw REPL on this TCP port for %%socketconnect (0 for any free port)")
+    parser.add_argument('--websocket', type=int, help="serve WebREPL on this port for %%websocketconnect (0 for any free port)")
+    parser.add_argument('--password', type=str, default=webreplpassword)
+    parser.add_argument('--baud', type=int, default=0, help="bits per second each way, 0 for no limit")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each way")
+    parser.add_argument('--heap', type=int, default=simheapsize, help="bytes of heap the device reports")
+    args = parser.parse_args(argv)
+
+    root = args.root or tempfile.mkdtemp(prefix="alpacasim")
+    os.makedirs(root, exist_ok=True)
+    transports = [ ]
+    device = SimulatedDevice(root, lambda data: [ transport.fromdevice(data)  for transport in transports ], args.heap)
+
+    info = { "root":root, "baud":args.baud, "latency":args.latency }
+    if args.pty or (args.tcp is None and args.websocket is None):
+        transport = PtyTransport(device, args.baud, args.latency)
+        transports.append(transport)
+        info["pty"] = transport.portname
+    if args.tcp is not None:
+        transport = TcpTransport(device, args.tcp, args.baud, args.latency)
+        transports.append(transport)
+        info["tcp"] = transport.port
+    if args.websocket is not None:
+        transport = WebreplTransport(device, args.websocket, args.baud, args.latency, args.password)
+        transports.append(transport)
+        info["websocket"] = "ws://127.0.0.1:{}".format(transport.port)
+        info["password"] = args.password
+
+    tracemalloc.start()   # so that gc.mem_alloc() follows what the cells allocate
+    device.newinterpreter()
+    device.start()
+    print("ALPACASIM " + json.dumps(info), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
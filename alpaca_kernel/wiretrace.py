@@ -0,0 +1,131 @@
+"""Records the bytes going to and from the device, and plays them back without it.
+
+A trace file is ``ALPT`` and a version byte followed by records of a ``<BdI`` header (direction, seconds
+since the recording started, length) and the data.  ``DeviceConnector`` records each write as it goes out
+and each chunk as ``yieldserialchunk`` hands it on, so the chunker finds the same boundaries when it reads
+them back.  A trace cut short by a crash just ends at its last whole record.
+
+``ReplaySerial`` stands in for serial.Serial, giving out the recorded reads at their original times (scaled
+by the speed) or as fast as they are asked for, so that ``DeviceConnector.replaytrace`` can run them through
+receivestream to reproduce ``[missing-OK]`` style glitches offline, or to time the parsing on real traffic.
+"""
+
+import struct
+import time
+
+import serial
+
+tracemagic = b"ALPT"
+traceversion = 1
+tracerecord = "<BdI"
+tracewrite, traceread, tracenote = 0, 1, 2
+
+
+class TraceRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.fout = open(filename, "wb")
+        self.fout.write(tracemagic + bytes([traceversion]))
+        self.t0 = time.perf_counter()
+        self.nrecords = [ 0, 0, 0 ]   # by direction
+        self.nbytes = [ 0, 0, 0 ]
+
+    def record(self, direction, data):
+        if type(data) == str:
+            data = data.encode("utf8")   # websocket text frames
+        self.fout.write(struct.pack(tracerecord, direction, time.perf_counter() - self.t0, len(data)))
+        self.fout.write(data)
+        self.nrecords[direction] += 1
+        self.nbytes[direction] += len(data)
+
+    def close(self):
+        self.fout.close()
+
+
+# returns [(direction, seconds, data)]
+def readtrace(filename):
+    records = [ ]
+    headersize = struct.calcsize(tracerecord)
+    with open(filename, "rb") as fin:
+        if fin.read(len(tracemagic)+1) != tracemagic + bytes([traceversion]):
+            raise ValueError("{} is not a wire trace".format(filename))
+        while True:
+            header = fin.read(headersize)
+            if len(header) < headersize:
+                break
+            direction, t, n = struct.unpack(tracerecord, header)
+            data = fin.read(n)
+            if len(data) < n:
+                break
+            records.append((direction, t, data))
+    return records
+
+
+class ReplaySerial:
+    def __init__(self, records, speed=None, timeout=0.5):
+        self.port = "replay"
+        self.baudrate = 0
+        self.speed = speed          # None for as fast as possible
+        self.timeout = timeout      # longest a read() waits before returning nothing, like serial.Serial
+        self.nwrites = 0            # write records the replay has got past, set by the driver
+        self.reads = [ ]            # (seconds, write records before it, data)
+        nwrites = 0
+        for direction, t, data in records:
+            if direction == tracewrite:
+                nwrites += 1
+            elif direction == traceread:
+                self.reads.append((t, nwrites, data))
+        self.readindex = 0
+        self.buffer = b""           # the read being given out, from bufferindex on
+        self.bufferindex = 0
+        self.nbytesread = 0
+        self.t0 = time.perf_counter()
+
+    def unread(self):
+        return self.bufferindex < len(self.buffer) or self.readindex < len(self.reads)
+
+    # seconds until the read was recorded
+    def wait(self, t):
+        return (self.t0 + t/self.speed - time.perf_counter())  if self.speed  else 0
+
+    def read(self, n=1):
+        if self.bufferindex >= len(self.buffer):
+            if self.readindex == len(self.reads):
+                raise serial.SerialException("end of trace")
+            t, nwrites, data = self.reads[self.readindex]
+            wait = self.wait(t)
+            if wait > self.timeout:
+                time.sleep(self.timeout)
+                return b""
+            if wait > 0:
+                time.sleep(wait)
+            self.buffer, self.bufferindex = data, 0
+            self.readindex += 1
+        res = self.buffer[self.bufferindex:self.bufferindex+n]
+        self.bufferindex += len(res)
+        self.nbytesread += len(res)
+        return res
+
+    # what had come in before the next write in the trace
+    def read_all(self):
+        res = [ self.buffer[self.bufferindex:] ]
+        self.buffer, self.bufferindex = b"", 0
+        while self.readindex < len(self.reads) and self.reads[self.readindex][1] <= self.nwrites:
+            t, nwrites, data = self.reads[self.readindex]
+            wait = self.wait(t)
+            if wait > 0:
+                time.sleep(wait)
+            res.append(data)
+            self.readindex += 1
+        res = b"".join(res)
+        self.nbytesread += len(res)
+        return res
+
+    def write(self, data):
+        return len(data)
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
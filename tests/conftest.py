@@ -0,0 +1,47 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from alpaca_kernel import deviceconnector
+
+
+class Output(list):
+    def sres(self, output, *args, **kwargs):
+        self.append(str(output))
+
+    def text(self):
+        return "".join(self)
+
+
+@pytest.fixture
+def output():
+    return Output()
+
+
+@pytest.fixture
+def disconnected(output):
+    return deviceconnector.DeviceConnector(output.sres, output.sres, output.sres)
+
+
+# a simulated board on a pseudo-terminal, as started by python -m alpaca_kernel.simulator --pty
+@pytest.fixture(scope="module")
+def simulator():
+    proc = subprocess.Popen([sys.executable, "-m", "alpaca_kernel.simulator", "--pty"], stdout=subprocess.PIPE)
+    try:
+        info = json.loads(proc.stdout.readline().decode().split(" ", 1)[1])
+        yield info
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+@pytest.fixture
+def device(simulator, output):
+    dc = deviceconnector.DeviceConnector(output.sres, output.sres, output.sres)
+    dc.serialconnect(simulator["pty"], 115200, False)
+    dc.enterpastemode(verbose=False)
+    output.clear()
+    yield dc
+    dc.disconnect(raw=True)
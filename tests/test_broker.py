@@ -0,0 +1,106 @@
+import os
+import socket
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from alpaca_kernel import broker
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="the broker needs unix sockets")
+
+
+@pytest.fixture
+def devicepty():
+    master, slave = os.openpty()
+    yield os.ttyname(slave)
+    os.close(master)
+    os.close(slave)
+
+
+@pytest.fixture
+def socketpath(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    thread = threading.Thread(target=broker.DeviceBroker(path).serve, daemon=True)
+    thread.start()
+    for i in range(100):
+        if os.path.exists(path):
+            break
+        thread.join(0.01)
+    yield path
+    s = broker.BrokerSerial(path)
+    s.request(broker.FQUIT)
+    s.sock.close()
+    thread.join(5)
+
+
+def test_monitor_cannot_close_the_port(socketpath, devicepty):
+    controller = broker.BrokerSerial(socketpath).attach(devicepty, 115200)
+    monitor = broker.BrokerSerial(socketpath).attach(devicepty, None, monitor=True)
+    assert not monitor.request(broker.FCLOSE)["ok"]
+    assert [ d["port"]  for d in broker.brokerstatus(socketpath) ] == [ devicepty ]
+    controller.close()
+    assert broker.brokerstatus(socketpath) == [ ]
+    monitor.sock.close()
+
+
+def test_takeover_notice_is_not_a_reply(socketpath, devicepty):
+    first = broker.BrokerSerial(socketpath).attach(devicepty, 115200)
+    second = broker.BrokerSerial(socketpath).attach(devicepty, 115200)
+    assert second.fresh is False
+    first.read_all()
+    assert first.takenover
+    with pytest.raises(broker.serial.SerialException):
+        first.write(b"x")
+    first.attach(devicepty, 115200)   # taking control back gets the attach reply, not the old notice
+    assert first.takenover is False and first.write(b"x") == 1
+    second.sock.close()
+    first.close()
+
+
+def test_stalled_monitor_does_not_block_the_broker(socketpath, monkeypatch):
+    monkeypatch.setattr(broker, "clientbuffermax", 256*1024)   # the broker thread reads the module global
+    master, slave = os.openpty()
+    devicename = os.ttyname(slave)
+    try:
+        controller = broker.BrokerSerial(socketpath).attach(devicename, 115200)
+        monitor = broker.BrokerSerial(socketpath).attach(devicename, None, monitor=True)   # never reads
+        chunk = b"x"*4095 + b"\n"
+        nbytes = 4*1024*1024
+        writer = threading.Thread(target=lambda: [ os.write(master, chunk)  for i in range(nbytes//len(chunk)) ], daemon=True)
+        writer.start()
+        received = 0
+        tend = time.time() + 30
+        while received < nbytes and time.time() < tend:
+            received += len(controller.read(65536))
+        writer.join(5)
+        assert received == nbytes
+        assert broker.brokerstatus(socketpath)[0]["monitors"] == 0   # dropped, rather than blocking everything
+        controller.close()
+        monitor.sock.close()
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_controller_not_reading_loses_oldest_output(tmp_path, monkeypatch):
+    monkeypatch.setattr(broker, "clientbuffermax", 256*1024)
+    db = broker.DeviceBroker(str(tmp_path / "unused.sock"))
+    brokerside, kernelside = socket.socketpair()
+    brokerside.setblocking(False)
+    db.clients[brokerside] = broker.BrokerClient()
+    db.sel.register(brokerside, broker.selectors.EVENT_READ, "client")
+    device = types.SimpleNamespace(portname="/dev/ttyX", controller=brokerside, monitors=set())
+    db.clients[brokerside].device = device
+    for i in range(100):
+        db.queueframe(brokerside, broker.FDATA, bytes([ i ])*50000)
+    client = db.clients[brokerside]
+    assert client.outbytes <= broker.clientbuffermax
+    assert client.outframes[-1][1][-1] == 99
+
+    device.controller = None   # as a monitor it is dropped instead
+    db.queueframe(brokerside, broker.FDATA, b"y"*300000)
+    assert brokerside not in db.clients
+    kernelside.close()
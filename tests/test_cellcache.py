@@ -0,0 +1,15 @@
+def test_cached_cell_reruns(device, output):
+    cell = "x = [ i*i  for i in range(100) ]\nprint(sum(x))\n"
+    device.runcachedcell(cell, 4)
+    device.runcachedcell(cell, 4)
+    assert output.text().count("328350") == 2
+    assert len(device.cachedcells) == 1
+
+
+def test_disconnect_forgets_device_state(device):
+    device.runcachedcell("y = 1\n", 4)
+    assert device.cachedcells and device.installedhelpers
+    device.disconnect(raw=True)
+    assert not device.cachedcells
+    assert not device.installedhelpers
+    assert device.agentversion is None
@@ -0,0 +1,57 @@
+import subprocess
+import sys
+
+from alpaca_kernel import deviceconnector
+
+
+def test_all_skips_busy_ports(disconnected, output, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALPACA_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(deviceconnector, "guessserialport", lambda: [ "/dev/ttyA", "/dev/ttyB", "/dev/ttyC" ])
+    monkeypatch.setattr(deviceconnector, "brokerheldports", lambda: [ "/dev/ttyC" ])
+    disconnected._esptool_command = "esptool.py"
+    flashed = [ ]
+    monkeypatch.setattr(disconnected, "runesptools", lambda pargsbyport: flashed.extend(pargsbyport) or ({ }, { }))
+    disconnected.esptool("erase", "all", None, busyports=[ "/dev/ttyA" ])
+    assert flashed == [ "/dev/ttyB" ]
+    assert "Skipping /dev/ttyA" in output.text() and "Skipping /dev/ttyC" in output.text()
+
+
+def test_no_broker_holds_nothing(monkeypatch, tmp_path):
+    monkeypatch.setenv("ALPACA_BROKER_SOCKET", str(tmp_path / "nobroker.sock"))
+    assert deviceconnector.brokerheldports() == [ ]
+
+
+def test_firmware_cache_records_and_reports(disconnected, output, monkeypatch, tmp_path):
+    monkeypatch.setenv("ALPACA_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(deviceconnector, "guessserialport", lambda: [ "/dev/ttyA" ])
+    disconnected._esptool_command = "esptool.py"
+    binfile = tmp_path / "firmware.bin"
+    binfile.write_bytes(b"\xe9" + bytes(1000))
+    sha256 = deviceconnector.hashlib.sha256(binfile.read_bytes()).hexdigest()
+    result = { "port":"/dev/ttyA", "sha256":sha256, "size":1001, "file":str(binfile), "offset":0,
+               "mac":"00:11:22:33:44:55", "written":1001, "skipped":False }
+    monkeypatch.setattr(disconnected, "runesptools", lambda pargsbyport: ({ "/dev/ttyA":0 }, { "/dev/ttyA":result }))
+
+    disconnected.esptool("esp8266", [ "/dev/ttyA" ], str(binfile))
+    assert "known to hold" not in output.text()
+    ports = deviceconnector.loadjsoncache("firmwarecache.json")[sha256]["ports"]
+    assert ports["/dev/ttyA"]["mac"] == "00:11:22:33:44:55"
+
+    output.clear()
+    disconnected.esptool("esp8266", [ "/dev/ttyA" ], str(binfile))
+    assert "/dev/ttyA is known to hold this image (board 00:11:22:33:44:55" in output.text()
+
+    monkeypatch.setattr(disconnected, "runesptools", lambda pargsbyport: ({ "/dev/ttyA":0 }, { }))
+    disconnected.esptool("erase", [ "/dev/ttyA" ], None)
+    assert deviceconnector.loadjsoncache("firmwarecache.json") == { }
+
+
+def test_closing_streamprocesses_stops_the_processes(monkeypatch):
+    processes = [ ]
+    popen = subprocess.Popen
+    monkeypatch.setattr(subprocess, "Popen", lambda *args, **kwargs: processes.append(popen(*args, **kwargs)) or processes[-1])
+    script = "import time; print('started', flush=True); time.sleep(60)"
+    lines = deviceconnector.streamprocesses({ "slow":[ sys.executable, "-c", script ] })
+    assert next(lines) == ("slow", "stdout", "started\n")
+    lines.close()
+    assert processes[0].poll() is not None
@@ -0,0 +1,41 @@
+import json
+
+from alpaca_kernel import flashimage
+
+
+def esp8266image(nbytes=0x9000):
+    return b"\xe9\x03\x00\x00" + bytes(i % 251  for i in range(nbytes - 4))
+
+
+def test_header_patched_only_with_header_flashargs():
+    image = esp8266image()
+    assert flashimage.esptoolpatchesheader(image, 0, "--flash_size=detect -fm dio")
+    assert not flashimage.esptoolpatchesheader(image, 0, "")
+    assert not flashimage.esptoolpatchesheader(image, 0x10000, "-fm dio")
+    assert not flashimage.esptoolpatchesheader(b"\x00" + image[1:], 0, "-fm dio")
+
+
+def test_flash_with_rewritten_header_matches():
+    image = esp8266image()
+    flash = image[:2] + b"\x02\x40" + image[4:]   # dio, 4MB as esptool wrote it
+    devicemd5s = flashimage.blockmd5s(flash)
+    assert flashimage.changedregions(flashimage.blockmd5s(image), devicemd5s, len(image)) == [ (0, 0x4000) ]
+    patched = flashimage.patchedimage(image, flash[:4])
+    assert flashimage.changedregions(flashimage.blockmd5s(patched), devicemd5s, len(image)) == [ ]
+
+
+def test_only_changed_blocks_written(tmp_path, monkeypatch, capsys):
+    image = esp8266image()
+    flash = bytearray(image[:2] + b"\x02\x40" + image[4:])
+    flash[0x5000] ^= 0xff
+    binfile = tmp_path / "firmware.bin"
+    binfile.write_bytes(image)
+    calls = [ ]
+    monkeypatch.setattr(flashimage, "flashmd5s", lambda port, baud, offset, image, bheader: 
+                        ("00:11:22:33:44:55", flashimage.blockmd5s(bytes(flash)), bytes(flash[:4]) if bheader else None))
+    monkeypatch.setattr(flashimage.subprocess, "call", lambda pargs: calls.append(pargs) or 0)
+
+    assert flashimage.main([ "--port", "/dev/null", "--offset", "0", "--flashargs", "--flash_size=detect -fm dio", str(binfile) ]) == 0
+    result = json.loads(capsys.readouterr().out.splitlines()[-1][len("ALPACAFLASH "):])
+    assert result["written"] == 0x4000 and not result["skipped"]
+    assert calls[0][-2] == "0x4000"
@@ -0,0 +1,31 @@
+from alpaca_kernel import deviceconnector
+from alpaca_kernel import wiretrace
+
+
+def receive(dc, stream):
+    dc.workingserial = wiretrace.ReplaySerial([ (wiretrace.traceread, 0.0, stream) ])
+    dc.receivestream(bseekokay=True)
+
+
+def test_frame_after_output_without_newline(disconnected, output):
+    receive(disconnected, b"OKno newline\x1e('exprs', {'a': (1, '42')})\r\n\x04\x04>")
+    assert output.text() == "no newline"
+    assert disconnected.sidevalues("exprs") == [ ({'a': (1, '42')},) ]
+
+
+def test_chunks_split_at_frame_marker():
+    stream = b"OKabc\x1e('heap', 1, 2, 3, 4)\r\n\x04\x04>"
+    chunks = list(deviceconnector.yieldserialchunk(wiretrace.ReplaySerial([ (wiretrace.traceread, 0.0, stream) ])))
+    assert chunks[:3] == [ b"OK", b"abc", b"\x1e('heap', 1, 2, 3, 4)\r\n" ]
+
+
+def test_user_expressions_after_print_without_newline(device, output):
+    device.runsourcecell("print('x', end='')\n", suffix=device.userexpressionsprogram({"n":"6*7"}))
+    assert output.text() == "x"
+    assert device.userexpressionresults() == {"n":(1, "42")}
+
+
+def test_heap_after_print_without_newline(device, output):
+    heap = device.runheapcell("print('y', end='')\n")
+    assert output.text() == "y"
+    assert heap and len(heap) == 4
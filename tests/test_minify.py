@@ -0,0 +1,49 @@
+import pytest
+
+from alpaca_kernel.minify import minifysource
+
+
+def runs(source):
+    namespace = { }
+    exec(compile(source, "<cell>", "exec"), namespace)
+    return namespace
+
+
+def test_comments_blank_lines_and_indentation():
+    source = "# heading\n\ndef f(x):\n    # comment\n    if x:\n        return 1  # one\n\n    return 2\n"
+    minified, linemap = minifysource(source)
+    assert minified == "def f(x):\n if x:\n  return 1\n return 2\n"
+    assert linemap == [ 3, 5, 6, 8 ]
+
+
+def test_strings_left_alone():
+    source = "s = '''a\n    # not a comment\n'''\nt = f'{s!r:>10}'  # tail\n"
+    minified, linemap = minifysource(source)
+    assert runs(minified)["t"] == runs(source)["t"]
+    assert "# not a comment" in minified
+
+
+def test_docstrings_dropped():
+    source = '"""module"""\ndef f():\n    """doc\n    string"""\n    return 3\n'
+    minified, linemap = minifysource(source)
+    assert minified == "def f():\n return 3\n"
+    assert runs(minified)["f"]() == 3
+
+
+@pytest.mark.parametrize("source, expected", [
+    ('def f():\n    "doc"\n', "def f():\n pass\n"),
+    ('def f():\n    "a"\n    "b"\n', "def f():\n pass\n"),
+    ('def f():\n    """a\n    b"""\n    "c"\nx = 1\n', "def f():\n pass\nx = 1\n"),
+    ('class C:\n    "a"\n    def g(self):\n        "b"\n        "c"\n', "class C:\n def g(self):\n  pass\n"),
+    ('if True:\n    if True:\n        "a"\n        # only comments\n        "b"\n    y = 2\n', "if True:\n if True:\n  pass\n y = 2\n"),
+    ('def f():\n    "a"\n    "b".join("c")\n', 'def f():\n "b".join("c")\n'),
+])
+def test_blocks_of_only_docstrings_get_pass(source, expected):
+    minified, linemap = minifysource(source)
+    assert minified == expected
+    runs(minified)
+
+
+def test_untokenizable_source_unchanged():
+    source = "s = '''open\n"
+    assert minifysource(source) == (source, [ 1 ])
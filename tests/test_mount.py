@@ -0,0 +1,35 @@
+import binascii
+
+from alpaca_kernel import hostmount
+
+
+def test_mount_without_connection(disconnected, output, tmp_path):
+    disconnected.mount(str(tmp_path))
+    assert "No serial connected" in output.text()
+    assert disconnected.hostmount is None
+
+
+def test_unmount_without_connection(disconnected, output):
+    disconnected.unmount()
+    assert output.text() == "Nothing mounted\n"
+
+
+def request(hm, line):
+    reply = hm.handle(line)
+    assert int(reply[:8], 16) == len(reply) - 8
+    return reply[8:]
+
+
+def test_hostmount_requests(tmp_path):
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "mod.py").write_bytes(b"x = 1\n")
+    hm = hostmount.HostMount(str(tmp_path))
+    hexpath = lambda path: binascii.hexlify(path.encode())
+
+    assert request(hm, b"\x18l " + hexpath("lib")) == b"%d 6 mod.py" % 0x8000
+    assert request(hm, b"\x18s " + hexpath("lib")).startswith(b"%d 0 " % 0x4000)
+    assert request(hm, b"\x18s " + hexpath("nothere")) == b""
+    fid, size = request(hm, b"\x18o " + hexpath("lib/mod.py")).split()
+    assert int(size) == 6
+    assert request(hm, b"\x18r %x 2 10" % int(fid)) == b"= 1\n"
+    assert request(hm, b"\x18o " + hexpath("../outside")) == b""
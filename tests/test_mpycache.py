@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pytest
+
+from alpaca_kernel import mpycache
+
+
+def test_declaresglobals():
+    assert mpycache.declaresglobals("def f():\n    global x\n    x = 1\n")
+    assert not mpycache.declaresglobals("def f():\n    return x\n")
+    assert not mpycache.declaresglobals("s = 'global x'  # global\n")
+    assert mpycache.declaresglobals("s = '''unterminated\n")
+
+
+# stands in for mpy-cross: "compiles" by prefixing M, and fails on sources containing a syntax error
+fakempycross = """#!{python}
+import sys
+if sys.argv[1] == "--version":
+    print("MicroPython fake mpy-cross")
+    sys.exit(0)
+args = sys.argv[1:]
+pyfile = args[-1]
+mpyfile = args[args.index("-o")+1]  if "-o" in args  else pyfile[:-3] + ".mpy"
+source = open(pyfile, "rb").read()
+if b"syntax error" in source:
+    print("{{}}:1: SyntaxError: invalid syntax".format(pyfile))
+    sys.exit(1)
+open(mpyfile, "wb").write(b"M" + source)
+"""
+
+
+@pytest.fixture
+def mpycrossexe(tmp_path):
+    exe = tmp_path / "mpy-cross"
+    exe.write_text(fakempycross.format(python=sys.executable))
+    exe.chmod(0o755)
+    return str(exe)
+
+
+def test_buildtree_uses_the_cache(mpycrossexe, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.py").write_bytes(b"x = 1\n")
+    (src / "main.py").write_bytes(b"import a\n")
+    (tmp_path / "cache").mkdir()
+    cache = mpycache.MpyBuildCache(mpycrossexe, cachedir=str(tmp_path / "cache"))
+    assert cache.buildtree(str(src)) == ({ "a.py":b"Mx = 1\n" }, { }, 0)
+    assert cache.buildtree(str(src)) == ({ "a.py":b"Mx = 1\n" }, { }, 1)
+
+
+def test_failed_compile_gives_no_stale_bytecode(mpycrossexe, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.py").write_bytes(b"x = 1\n")
+    (tmp_path / "cache").mkdir()
+    cache = mpycache.MpyBuildCache(mpycrossexe, cachedir=str(tmp_path / "cache"))
+    cache.buildtree(str(src))
+    (src / "a.py").write_bytes(b"x = syntax error\n")
+    built, errors, ncachehits = cache.buildtree(str(src))
+    assert built == { } and ncachehits == 0
+    assert "SyntaxError" in errors["a.py"]
+
+
+def test_mpycross_failure_keeps_mpy(mpycrossexe, disconnected, output, tmp_path):
+    pyfile = tmp_path / "a.py"
+    pyfile.write_bytes(b"x = 1\n")
+    disconnected.mpycross(mpycrossexe, str(pyfile))
+    assert (tmp_path / "a.mpy").read_bytes() == b"Mx = 1\n"
+    os.utime(tmp_path / "a.mpy", (1, 1))
+    pyfile.write_bytes(b"x = syntax error\n")
+    output.clear()
+    disconnected.mpycross(mpycrossexe, str(pyfile))
+    assert "SyntaxError" in output.text()
+    assert "mpy-cross failed" in output.text()
+    assert (tmp_path / "a.mpy").read_bytes() == b"Mx = 1\n"
+    assert mpycache.mpyoutofdate(str(tmp_path / "a.mpy"))
@@ -0,0 +1,7 @@
+from alpaca_kernel import plotparse
+
+
+def test_unpack_Thonny_string_is_quiet(capsys):
+    points = plotparse.unpack_Thonny_string("Random walk: 7 just random: 2.571 sine: 0.6442")
+    assert capsys.readouterr().out == ""
+    assert points == { "Random walk":7.0, "just random":2.571, "sine":0.6442 }
@@ -0,0 +1,17 @@
+def test_source_cell_is_one_write(device, output):
+    for cell, suffix in [("print(1+1)\n", ""), ("a = 5\nfor i in range(3):\n    a += i\nprint(a)\n", ""),
+                         ("b = 2\n", device.userexpressionsprogram({"b":"b*3"}))]:
+        device.resetstats()
+        device.runsourcecell(cell, suffix=suffix)
+        assert device.stats["nwrites"] == 1, cell
+    assert output.text() == "2\r\n8\r\n"
+    assert device.userexpressionresults() == {"b":(1, "6")}
+
+
+def test_suppressed_end_code_still_sends(device, output):
+    device.resetstats()
+    device.runsourcecell("print('later')\n", bsuppressendcode=True)
+    assert device.stats["nwrites"] == 1
+    device.writebytes(b'\r\x04')
+    device.receivestream(bseekokay=True)
+    assert output.text() == "later\r\n"